@@ -1,11 +1,116 @@
 #-*- coding: utf-8 -*-
 """
 Ads app admin module
+
+Changelists of geoads tables stay usable with millions of rows:
+- the count of unfiltered changelists, and the total count shown with
+  filtered ones, are estimated from PostgreSQL statistics (pg_class.reltuples)
+  above GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD rows
+- foreign keys are joined (list_select_related) and generic foreign keys
+  of a page are resolved in one query per content type
+- foreign keys to big tables use raw id widgets, list filters use indexed columns
 """
 from django.contrib import admin
-from geoads.models import AdSearch, AdPicture, AdSearchResult
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.contenttypes.generic import GenericForeignKey
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connection
+
+from geoads.models import AdSearch, AdPicture, AdSearchResult, SlowFilterQuery
+from geoads.settings import GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD
+from geoads.utils import resolve_content_objects
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the planner row estimate of the table as count of
+    unfiltered querysets, when the table is big (PostgreSQL only)
+    """
+    def _get_count(self):
+        query = getattr(self.object_list, 'query', None)
+        if self._count is None and query is not None and not query.where \
+                and connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s AND relkind = %s',
+                           [self.object_list.model._meta.db_table, 'r'])
+            row = cursor.fetchone()
+            if row is not None and row[0] >= GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                self._count = int(row[0])
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
+
+class ContentObjectsChangeList(ChangeList):
+    """
+    ChangeList resolving generic foreign keys of the page in batch
+
+    The unfiltered count shown next to filtered results
+    goes through the paginator too, so that it's estimated.
+    """
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = self.model_admin.get_paginator(request, self.root_query_set,
+                                                               self.list_per_page).count
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+        for field in self.model._meta.virtual_fields:
+            if isinstance(field, GenericForeignKey):
+                self.result_list = resolve_content_objects(self.result_list, field.name)
+
+
+class GeoadsModelAdmin(admin.ModelAdmin):
+    """
+    ModelAdmin for big geoads tables
+    """
+    list_select_related = True
+    paginator = EstimatedCountPaginator
+
+    def get_changelist(self, request, **kwargs):
+        return ContentObjectsChangeList
+
+
+class AdSearchAdmin(GeoadsModelAdmin):
+    list_display = ('id', 'user', 'content_type', 'search', 'public', 'unread_count', 'create_date')
+    # (content_type, public) and (public, id) indexes, see geoads.indexes
+    list_filter = ('content_type', 'public')
+    raw_id_fields = ('user',)
+
+
+class AdPictureAdmin(GeoadsModelAdmin):
+    list_display = ('id', 'title', 'content_type', 'content_object')
+    list_filter = ('content_type',)
+
+
+class AdSearchResultAdmin(GeoadsModelAdmin):
+    list_display = ('id', 'ad_search', 'content_type', 'content_object', 'contacted', 'create_date')
+    list_filter = ('content_type',)
+    raw_id_fields = ('ad_search',)
+
+
+class SlowFilterQueryAdmin(GeoadsModelAdmin):
+    list_display = ('search', 'content_type', 'duration', 'create_date')
+    list_filter = ('content_type',)
 
 
-admin.site.register(AdSearch)
-admin.site.register(AdPicture)
-admin.site.register(AdSearchResult)
+admin.site.register(AdSearch, AdSearchAdmin)
+admin.site.register(AdPicture, AdPictureAdmin)
+admin.site.register(AdSearchResult, AdSearchResultAdmin)
+admin.site.register(SlowFilterQuery, SlowFilterQueryAdmin)
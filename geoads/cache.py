@@ -0,0 +1,66 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app cache module
+
+Cache keys of rendered ad fragments, built from
+(content_type, pk, update_date) and an ad version bumped
+by ad save/delete and moderation, so that a fragment is never
+served once its ad changed.
+
+Ad model versions, bumped the same way by any ad write,
+key cached results computed over all ads of a model (facet counts).
+"""
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from geoads.settings import GEOADS_FRAGMENT_CACHE_TIMEOUT, GEOADS_FACETS_CACHE_TIMEOUT
+
+
+def _ad_version_key(content_type_id, pk):
+    return 'geoads:ad_version:%s:%s' % (content_type_id, pk)
+
+
+def ad_fragment_cache_key(ad, fragment='body'):
+    """
+    Return the cache key of a rendered fragment of ad
+    """
+    content_type_id = ContentType.objects.get_for_model(ad).id
+    version = cache.get(_ad_version_key(content_type_id, ad.pk), 0)
+    update_date = ad.update_date.strftime('%Y%m%d%H%M%S%f') if ad.update_date else ''
+    return 'geoads:ad_fragment:%s:%s:%s:%s:%s' % (fragment, content_type_id, ad.pk,
+                                                   update_date, version)
+
+
+def _model_version_key(content_type_id):
+    return 'geoads:model_version:%s' % content_type_id
+
+
+def ad_model_version(model):
+    """
+    Return the current version of an ad model, changed by any write of its ads
+    """
+    key = _model_version_key(ContentType.objects.get_for_model(model).id)
+    version = cache.get(key)
+    if version is None:
+        # a new version, never used by the results cached with an expired one
+        cache.add(key, '%.6f' % time.time(), GEOADS_FACETS_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_ad_fragments(ad):
+    """
+    Invalidate all cached fragments of ad, and results cached for its model
+    """
+    content_type_id = ContentType.objects.get_for_model(ad).id
+    key = _ad_version_key(content_type_id, ad.pk)
+    # fragments rendered before are older than this version key,
+    # so they expire before it does
+    cache.set(key, '%.6f' % time.time(), GEOADS_FRAGMENT_CACHE_TIMEOUT)
+    cache.delete(_model_version_key(content_type_id))
+
+
+def ad_fragments_invalidation_handler(sender, instance, **kwargs):
+    invalidate_ad_fragments(instance)
@@ -1,7 +1,55 @@
 #-*- coding: utf-8 -*-
 from django.contrib import admin
+from django.contrib.contenttypes.models import ContentType
 from moderation.admin import ModerationAdmin
+from moderation.models import ModeratedObject
+from geoads.admin import ContentObjectsChangeList, EstimatedCountPaginator
 from geoads.contrib.moderation.models import ModeratedAd
+from geoads.contrib.moderation.moderator import batched_matching
+
+
+class ModeratedAdAdmin(ModerationAdmin):
+    """
+    Moderated ad admin, with bulk approve/reject actions
+    matching the selection in one batched pass
+    """
+    actions = ['approve_selected', 'reject_selected']
+    list_display = ('__unicode__', 'user', 'visible', 'create_date', 'update_date', 'delete_date')
+    list_select_related = True
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+
+    def queryset(self, request):
+        # soft deleted ads are listed too (and unfiltered counts can be estimated)
+        queryset = self.model.all_objects.get_query_set()
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
+    def get_changelist(self, request, **kwargs):
+        return ContentObjectsChangeList
+
+    def moderate_selected(self, request, queryset, approve):
+        moderated_objects = ModeratedObject.objects.filter(
+            content_type=ContentType.objects.get_for_model(self.model),
+            object_pk__in=list(queryset.values_list('pk', flat=True)))
+        with batched_matching():
+            for moderated_object in moderated_objects:
+                if approve:
+                    moderated_object.approve(request.user)
+                else:
+                    moderated_object.reject(request.user)
+        self.message_user(request, u'%s annonce(s) %s.'
+                          % (len(moderated_objects), u'approuvée(s)' if approve else u'rejetée(s)'))
+
+    def approve_selected(self, request, queryset):
+        self.moderate_selected(request, queryset, True)
+    approve_selected.short_description = u'Approuver les annonces sélectionnées'
+
+    def reject_selected(self, request, queryset):
+        self.moderate_selected(request, queryset, False)
+    reject_selected.short_description = u'Rejeter les annonces sélectionnées'
 
 
 def get_subclasses(classes, level=0):
@@ -24,4 +72,4 @@ def get_subclasses(classes, level=0):
 
 for mod in get_subclasses(ModeratedAd):
     if mod != ModeratedAd:
-        admin.site.register(mod, ModerationAdmin)
+        admin.site.register(mod, ModeratedAdAdmin)
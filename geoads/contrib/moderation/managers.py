@@ -1,10 +1,11 @@
 #-*- coding: utf-8 -*-
 from moderation.managers import ModerationObjectsManager
-from django.contrib.gis.db.models import GeoManager
+from geoads.models import AdManager
 
 
-class ModeratedAdManager(ModerationObjectsManager, GeoManager):
+class ModeratedAdManager(ModerationObjectsManager, AdManager):
     """
-    Manager for Ad with moderation feature and geo enabled
+    Manager for Ad with moderation feature, geo enabled
+    and AdQuerySet methods
     """
     pass
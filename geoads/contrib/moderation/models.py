@@ -7,5 +7,10 @@ from geoads.models import Ad
 class ModeratedAd(Ad):
     visible = models.BooleanField()
 
+    @classmethod
+    def matchable_queryset(cls):
+        # ads hidden by moderation (pending or rejected) belong to no search
+        return super(ModeratedAd, cls).matchable_queryset().filter(visible=True)
+
     class Meta:
         abstract = True
@@ -1,7 +1,14 @@
 #-*- coding: utf-8 -*-
+import threading
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from moderation.models import MODERATION_STATUS_APPROVED
 from moderation.moderator import GenericModerator
 
-from geoads.events import ad_post_save_handler
+from geoads.cache import invalidate_ad_fragments
+from geoads.events import (ad_post_save_handler, async_batch_post_save_handler,
+                           refresh_potential_buyers_counts, remove_ad_search_results)
 
 from .managers import ModeratedAdManager
 from .signals import moderation_in_progress
@@ -29,5 +36,60 @@ class AdModerator(GenericModerator):
         pass
 
 
+_state = threading.local()
+
+
+def pre_moderation_abstract_handler(sender, instance, status, **kwargs):
+    # remember the status before moderation, see post_moderation_abstract_handler
+    # only the moderation in progress is kept: the status left by a moderation
+    # aborted before post_moderation is dropped
+    _state.previous = {(sender, instance.pk): instance.moderated_object.moderation_status}
+
+
 def post_moderation_abstract_handler(sender, instance, status, **kwargs):
-    ad_post_save_handler(sender, instance)
+    previous = getattr(_state, 'previous', {}).pop((sender, instance.pk), None)
+    invalidate_ad_fragments(instance)
+    if status == previous:
+        # already approved (no pending change) or rejected: nothing to match
+        return
+    batch = getattr(_state, 'batch', None)
+    if batch is not None:
+        batch[status == MODERATION_STATUS_APPROVED][sender].add(instance.pk)
+    elif status == MODERATION_STATUS_APPROVED:
+        ad_post_save_handler(sender, instance)
+    else:
+        # rejected ads are hidden: their results are removed, no matching needed
+        content_type = ContentType.objects.get_for_model(sender)
+        remove_ad_search_results(content_type, [instance.pk])
+        refresh_potential_buyers_counts(content_type, [instance.pk])
+
+
+class batched_matching(object):
+    """
+    Defer the matching of ads moderated in the with block to one batched pass
+    per ad model when it exits, instead of one matching job per ad
+
+        with batched_matching():
+            for moderated_object in moderated_objects:
+                moderated_object.approve(user)
+
+    A nested block adds its ads to the batch of the outer one.
+    """
+    def __enter__(self):
+        self.nested = getattr(_state, 'batch', None) is not None
+        if not self.nested:
+            _state.batch = {True: defaultdict(set), False: defaultdict(set)}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.nested:
+            # matched when the outer block exits
+            return
+        batch = _state.batch
+        del _state.batch
+        for model, pks in batch[False].items():
+            content_type = ContentType.objects.get_for_model(model)
+            remove_ad_search_results(content_type, pks)
+            refresh_potential_buyers_counts(content_type, pks)
+        for model, pks in batch[True].items():
+            async_batch_post_save_handler.delay(ContentType.objects.get_for_model(model).id, sorted(pks))
@@ -1,8 +1,17 @@
 #-*- coding: utf-8 -*-
-from moderation.signals import post_moderation
+from django.db.models.signals import pre_delete, post_delete
+from moderation.signals import pre_moderation, post_moderation
 
-from .moderator import post_moderation_abstract_handler
+from geoads.cache import ad_fragments_invalidation_handler
+from geoads.events import ad_pre_delete_handler
+
+from .moderator import pre_moderation_abstract_handler, post_moderation_abstract_handler
 
 
 def moderated_geoads_register(model_class):
+    pre_moderation.connect(pre_moderation_abstract_handler, dispatch_uid="pre_moderation_abstract_handler")
     post_moderation.connect(post_moderation_abstract_handler, dispatch_uid="post_moderation_abstract_handler")
+    post_delete.connect(ad_fragments_invalidation_handler, sender=model_class,
+                        dispatch_uid="ad_fragments_post_delete_handler")
+    pre_delete.connect(ad_pre_delete_handler, sender=model_class,
+                       dispatch_uid="ad_pre_delete_handler")
@@ -70,3 +70,14 @@ class NewAdToBuyerMessageEmail(BaseMail):
     params = ['user', 'site_name', 'site_url']
 
 factory.register(NewAdToBuyerMessageEmail)
+
+
+class NotificationDigestEmail(BaseMail):
+    """
+    Digest of pending notifications (new ads for searches,
+    new potential buyers) of a user
+    """
+    template_name = 'notification_digest'
+    params = ['user', 'site_name', 'site_url', 'notifications']
+
+factory.register(NotificationDigestEmail)
@@ -0,0 +1,31 @@
+#-*- coding: utf-8 -*-
+"""
+Send notification digests
+
+To be run periodically (cron), for example:
+    0 * * * *  django-admin.py send_notification_digests --frequency=hourly
+    0 8 * * *  django-admin.py send_notification_digests --frequency=daily
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geoads.contrib.notifications.models import FREQUENCY_CHOICES, send_digests
+
+
+class Command(BaseCommand):
+    help = "Send pending notifications, coalesced in one digest per user, " \
+           "to users with the given notification frequency."
+    option_list = BaseCommand.option_list + (
+        make_option('--frequency', dest='frequency', default='hourly',
+                    help='Notification frequency: %s (default: hourly)'
+                         % ', '.join(choice[0] for choice in FREQUENCY_CHOICES)),
+    )
+
+    def handle(self, *args, **options):
+        frequency = options['frequency']
+        if frequency not in dict(FREQUENCY_CHOICES):
+            raise CommandError('Unknown frequency %s' % frequency)
+        sent = send_digests(frequency)
+        if int(options['verbosity']) >= 1:
+            self.stdout.write('%s digests sent.' % sent)
@@ -1,50 +1,226 @@
 #-*- coding: utf-8 -*-
+from django.contrib.auth.models import User
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.core.mail import get_connection
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+
+from geoads import metrics
+from geoads.instrumentation import record_queries
+from geoads.models import AdSearch
+from geoads.settings import GEOADS_NOTIFICATION_FREQUENCY
+from geoads.utils import resolve_content_objects
 
 from .mails import (AdModifiedMessageEmail, AdModeratedMessageEmail,
                     BuyerToVendorMessageEmail, VendorToBuyerMessageEmail,
-                    NewPotentialBuyerToVendorMessageEmail, NewAdToBuyerMessageEmail)
+                    NewPotentialBuyerToVendorMessageEmail, NewAdToBuyerMessageEmail,
+                    NotificationDigestEmail)
+
+def get_default_context():
+    """
+    Context of all mails, read when sending: the sites table
+    doesn't exist yet when this module is first imported by syncdb
+    """
+    site = Site.objects.get_current()
+    return {'site': site, 'site_name': site.name,
+            'site_url': 'http://%s' % (site.domain)}
+
+
+FREQUENCY_CHOICES = (('immediate', u'Immédiatement'),
+                     ('hourly', u'Une fois par heure'),
+                     ('daily', u'Une fois par jour'))
+
+
+class NotificationPreference(models.Model):
+    """
+    Notification preference of a user
+    Users without preference get GEOADS_NOTIFICATION_FREQUENCY
+    """
+    user = models.OneToOneField(User, related_name='geoads_notification_preference')
+    frequency = models.CharField(u"Fréquence des notifications", max_length=10,
+                                 choices=FREQUENCY_CHOICES, default=GEOADS_NOTIFICATION_FREQUENCY)
+
+    class Meta:
+        db_table = 'ads_notificationpreference'
+
+
+class PendingNotification(models.Model):
+    """
+    Notification outbox
+
+    One row per event to notify, coalesced per recipient
+    in digests by send_digests
+    """
+    NEW_AD = 'new_ad'  # to buyer: a new ad corresponds to its search
+    NEW_INTERESTED_USER = 'new_interested_user'  # to vendor: a new search corresponds to its ad
+    KIND_CHOICES = ((NEW_AD, 'New ad for search'),
+                    (NEW_INTERESTED_USER, 'New interested user'))
+
+    recipient = models.ForeignKey(User)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    content_type = models.ForeignKey(ContentType)
+    object_pk = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey(ct_field="content_type",
+                                               fk_field="object_pk")
+    ad_search = models.ForeignKey(AdSearch)
+    create_date = models.DateTimeField(auto_now_add=True)
+    sent_date = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        db_table = 'ads_pendingnotification'
+
+
+def queue_notifications(kind, pairs, recipient_field):
+    """
+    Store (ad, ad_search) pairs in the outbox, with one bulk INSERT,
+    and send digests of recipients who want immediate notifications
+    """
+    if not pairs:
+        return
+    notifications = []
+    for ad, ad_search in pairs:
+        recipient = ad.user if recipient_field == 'vendor' else ad_search.user
+        notifications.append(PendingNotification(
+            recipient=recipient, kind=kind, ad_search=ad_search, object_pk=ad.pk,
+            content_type=ContentType.objects.get_for_model(ad)))
+    PendingNotification.objects.bulk_create(notifications)
+    send_digests('immediate', recipients=set(n.recipient_id for n in notifications))
+
 
-site = Site.objects.get_current()
-default_context = {'site':site, 'site_name': site.name,
-                   'site_url': 'http://%s' % (site.domain)}
+def send_digests(frequency, recipients=None, mail_class=NotificationDigestEmail):
+    """
+    Send one digest per recipient of pending notifications
+    for users with the given notification frequency
+
+    All digests are sent over one SMTP connection, notifications
+    of a recipient are marked as sent as soon as its digest is sent.
+    Return the number of digests sent.
+    """
+    frequency_filter = Q(recipient__geoads_notification_preference__frequency=frequency)
+    if frequency == GEOADS_NOTIFICATION_FREQUENCY:
+        frequency_filter |= Q(recipient__geoads_notification_preference__isnull=True)
+    pending = PendingNotification.objects.filter(frequency_filter, sent_date__isnull=True)\
+        .select_related('recipient').order_by('recipient', 'create_date')
+    if recipients is not None:
+        pending = pending.filter(recipient__in=recipients)
+    digests = []
+    orphans = []
+    for notification in resolve_content_objects(pending):
+        if notification.content_object is None:
+            # ad deleted since the notification was queued
+            orphans.append(notification.id)
+            continue
+        if not digests or digests[-1][0] != notification.recipient:
+            digests.append((notification.recipient, []))
+        digests[-1][1].append(notification)
+    if orphans:
+        PendingNotification.objects.filter(id__in=orphans).delete()
+    if not digests:
+        return 0
+    context = get_default_context()
+    sent = 0
+    connection = get_connection()
+    connection.open()
+    try:
+        for recipient, notifications in digests:
+            message = mail_class(dict(context, **{'to': recipient.email, 'user': recipient,
+                                                  'notifications': notifications}))\
+                .create_email_msg([recipient.email, ])
+            if not connection.send_messages([message]):
+                continue
+            # a failure on a later digest doesn't send this one twice
+            PendingNotification.objects.filter(id__in=[n.id for n in notifications])\
+                .update(sent_date=timezone.now())
+            sent += 1
+    finally:
+        connection.close()
+        metrics.incr('notifications.digests_sent', sent, tags={'frequency': frequency})
+    return sent
+
+
+@record_queries
+def queue_new_relevant_ads_for_searches_callback(sender, pairs, **kwargs):
+    """
+    Digest variant of geoad_new_relevant_ads_for_searches_callback,
+    to connect to geoad_new_relevant_ads_for_searches signal
+    """
+    queue_notifications(PendingNotification.NEW_AD, pairs, 'buyer')
+
+
+@record_queries
+def queue_new_interested_users_callback(sender, pairs, **kwargs):
+    """
+    Digest variant of geoad_new_interested_users_callback,
+    to connect to geoad_new_interested_users signal
+    """
+    queue_notifications(PendingNotification.NEW_INTERESTED_USER, pairs, 'vendor')
 
 
 def geoad_new_interested_user_callback(sender, ad, interested_user, mail_class=NewPotentialBuyerToVendorMessageEmail, **kwargs):
-    context = dict(default_context, **{'to': ad.user.email, 'ad': ad, 'user': interested_user})
-    msg = mail_class(context)
-    msg.send([context['to'], ])
+    send_new_interested_user_mails([(ad, interested_user)], mail_class=mail_class)
 
 
 def geoad_new_relevant_ad_for_search_callback(sender, ad, relevant_search, mail_class=NewAdToBuyerMessageEmail, **kwargs):
-    context = dict(default_context, **{'to': relevant_search.ad_search.user.email,
-                                   'ad': ad, 'user':relevant_search.ad_search.user})
-    msg = mail_class(context)
-    msg.send([context['to'], ])
+    geoad_new_relevant_ads_for_searches_callback(sender, [(ad, relevant_search.ad_search)], mail_class=mail_class)
+
+
+@record_queries
+def geoad_new_interested_users_callback(sender, pairs, mail_class=NewPotentialBuyerToVendorMessageEmail, **kwargs):
+    """
+    Batch variant of geoad_new_interested_user_callback,
+    to connect to geoad_new_interested_users signal
+    """
+    send_new_interested_user_mails([(ad, ad_search.user) for ad, ad_search in pairs], mail_class=mail_class)
+
+
+def send_new_interested_user_mails(pairs, mail_class=NewPotentialBuyerToVendorMessageEmail):
+    """
+    Send a mail to the vendor of each (ad, interested user) pair
+    """
+    for ad, user in pairs:
+        context = dict(get_default_context(), **{'to': ad.user.email, 'ad': ad, 'user': user})
+        msg = mail_class(context)
+        msg.send([context['to'], ])
+
+
+@record_queries
+def geoad_new_relevant_ads_for_searches_callback(sender, pairs, mail_class=NewAdToBuyerMessageEmail, **kwargs):
+    """
+    Batch variant of geoad_new_relevant_ad_for_search_callback,
+    to connect to geoad_new_relevant_ads_for_searches signal
+    """
+    for ad, ad_search in pairs:
+        context = dict(get_default_context(), **{'to': ad_search.user.email,
+                                           'ad': ad, 'user': ad_search.user})
+        msg = mail_class(context)
+        msg.send([context['to'], ])
 
 
 def geoad_user_message_callback(sender, ad, user, message, mail_class=BuyerToVendorMessageEmail, **kwargs):
-    context = dict(default_context, **{'message': message, 'to': ad.user.email,
+    context = dict(get_default_context(), **{'message': message, 'to': ad.user.email,
                                     'from': user.email, 'ad': ad, 'user': user})
     msg = mail_class(context)
     msg.send([context['to'], ])
 
 
 def geoad_vendor_message_callback(sender, ad, ad_search, user, message, mail_class=VendorToBuyerMessageEmail, **kwargs):
-    context = dict(default_context, **{'message': message, 'to': user.email, 'ad_search':ad_search,
+    context = dict(get_default_context(), **{'message': message, 'to': user.email, 'ad_search':ad_search,
                                     'from': ad.user.email, 'ad': ad, 'user': user})
     msg = mail_class(context)
     msg.send([context['to'], ])
 
 
 def ad_post_save_callback(sender, ad, mail_class=AdModifiedMessageEmail, **kwargs):
-    context = dict(default_context, **{'user': ad.user, 'to': ad.user.email, 'ad':ad})
+    context = dict(get_default_context(), **{'user': ad.user, 'to': ad.user.email, 'ad':ad})
     msg = mail_class(context)
     msg.send([context['to'], ])
 
 
 def ad_post_moderation_callback(sender, instance, status, mail_class=AdModeratedMessageEmail, **kwargs):
-    context = dict(default_context, **{'user': instance.user, 'to': instance.user.email,
+    context = dict(get_default_context(), **{'user': instance.user, 'to': instance.user.email,
                                     'ad':instance, 'status': status})
     msg = mail_class(context)
     msg.send([context['to'], ])
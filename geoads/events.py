@@ -7,46 +7,203 @@ Ads app events module
 - events used to bound Ad and AdSearch/AdSearchResult models
 """
 import logging
+import time
+from collections import defaultdict
 
 from django_rq import job
 
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
 from django.http import QueryDict
 from django.contrib.contenttypes.models import ContentType
 
-from .models import AdSearchResult, AdSearch, Ad
+from . import metrics
+from .instrumentation import record_queries
+from .models import AdContact, AdSearchResult, AdSearch, AdSearchDefinition, Ad
+from .predicates import get_predicate
+from .profiling import profile_sampled
+from .settings import GEOADS_MATCHING_QUEUE
+from .utils import resolve_content_objects
 from .signals import (geoad_new_interested_user, geoad_post_save_ended,
-                            geoad_new_relevant_ad_for_search)
+                      geoad_new_relevant_ad_for_search, geoad_new_interested_users,
+                      geoad_new_relevant_ads_for_searches)
 
 
 logger = logging.getLogger(__name__)
 
 
-@job
+def definition_matching_pks(definition, pks=None):
+    """
+    Return the set of ad pks the filterset of a search definition currently selects,
+    among pks when given
+    """
+    query = QueryDict(definition.search)
+    filter = definition.content_type.model_class().filterset()(query or None)
+    queryset = filter.qs.order_by()
+    if pks is not None:
+        queryset = queryset.filter(pk__in=pks)
+    return set(queryset.values_list('pk', flat=True))
+
+
+def sync_ad_search_results(ad_search, matching_pks=None, dry_run=False):
+    """
+    Set-based synchronisation of AdSearchResult rows of ad_search
+
+    Stale rows are removed with one DELETE and new rows are added
+    with one bulk INSERT, so no post_save signal is sent.
+    Return the (added, removed) object pk sets.
+    """
+    if matching_pks is None:
+        matching_pks = definition_matching_pks(get_definition(ad_search))
+    existing_pks = set(AdSearchResult.objects.filter(ad_search=ad_search)
+                       .values_list('object_pk', flat=True))
+    added = matching_pks - existing_pks
+    removed = existing_pks - matching_pks
+    if not dry_run:
+        if removed:
+            stale = AdSearchResult.objects.filter(ad_search=ad_search, object_pk__in=removed)
+            update_unread_counts(removed=stale)
+            stale.delete()
+        if added:
+            AdSearchResult.objects.bulk_create([
+                AdSearchResult(ad_search=ad_search,
+                               content_type_id=ad_search.content_type_id,
+                               object_pk=pk) for pk in added])
+            update_unread_counts(added=[ad_search.id] * len(added))
+        refresh_potential_buyers_counts(ad_search.content_type, added | removed)
+    return added, removed
+
+
+def update_unread_counts(added=(), removed=None):
+    """
+    Maintain AdSearch.unread_count counters
+
+    added holds the AdSearch id of each new result, removed is the
+    AdSearchResult queryset about to be deleted (only its rows created
+    after their search last_seen_date are unread).
+    """
+    deltas = defaultdict(int)
+    for ad_search_id in added:
+        deltas[ad_search_id] += 1
+    if removed is not None:
+        unread = removed.filter(Q(ad_search__last_seen_date__isnull=True) |
+                                Q(create_date__gt=F('ad_search__last_seen_date')))
+        for ad_search_id in unread.values_list('ad_search_id', flat=True):
+            deltas[ad_search_id] -= 1
+    # one UPDATE per distinct delta
+    ad_search_ids = defaultdict(list)
+    for ad_search_id, delta in deltas.items():
+        if delta:
+            ad_search_ids[delta].append(ad_search_id)
+    for delta, ids in ad_search_ids.items():
+        ad_searches = AdSearch.objects.filter(id__in=ids)
+        if delta < 0:
+            # counters can't go below 0 (results created before counters existed)
+            ad_searches.filter(unread_count__lt=-delta).update(unread_count=0)
+            ad_searches = ad_searches.filter(unread_count__gte=-delta)
+        ad_searches.update(unread_count=F('unread_count') + delta)
+
+
+def refresh_potential_buyers_counts(content_type, object_pks):
+    """
+    Recompute denormalized buyers_count and contacted_buyers_count of ads
+
+    Counts come from 2 grouped queries on public search results,
+    and are written with one UPDATE per distinct pair of counts.
+    """
+    object_pks = set(object_pks)
+    if not object_pks:
+        return
+    results = AdSearchResult.objects.filter(content_type=content_type, object_pk__in=object_pks,
+                                            ad_search__public=True).values('object_pk')
+    totals = dict((row['object_pk'], row['total'])
+                  for row in results.annotate(total=Count('id')).order_by())
+    contacted = dict((row['object_pk'], row['total'])
+                     for row in results.filter(contacted=True).annotate(total=Count('id')).order_by())
+    pks = defaultdict(list)
+    for pk in object_pks:
+        pks[(totals.get(pk, 0), contacted.get(pk, 0))].append(pk)
+    ads = content_type.model_class()._base_manager
+    for (total, contacted_total), ad_pks in pks.items():
+        ads.filter(pk__in=ad_pks).update(buyers_count=total, contacted_buyers_count=contacted_total)
+
+
+def get_definition(ad_search):
+    """
+    Return the AdSearchDefinition of ad_search,
+    linking it first for AdSearch saved before definitions existed
+    """
+    if ad_search.definition_id is None:
+        ad_search.definition = AdSearchDefinition.objects.get_for_search(ad_search.content_type,
+                                                                         ad_search.search)
+        AdSearch.objects.filter(id=ad_search.id).update(definition=ad_search.definition)
+    return ad_search.definition
+
+
+def ad_matches_definition(instance, definition):
+    """
+    Test if instance belongs to searches sharing definition
+
+    Use the compiled predicate of definition when there is one,
+    otherwise fall back to a SQL query restricted to instance.
+    """
+    predicate = get_predicate(definition)
+    if predicate is not None:
+        return predicate(instance)
+    query = QueryDict(definition.search)
+    filter = definition.content_type.model_class().filterset()(query or None)
+    return filter.qs.filter(pk=instance.pk).exists()
+
+
+@job(GEOADS_MATCHING_QUEUE)
+@profile_sampled
+@record_queries
 def async_post_save_handler(instance):
     # we must test and do 2 things
     # remove the ad to adsearch it doesn't more belongs to
+    # and add the ad to adsearch it belongs to
+    # Matching is done once per distinct search definition,
+    # and then fanned out to all the AdSearch sharing it.
+    start = time.time()
     ct = ContentType.objects.get_for_model(instance)
-    q1 = AdSearch.objects.filter(adsearchresult__object_pk=instance.pk,
-                                 adsearchresult__content_type=ct)
-    for ad_search in q1:
-        query = QueryDict(ad_search.search)
-        filter = ad_search.content_type.model_class().filterset()(query or None)
-        if instance not in filter.qs:
-            ad_search_result = AdSearchResult.objects.get(ad_search=ad_search, object_pk=instance.pk,
-                                                          content_type=ct)
-            ad_search_result.delete()
-    # add the ad to adsearch it belongs to
-    q2 = AdSearch.objects.exclude(adsearchresult__object_pk=instance.pk,
-                                  adsearchresult__content_type=ct)
-    for ad_search in q2:
-        query = QueryDict(ad_search.search)
-        filter = ad_search.content_type.model_class().filterset()(query or None)
-        if instance in filter.qs:
-            # here we do a get_or_create, in case the add, even modified
-            # is always inside the search
-            adr, created = AdSearchResult.objects.get_or_create(ad_search=ad_search, object_pk=instance.pk,
-                           content_type=ContentType.objects.get_for_model(instance))
-            #logger.info('>>>>>> %s %s' % (adr, created))
+    # an ad out of its model matchable queryset (filterset base queryset)
+    # can't belong to any search
+    indexable = instance.__class__.matchable_queryset().filter(pk=instance.pk).exists()
+    current = set(AdSearchResult.objects.filter(object_pk=instance.pk, content_type=ct)
+                  .values_list('ad_search_id', flat=True))
+    matches = {}
+    ad_searches = AdSearch.objects.filter(content_type=ct)\
+        .select_related('definition', 'definition__content_type')
+    removed = []
+    added = []
+    scanned = 0
+    for ad_search in ad_searches:
+        scanned += 1
+        definition = get_definition(ad_search)
+        if definition.id not in matches:
+            matches[definition.id] = indexable and ad_matches_definition(instance, definition)
+        if ad_search.id in current and not matches[definition.id]:
+            removed.append(ad_search.id)
+        elif matches[definition.id] and ad_search.id not in current:
+            added.append(ad_search)
+    if removed:
+        stale = AdSearchResult.objects.filter(ad_search__in=removed, object_pk=instance.pk,
+                                              content_type=ct)
+        update_unread_counts(removed=stale)
+        stale.delete()
+    created = create_ad_search_results([
+        AdSearchResult(ad_search=ad_search, object_pk=instance.pk, content_type=ct)
+        for ad_search in added])
+    update_unread_counts(added=[result.ad_search_id for result in created])
+    # always refreshed, as the ad save wrote its in-memory counters
+    refresh_potential_buyers_counts(ct, [instance.pk])
+    send_new_results_signals([(instance, result.ad_search) for result in created])
+    tags = {'model': metrics.model_tag(instance), 'queue': GEOADS_MATCHING_QUEUE}
+    metrics.incr('matching.searches_scanned', scanned, tags)
+    metrics.incr('matching.definitions_evaluated', len(matches), tags)
+    metrics.incr('matching.results_added', len(added), tags)
+    metrics.incr('matching.results_removed', len(removed), tags)
+    metrics.timing('matching.ad_post_save', (time.time() - start) * 1000, tags)
     geoad_post_save_ended.send(sender=Ad, ad=instance)
 
 
@@ -54,30 +211,212 @@ def ad_post_save_handler(sender, instance, **kwargs):
     async_post_save_handler.delay(instance)
 
 
+@job(GEOADS_MATCHING_QUEUE)
+@profile_sampled
+@record_queries
+def async_batch_post_save_handler(content_type_id, pks):
+    """
+    Matching pass of several ads of the same model at once (bulk moderation)
+
+    Each search definition is evaluated once for the whole batch, with one
+    query restricted to the batch ads, then results are synchronised
+    with one DELETE and one bulk INSERT.
+    """
+    start = time.time()
+    ct = ContentType.objects.get_for_id(content_type_id)
+    model = ct.model_class()
+    ads = model.matchable_queryset().in_bulk(set(pks))
+    current = dict(((ad_search_id, object_pk), id) for id, ad_search_id, object_pk in
+                   AdSearchResult.objects.filter(content_type=ct, object_pk__in=pks)
+                   .values_list('id', 'ad_search_id', 'object_pk'))
+    matches = {}
+    wanted = set()
+    ad_searches = {}
+    for ad_search in AdSearch.objects.filter(content_type=ct)\
+            .select_related('definition', 'definition__content_type'):
+        definition = get_definition(ad_search)
+        if definition.id not in matches:
+            matches[definition.id] = definition_matching_pks(definition, ads.keys()) if ads else set()
+        wanted.update((ad_search.id, pk) for pk in matches[definition.id])
+        ad_searches[ad_search.id] = ad_search
+    removed = set(current) - wanted
+    if removed:
+        stale = AdSearchResult.objects.filter(id__in=[current[pair] for pair in removed])
+        update_unread_counts(removed=stale)
+        stale.delete()
+    created = create_ad_search_results([
+        AdSearchResult(ad_search=ad_searches[ad_search_id], object_pk=pk, content_type=ct)
+        for ad_search_id, pk in sorted(wanted - set(current))])
+    update_unread_counts(added=[result.ad_search_id for result in created])
+    refresh_potential_buyers_counts(ct, pks)
+    send_new_results_signals([(ads[result.object_pk], result.ad_search) for result in created])
+    tags = {'model': metrics.model_tag(model), 'queue': GEOADS_MATCHING_QUEUE}
+    metrics.incr('matching.searches_scanned', len(ad_searches), tags)
+    metrics.incr('matching.definitions_evaluated', len(matches), tags)
+    metrics.incr('matching.results_added', len(created), tags)
+    metrics.incr('matching.results_removed', len(removed), tags)
+    metrics.timing('matching.batch_post_save', (time.time() - start) * 1000, tags)
+    for ad in ads.values():
+        geoad_post_save_ended.send(sender=Ad, ad=ad)
+
+
+def remove_ad_search_results(content_type, object_pks):
+    """
+    Set-based removal of the search results of ads (deleted or hidden ads)
+    """
+    results = AdSearchResult.objects.filter(content_type=content_type, object_pk__in=object_pks)
+    update_unread_counts(removed=results)
+    results.delete()
+
+
+@record_queries
+def ad_pre_delete_handler(sender, instance, **kwargs):
+    # results and contacts of a deleted ad are removed with set-based deletes
+    # (pictures are removed with their generic relation)
+    # only hard deletes get here, soft deleted ads keep their contacts; a hard
+    # deleted ad's contacts have no content_object anymore and would be
+    # removed by the reaper anyway
+    ct = ContentType.objects.get_for_model(instance)
+    remove_ad_search_results(ct, [instance.pk])
+    AdContact.objects.filter(content_type=ct, object_pk=instance.pk).delete()
+
+
+@record_queries
 def ad_search_post_save_handler(sender, instance, created, **kwargs):
     # this should be optimized if search field is modified !
     # if it's only other conf file, we should'nt test for new/remove ads
-    q = QueryDict(instance.search)
-    filter = instance.content_type.model_class().filterset()(q or None)
+    start = time.time()
+    definition = get_definition(instance)
+    # identical searches are evaluated once: when another AdSearch
+    # shares the definition, its results are reused
+    sibling = AdSearch.objects.filter(definition=definition).exclude(id=instance.id)[:1]
+    if sibling:
+        matching_pks = set(AdSearchResult.objects.filter(ad_search=sibling[0])
+                           .values_list('object_pk', flat=True))
+    else:
+        matching_pks = definition_matching_pks(definition)
+    existing_pks = set(AdSearchResult.objects.filter(ad_search=instance)
+                       .values_list('object_pk', flat=True))
     # here we remove ads that no more belongs to AdSearch
-    ads = AdSearchResult.objects.filter(ad_search=instance)
-    for ad in ads:
-        if ad.content_object not in filter.qs:
-            ad.delete()
+    if existing_pks - matching_pks:
+        stale = AdSearchResult.objects.filter(ad_search=instance,
+                                              object_pk__in=existing_pks - matching_pks)
+        update_unread_counts(removed=stale)
+        stale.delete()
     # here we save search AdSearchResult instances
     # so we add an Ad if it belongs to AdSearch
-    for ad in filter.qs:
-        ad_search_result, created = AdSearchResult.objects.get_or_create(
-            ad_search=instance,
-            content_type=instance.content_type,
-            object_pk=ad.id)
-        # this below shoud help in case, ad_search change from not public to public
-        # and we want to inform vendor that someone is interested in its ad
-        #ad_search_result.save()
+    added_pks = matching_pks - existing_pks
+    if added_pks:
+        created = create_ad_search_results([
+            AdSearchResult(ad_search=instance, content_type=instance.content_type, object_pk=pk)
+            for pk in sorted(added_pks)])
+        update_unread_counts(added=[instance.id] * len(created))
+        send_new_results_signals([(result.content_object, instance)
+                                  for result in resolve_content_objects(created)
+                                  if result.content_object is not None])
+    # public flag may have changed, so all the search ads are refreshed
+    refresh_potential_buyers_counts(instance.content_type, matching_pks | existing_pks)
+    tags = {'model': metrics.model_tag(instance.content_type.model_class())}
+    metrics.incr('materialization.results_added', len(added_pks), tags)
+    metrics.incr('materialization.results_removed', len(existing_pks - matching_pks), tags)
+    metrics.timing('materialization.ad_search_post_save', (time.time() - start) * 1000, tags)
+
 
+def ad_search_pre_delete_handler(sender, instance, **kwargs):
+    # remember ads of the search, their counters are refreshed once it's deleted
+    instance._result_pks = list(AdSearchResult.objects.filter(ad_search=instance)
+                                .values_list('object_pk', flat=True))
 
+
+def ad_search_post_delete_handler(sender, instance, **kwargs):
+    refresh_potential_buyers_counts(ContentType.objects.get_for_id(instance.content_type_id),
+                                    getattr(instance, '_result_pks', ()))
+
+
+@record_queries
 def ad_search_result_post_save_handler(sender, instance, created, **kwargs):
+    # AdSearchResult created one by one (not by a matching pass),
+    # or updated (contacted buyer)
     if created:
-        geoad_new_relevant_ad_for_search.send(sender=Ad, ad=instance.content_object, relevant_search=instance)
-        if instance.ad_search.public:
-            geoad_new_interested_user.send(sender=Ad, ad=instance.content_object, interested_user=instance.ad_search.user)
+        update_unread_counts(added=[instance.ad_search_id])
+        send_new_results_signals([(instance.content_object, instance.ad_search)])
+    refresh_potential_buyers_counts(ContentType.objects.get_for_id(instance.content_type_id),
+                                    [instance.object_pk])
+
+
+def create_ad_search_results(results):
+    """
+    Insert new AdSearchResult instances with one bulk INSERT
+
+    If some of them were concurrently inserted, fall back to
+    get_or_create; rows created this way are notified by
+    ad_search_result_post_save_handler.
+    Return the results created by the bulk INSERT.
+    """
+    if not results:
+        return []
+    if transaction.is_managed():
+        return _insert_ad_search_results(results)
+    # bulk_create commits by itself outside of a managed block, which
+    # releases the savepoint and hides IntegrityError behind a
+    # TransactionManagementError
+    with transaction.commit_on_success():
+        return _insert_ad_search_results(results)
+
+
+def _insert_ad_search_results(results):
+    sid = transaction.savepoint()
+    try:
+        AdSearchResult.objects.bulk_create(results)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        for result in results:
+            AdSearchResult.objects.get_or_create(ad_search=result.ad_search,
+                                                 content_type_id=result.content_type_id,
+                                                 object_pk=result.object_pk)
+        return []
+    transaction.savepoint_commit(sid)
+    return results
+
+
+def send_new_results_signals(pairs):
+    """
+    Send batch signals for the new (ad, ad_search) pairs of a matching pass
+    """
+    if not pairs:
+        return
+    geoad_new_relevant_ads_for_searches.send(sender=Ad, pairs=pairs)
+    public_pairs = [(ad, ad_search) for ad, ad_search in pairs if ad_search.public]
+    if public_pairs:
+        geoad_new_interested_users.send(sender=Ad, pairs=public_pairs)
+
+
+def new_relevant_ads_for_searches_handler(sender, pairs, **kwargs):
+    # per pair geoad_new_relevant_ad_for_search, kept for existing receivers
+    if not geoad_new_relevant_ad_for_search.receivers:
+        return
+    # saved results of the pairs, one query per ad model
+    pks = defaultdict(lambda: (set(), set()))
+    for ad, ad_search in pairs:
+        pks[ad_search.content_type_id][0].add(ad_search.id)
+        pks[ad_search.content_type_id][1].add(ad.pk)
+    results = {}
+    for content_type_id, (ad_search_ids, object_pks) in pks.items():
+        for result in AdSearchResult.objects.filter(content_type=content_type_id, ad_search__in=ad_search_ids,
+                                                    object_pk__in=object_pks):
+            results[(result.ad_search_id, result.object_pk)] = result
+    for ad, ad_search in pairs:
+        relevant_search = results.get((ad_search.id, ad.pk))
+        if relevant_search is None:
+            # removed since by a concurrent matching pass
+            continue
+        relevant_search.ad_search = ad_search
+        geoad_new_relevant_ad_for_search.send(sender=sender, ad=ad, relevant_search=relevant_search)
+
+
+def new_interested_users_handler(sender, pairs, **kwargs):
+    # per pair geoad_new_interested_user, kept for existing receivers
+    if not geoad_new_interested_user.receivers:
+        return
+    for ad, ad_search in pairs:
+        geoad_new_interested_user.send(sender=sender, ad=ad, interested_user=ad_search.user)
@@ -7,6 +7,9 @@ from django.contrib.gis.geos import fromstr
 from django_filters.filters import Filter
 
 from django import forms
+from django.db import connection
+
+from geoads.settings import GEOADS_FULL_TEXT_CONFIG
 
 
 class LocationFilter(Filter):
@@ -34,3 +37,23 @@ class BooleanForNumberFilter(Filter):
         if value is None:
             return qs
         return qs.filter(**{'%s__isnull' % (self.name): not(value)})
+
+
+class FullTextFilter(Filter):
+    """
+    Full-text filter
+    Used for keyword search on the ad search_vector column (see geoads.indexes),
+    ads are annotated with their search_rank, usable as filterset ordering
+    """
+    field_class = forms.CharField
+
+    def filter(self, qs, value):
+        if not value:
+            return qs
+        qn = connection.ops.quote_name
+        vector = '%s.%s' % (qn(qs.model._meta.db_table), qn('search_vector'))
+        query = 'plainto_tsquery(%s::regconfig, %s)'
+        return qs.extra(select={'search_rank': 'ts_rank(%s, %s)' % (vector, query)},
+                        select_params=(GEOADS_FULL_TEXT_CONFIG, value),
+                        where=['%s @@ %s' % (vector, query)],
+                        params=(GEOADS_FULL_TEXT_CONFIG, value))
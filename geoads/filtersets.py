@@ -4,12 +4,90 @@ Ads app filtersets module
 
 This module provides default filterset 'AdFilterSet' to work with Ad models.
 """
+import hashlib
+import time
+from urllib import urlencode
+
+from django import forms
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.db import models
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.constants import LOOKUP_SEP
 
 import django_filters
 
-from geoads.models import Ad
-from geoads.filters import LocationFilter
+from geoads import metrics
+from geoads.cache import ad_model_version
+from geoads.models import Ad, SlowFilterQuery
+from geoads.settings import GEOADS_SLOW_FILTER_QUERY_THRESHOLD, GEOADS_FACETS_CACHE_TIMEOUT
+from geoads.filters import BooleanForNumberFilter, FullTextFilter, LocationFilter
+from geoads.utils import normalize_search
+
+
+class TimedQuerySetMixin(object):
+    """
+    QuerySet mixin reporting the duration of its queries,
+    and of the queries of its clones, to its filterset
+    """
+    _filterset = None
+
+    def _clone(self, klass=None, *args, **kwargs):
+        if klass is not None and not issubclass(klass, (TimedQuerySetMixin, EmptyQuerySet)):
+            # values(), values_list() and dates() clones are timed too
+            klass = timed_queryset_class(klass)
+        clone = super(TimedQuerySetMixin, self)._clone(klass, *args, **kwargs)
+        clone._filterset = self._filterset
+        return clone
+
+    def _timed(self, method, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._filterset.query_done(self, time.time() - start)
+
+    def iterator(self):
+        # only the time spent fetching rows, not the caller's
+        rows = super(TimedQuerySetMixin, self).iterator()
+        duration = 0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                finally:
+                    duration += time.time() - start
+                yield row
+        finally:
+            # reported as well when the rows are not all consumed, or on errors
+            self._filterset.query_done(self, duration)
+
+    def count(self):
+        if self._result_cache is not None and not self._iter:
+            return super(TimedQuerySetMixin, self).count()
+        return self._timed(super(TimedQuerySetMixin, self).count)
+
+    def exists(self):
+        if self._result_cache is not None:
+            return super(TimedQuerySetMixin, self).exists()
+        return self._timed(super(TimedQuerySetMixin, self).exists)
+
+
+_timed_queryset_classes = {}
+
+
+def timed_queryset_class(klass):
+    """
+    Return the TimedQuerySetMixin subclass of queryset class klass
+    """
+    if klass not in _timed_queryset_classes:
+        _timed_queryset_classes[klass] = type('Timed%s' % klass.__name__, (TimedQuerySetMixin, klass), {})
+    return _timed_queryset_classes[klass]
 
 
 class AdFilterSet(django_filters.FilterSet):
@@ -23,11 +101,144 @@ class AdFilterSet(django_filters.FilterSet):
         }
     }
 
+    # names of the filters with value counts, see facet_counts
+    facets = ()
+
+    def __init__(self, data=None, queryset=None, *args, **kwargs):
+        if queryset is None:
+            queryset = self._meta.model.matchable_queryset()
+        super(AdFilterSet, self).__init__(data, queryset, *args, **kwargs)
+
+    def get_order_by(self, order_choice):
+        if order_choice.lstrip('-') == 'search_rank':
+            # ranked by the full-text filters in use, base queryset
+            # ordering without them (search_rank can be the default choice)
+            if not any(isinstance(filter_, FullTextFilter) and self.form[name].data
+                       for name, filter_ in self.filters.items()):
+                return list(self.queryset.query.order_by or self._meta.model._meta.ordering)
+            return ['-search_rank']
+        return super(AdFilterSet, self).get_order_by(order_choice)
+
+    @property
+    def qs(self):
+        qs = super(AdFilterSet, self).qs
+        if not isinstance(qs, (TimedQuerySetMixin, EmptyQuerySet)):
+            # queries of qs, its slices and counts are timed
+            qs.__class__ = timed_queryset_class(qs.__class__)
+            qs._filterset = self
+        return qs
+
+    def query_done(self, queryset, duration):
+        """
+        Called with the duration (seconds) of each query of qs,
+        record it in the slow queries log when slow
+        """
+        duration *= 1000
+        metrics.timing('filterset.evaluate', duration, tags={'model': metrics.model_tag(self._meta.model)})
+        if GEOADS_SLOW_FILTER_QUERY_THRESHOLD is not None and duration >= GEOADS_SLOW_FILTER_QUERY_THRESHOLD:
+            SlowFilterQuery.objects.record(self, queryset, duration)
+
     def __len__(self):
         return len(self.qs)
 
     def __getitem__(self, key):
         return self.qs[key]
 
+    def get_search(self):
+        """
+        Return the normalized querystring of the filterset data
+        """
+        data = self.data or {}
+        return normalize_search(data.urlencode() if hasattr(data, 'urlencode') else urlencode(data, True))
+
+    def facet_counts(self):
+        """
+        Return {facet: [(value, count), ...]} for the filters named in facets,
+        counts of a facet being computed under all the other filters
+
+        All facets are counted with one UNION ALL of grouped aggregates,
+        cached until an ad of the model is written.
+        """
+        if not self.facets:
+            return {}
+        key = 'geoads:facets:%s:%s:%s' % (
+            ContentType.objects.get_for_model(self._meta.model).id, ad_model_version(self._meta.model),
+            hashlib.sha1(('%s:%s' % (','.join(self.facets), self.get_search())).encode('utf-8')).hexdigest())
+        counts = cache.get(key)
+        if counts is None:
+            with metrics.timer('filterset.facets', tags={'model': metrics.model_tag(self._meta.model)}):
+                counts = self._count_facets()
+            cache.set(key, counts, GEOADS_FACETS_CACHE_TIMEOUT)
+        return counts
+
+    def _facet_queryset(self, facet):
+        """
+        Return the queryset filtered by all filters but facet, the way qs does
+        (in strict mode, invalid data selects nothing)
+        """
+        valid = self.is_bound and self.form.is_valid()
+        if self.strict and self.is_bound and not valid:
+            return self.queryset.none()
+        qs = self.queryset.all()
+        for name, filter_ in self.filters.items():
+            if name == facet:
+                continue
+            value = None
+            if valid:
+                value = self.form.cleaned_data[name]
+            else:
+                try:
+                    value = self.form.fields[name].clean(self.form[name].value())
+                except forms.ValidationError:
+                    if self.strict:
+                        return self.queryset.none()
+            if value is not None:
+                qs = filter_.filter(qs, value)
+        return qs
+
+    def _count_facets(self):
+        qn = connection.ops.quote_name
+        parts = []
+        params = []
+        fields = {}
+        for facet in self.facets:
+            filter_ = self.filters[facet]
+            if LOOKUP_SEP in filter_.name:
+                raise ImproperlyConfigured("Facet %s of %s filters on a related field (%s), "
+                                           "only fields of the ad model can be counted"
+                                           % (facet, self.__class__.__name__, filter_.name))
+            queryset = self._facet_queryset(facet)
+            if isinstance(queryset, EmptyQuerySet):
+                continue
+            field = self._meta.model._meta.get_field(filter_.name)
+            column = '%s.%s' % (qn(self._meta.model._meta.db_table), qn(field.column))
+            if isinstance(filter_, BooleanForNumberFilter):
+                value = 'CAST(%s IS NOT NULL AS varchar)' % column
+            else:
+                value = 'CAST(%s AS varchar)' % column
+            fields[facet] = (filter_, field)
+            sql, facet_params = queryset.order_by()\
+                .extra(select={'facet_value': value}).values('facet_value').query.sql_with_params()
+            parts.append('SELECT %%s, facet_value, COUNT(*) FROM (%s) AS %s GROUP BY facet_value'
+                         % (sql, qn('facet_%s' % len(parts))))
+            params.append(facet)
+            params.extend(facet_params)
+        counts = dict((facet, []) for facet in self.facets)
+        if not parts:
+            return counts
+        cursor = connection.cursor()
+        cursor.execute(' UNION ALL '.join(parts), params)
+        for facet, value, count in cursor.fetchall():
+            filter_, field = fields[facet]
+            if isinstance(filter_, BooleanForNumberFilter) or isinstance(field, models.BooleanField):
+                value = None if value is None else value == 'true'
+            elif value is not None:
+                value = field.to_python(value)
+            counts[facet].append((value, count))
+        for values in counts.values():
+            # most frequent values first, then by value
+            values.sort(key=lambda item: (-item[1], item[0]))
+        return counts
+
     class Meta:
         model = Ad  # this must be set by the children class
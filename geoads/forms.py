@@ -5,10 +5,9 @@ Ads app forms module
 This module provides default forms to work with Ad, AdContact, AdSearch forms.
 """
 from django import forms
-from django.http import QueryDict
 
 from geoads.models import AdPicture, AdContact, AdSearch, AdSearchResult, Ad
-from geoads.utils import geocode
+from geoads.utils import geocode, normalize_search
 
 
 class AdPictureForm(forms.ModelForm):
@@ -37,14 +36,10 @@ class AdSearchForm(forms.ModelForm):
 
     def clean_search(self):
         # Remove all empty elements of search field
-        # Django `QueryDict` uses keep_blank_values=True
-        # in parse_qsl that keeps empty values as [u'']
-        # which is not in our use case
-        # Below, we remove these values, and only keep setted ones.
+        # and put it in its canonical form (see normalize_search)
+        # so that identical searches share the same definition
         data = self.cleaned_data['search']
-        q = QueryDict(data, mutable=True)
-        [q.pop(elt[0]) for elt in q.lists() if elt[1] == [u'']]
-        return q.urlencode()
+        return normalize_search(data)
 
     class Meta:
         model = AdSearch
@@ -0,0 +1,149 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app index pack
+
+Composite, partial and GiST indexes matching geoads hot lookups,
+that Django can't declare on models (or only for new tables).
+They are created after syncdb, and on existing databases with
+the create_geoads_indexes management command (PostgreSQL only).
+
+Ad tables also get the full-text search_vector column (see
+geoads.filters.FullTextFilter), a GIN index on it, and a trigger keeping
+it up to date from the model full_text_fields. To change these fields,
+drop the <table>_search_vector_update trigger and run the command again.
+"""
+from django.db import connection, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import get_models
+
+from geoads.models import Ad, AdContact, AdPicture, AdSearch, AdSearchResult
+from geoads.settings import GEOADS_FULL_TEXT_CONFIG, GEOADS_FULL_TEXT_BACKFILL_BATCH
+
+
+SEARCH_VECTOR = 'search_vector'
+
+
+def index_name(table, suffix):
+    return truncate_name('%s_%s' % (table, suffix), connection.ops.max_name_length())
+
+
+def get_ad_models():
+    """
+    Return the concrete ad models, with a table
+    """
+    return [model for model in get_models()
+            if issubclass(model, Ad) and not model._meta.proxy and model._meta.managed]
+
+
+def get_index_statements():
+    """
+    Return the (table, index name, CREATE INDEX statement) list of the index pack
+    """
+    qn = connection.ops.quote_name
+    statements = []
+
+    def add(model, suffix, columns, where=None, using=None):
+        table = model._meta.db_table
+        name = index_name(table, suffix)
+        sql = 'CREATE INDEX %s ON %s%s (%s)' % (qn(name), qn(table), ' USING %s' % using if using else '',
+                                               ', '.join(qn(column) for column in columns))
+        if where:
+            sql += ' WHERE %s' % where
+        statements.append((table, name, sql))
+
+    # results of an ad (matching pass, potential buyers, counters)
+    add(AdSearchResult, 'ct_object_pk', ('content_type_id', 'object_pk'))
+    # contacted/not contacted buyers of a search
+    add(AdSearchResult, 'ad_search_contacted', ('ad_search_id', 'contacted'))
+    # searches of an ad model, public ones (matching pass, public_adsearch)
+    add(AdSearch, 'ct_public', ('content_type_id', 'public'))
+    # admin changelist filtered on public only, newest first
+    add(AdSearch, 'public_id', ('public', 'id'))
+    # generic references to an ad
+    add(AdContact, 'ct_object_pk', ('content_type_id', 'object_pk'))
+    add(AdPicture, 'ct_object_id', ('content_type_id', 'object_id'))
+    for model in get_ad_models():
+        # live (not soft deleted) ads, newest first and ads version (conditional GET)
+        add(model, 'live_update_date', ('update_date',), where='%s IS NULL' % qn('delete_date'))
+        # same name as GeoDjango spatial index, so that it's only created if missing
+        location = model._meta.get_field('location')
+        add(model, '%s_id' % location.column, (location.column,), using='GIST')
+        # full-text search, see create_search_vectors
+        add(model, SEARCH_VECTOR, (SEARCH_VECTOR,), using='GIN')
+    return statements
+
+
+def create_search_vectors(cursor, tables):
+    """
+    Add the search_vector column of ad tables, with the trigger maintaining it,
+    and fill it for existing rows. Return the names of created triggers.
+    """
+    qn = connection.ops.quote_name
+    cursor.execute('SELECT tgname FROM pg_trigger')
+    triggers = set(row[0] for row in cursor.fetchall())
+    # the trigger needs a schema-qualified configuration
+    config = GEOADS_FULL_TEXT_CONFIG if '.' in GEOADS_FULL_TEXT_CONFIG else 'pg_catalog.%s' % GEOADS_FULL_TEXT_CONFIG
+    created = []
+    for model in get_ad_models():
+        table = model._meta.db_table
+        name = index_name(table, 'search_vector_update')
+        if table not in tables or name in triggers:
+            continue
+        columns = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+        if SEARCH_VECTOR not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s tsvector' % (qn(table), qn(SEARCH_VECTOR)))
+        cursor.execute('CREATE TRIGGER %s BEFORE INSERT OR UPDATE ON %s FOR EACH ROW '
+                       'EXECUTE PROCEDURE tsvector_update_trigger(%s, %s, %s)'
+                       % (qn(name), qn(table), SEARCH_VECTOR, config,
+                          ', '.join(model._meta.get_field(field).column for field in model.full_text_fields)))
+        created.append(name)
+        backfill_search_vectors(cursor, model)
+    return created
+
+
+def backfill_search_vectors(cursor, model):
+    """
+    Fill the search_vector column of existing rows, by firing the trigger
+    on GEOADS_FULL_TEXT_BACKFILL_BATCH rows per UPDATE
+
+    Each UPDATE rewrites its rows: outside of a managed transaction every
+    batch is committed, so that row locks are held one batch at a time and
+    dead row versions can be vacuumed while the backfill goes on.
+    """
+    qn = connection.ops.quote_name
+    table, pk = qn(model._meta.db_table), qn(model._meta.pk.column)
+    cursor.execute('SELECT MIN(%s), MAX(%s) FROM %s' % (pk, pk, table))
+    low, high = cursor.fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, GEOADS_FULL_TEXT_BACKFILL_BATCH):
+        cursor.execute('UPDATE %s SET %s = %s WHERE %s >= %%s AND %s < %%s' % (table, pk, pk, pk, pk),
+                       [start, start + GEOADS_FULL_TEXT_BACKFILL_BATCH])
+        transaction.commit_unless_managed()
+
+
+def create_indexes():
+    """
+    Create the missing indexes of the pack (and search vectors), on existing tables
+    Return the names of created indexes and triggers.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+    cursor = connection.cursor()
+    tables = set(connection.introspection.table_names())
+    cursor.execute('SELECT indexname FROM pg_indexes')
+    existing = set(row[0] for row in cursor.fetchall())
+    # the GIN index needs the search_vector column
+    created = create_search_vectors(cursor, tables)
+    for table, name, sql in get_index_statements():
+        if table in tables and name not in existing:
+            cursor.execute(sql)
+            created.append(name)
+    if created:
+        transaction.commit_unless_managed()
+    return created
+
+
+def create_indexes_handler(sender, **kwargs):
+    # post_syncdb is sent once per app, when tables of all apps exist
+    create_indexes()
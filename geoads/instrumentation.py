@@ -0,0 +1,146 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app query instrumentation module
+
+Record SQL queries issued by a block of code (a view dispatch, an event
+handler), grouped by normalized SQL, so that the same query shape
+repeated many times (likely N+1) is flagged.
+
+- QueryRecorder: context manager recording queries of the default connection
+- record_queries: decorator logging queries of event handlers,
+  when GEOADS_QUERY_INSTRUMENTATION is enabled
+- query_budget: test helper asserting a path stays within its query budget
+- explain: query plan of a queryset
+"""
+import functools
+import logging
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+from geoads.settings import GEOADS_QUERY_INSTRUMENTATION, GEOADS_QUERY_DUPLICATES_THRESHOLD
+
+
+logger = logging.getLogger('geoads.queries')
+
+_NORMALIZE = ((re.compile(r"'(?:[^']|'')*'"), '?'),  # strings
+              (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),  # numbers
+              (re.compile(r'%s'), '?'),  # placeholders of queries not yet run
+              (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),  # IN lists
+              (re.compile(r'\s+'), ' '))
+
+
+def normalize_sql(sql):
+    """
+    Return the shape of a SQL query: literals and IN lists replaced by placeholders
+    """
+    for pattern, replacement in _NORMALIZE:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def explain(queryset):
+    """
+    Return the query plan of a queryset, without running it (PostgreSQL only)
+    """
+    if connection.vendor != 'postgresql':
+        return ''
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN (ANALYZE false) ' + sql, params)
+    return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+class QueryRecorder(object):
+    """
+    Record queries executed on the default connection inside a with block
+    """
+    def __init__(self):
+        self.queries = []
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queries = connection.queries[self.start:]
+        connection.use_debug_cursor = self.use_debug_cursor
+        if not self.use_debug_cursor and not settings.DEBUG:
+            # outermost recorder outside of DEBUG: don't let queries pile up
+            del connection.queries[self.start:]
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def shapes(self):
+        """
+        Return {normalized sql: number of queries}
+        """
+        shapes = defaultdict(int)
+        for query in self.queries:
+            shapes[normalize_sql(query['sql'])] += 1
+        return shapes
+
+    def duplicates(self, threshold=GEOADS_QUERY_DUPLICATES_THRESHOLD):
+        """
+        Return {normalized sql: number of queries} of shapes
+        issued at least threshold times (likely N+1)
+        """
+        return dict((sql, count) for sql, count in self.shapes().items() if count >= threshold)
+
+    def summary(self, name):
+        duplicates = self.duplicates()
+        lines = ['%s: %s queries, %s repeated shapes' % (name, self.count, len(duplicates))]
+        for sql, count in sorted(duplicates.items(), key=lambda item: -item[1]):
+            lines.append('  %sx %s' % (count, sql))
+        return '\n'.join(lines)
+
+
+def record_queries(func):
+    """
+    Log queries of an event handler, when GEOADS_QUERY_INSTRUMENTATION is enabled
+    """
+    name = '%s.%s' % (func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not GEOADS_QUERY_INSTRUMENTATION:
+            return func(*args, **kwargs)
+        with QueryRecorder() as recorder:
+            result = func(*args, **kwargs)
+        if recorder.duplicates():
+            logger.warning(recorder.summary(name))
+        else:
+            logger.debug(recorder.summary(name))
+        return result
+    return wrapper
+
+
+class query_budget(QueryRecorder):
+    """
+    Test helper: fail if the with block issues more than max_queries queries,
+    or repeats a query shape at least max_repeat times
+
+        with query_budget(5):
+            view(request)
+    """
+    def __init__(self, max_queries, max_repeat=None):
+        super(query_budget, self).__init__()
+        self.max_queries = max_queries
+        self.max_repeat = max_repeat
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(query_budget, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return
+        if self.count > self.max_queries:
+            raise AssertionError('%s queries issued, budget is %s\n%s'
+                                 % (self.count, self.max_queries, self.summary('budget')))
+        if self.max_repeat is not None and self.duplicates(self.max_repeat):
+            raise AssertionError('Query shapes repeated %s times or more (N+1)\n%s'
+                                 % (self.max_repeat, self.summary('budget')))
@@ -0,0 +1,148 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app mail module
+
+Deliver mails out of the request path:
+- AsyncEmailBackend enqueues messages to rq, set
+  EMAIL_BACKEND = 'geoads.mail.AsyncEmailBackend' to use it
+  (messages are then delivered with GEOADS_EMAIL_BACKEND)
+- deliver_messages job sends them in batches over a connection
+  opened for the job, and retries on failure with an increasing delay
+- report_invalid_form aggregates invalid form reports per time window,
+  in a cache shared by the web processes and the workers
+"""
+import logging
+import time
+
+from django_rq import job
+
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.utils.translation import ugettext as _
+
+from geoads import metrics
+from geoads.settings import (GEOADS_EMAIL_BACKEND, GEOADS_MAIL_QUEUE, GEOADS_MAIL_MAX_RETRIES,
+                             GEOADS_MAIL_RETRY_DELAY, GEOADS_REPORT_EMAIL,
+                             GEOADS_INVALID_FORM_REPORT_WINDOW)
+
+
+logger = logging.getLogger(__name__)
+
+
+if isinstance(cache, (LocMemCache, DummyCache)):
+    # reports stored by a web process are not seen by the worker flushing them
+    logger.warning('Invalid form reports need a cache shared between processes, '
+                   '%s is process local' % cache.__class__.__name__)
+
+
+@job(GEOADS_MAIL_QUEUE)
+def deliver_messages(messages, attempt=0):
+    """
+    Send messages over a connection opened for this job
+
+    On failure, the messages not yet sent are enqueued again, up to
+    GEOADS_MAIL_MAX_RETRIES times. rq has no delayed jobs, so a retry
+    waits GEOADS_MAIL_RETRY_DELAY * 2 ** (attempt - 1) seconds in the worker
+    before sending.
+    """
+    if attempt:
+        time.sleep(GEOADS_MAIL_RETRY_DELAY * 2 ** (attempt - 1))
+    # a new connection per job, a connection kept by the worker may have been
+    # dropped by the server since the last job
+    connection = get_connection(backend=GEOADS_EMAIL_BACKEND)
+    tags = {'queue': GEOADS_MAIL_QUEUE}
+    try:
+        for index, message in enumerate(messages):
+            message.connection = None
+            try:
+                # connection is opened once, send_messages doesn't close it then
+                connection.open()
+                with metrics.timer('mail.send', tags=tags):
+                    connection.send_messages([message])
+                metrics.incr('mail.sent', tags=tags)
+            except Exception:
+                metrics.incr('mail.failures', tags=tags)
+                if attempt >= GEOADS_MAIL_MAX_RETRIES:
+                    logger.exception('Mail delivery failed after %s retries' % attempt)
+                    raise
+                logger.warning('Mail delivery failed, retrying %s messages' % (len(messages) - index))
+                deliver_messages.delay(messages[index:], attempt + 1)
+                return index
+        return len(messages)
+    finally:
+        connection.close()
+
+
+class AsyncEmailBackend(BaseEmailBackend):
+    """
+    Email backend enqueuing messages to be delivered by a rq worker
+    """
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        messages = list(email_messages)
+        for message in messages:
+            message.connection = None
+        deliver_messages.delay(messages)
+        return len(messages)
+
+
+def _report_keys(window):
+    key = 'geoads:invalid_form_reports:%s' % window
+    return key, ['%s:%s' % (key, index) for index in range(1, (cache.get(key) or 0) + 1)]
+
+
+def report_invalid_form(user, form):
+    """
+    Store a report of an invalid form, to be sent to GEOADS_REPORT_EMAIL
+    with all the other reports of the same time window
+
+    The first report of a window triggers the delivery of the previous window.
+    When the cache can't keep the report, it is sent on its own.
+    """
+    report = u"%s\n%s" % (user.email, form.errors.as_text())
+    if isinstance(cache, DummyCache):
+        _send_reports([report])
+        return
+    window = int(time.time()) // GEOADS_INVALID_FORM_REPORT_WINDOW
+    key = 'geoads:invalid_form_reports:%s' % window
+    timeout = GEOADS_INVALID_FORM_REPORT_WINDOW * 3
+    if cache.add(key, 0, timeout):
+        flush_invalid_form_reports.delay(window - 1)
+    try:
+        try:
+            index = cache.incr(key)
+        except ValueError:
+            # counter evicted from the cache since it was added
+            cache.add(key, 0, timeout)
+            index = cache.incr(key)
+    except ValueError:
+        logger.warning('Invalid form report not aggregated, counter %s not kept by the cache' % key)
+        _send_reports([report])
+        return
+    cache.set('%s:%s' % (key, index), report, timeout)
+
+
+def _send_reports(reports):
+    # sent with EMAIL_BACKEND, enqueued when it is AsyncEmailBackend
+    EmailMessage(_(u"[%s] %s invalid forms while creating an ad")
+                 % (Site.objects.get_current().name, len(reports)),
+                 u"\n\n".join(reports), GEOADS_REPORT_EMAIL, [GEOADS_REPORT_EMAIL]).send(fail_silently=True)
+
+
+@job(GEOADS_MAIL_QUEUE)
+def flush_invalid_form_reports(window):
+    """
+    Send the invalid form reports of a time window in one mail
+    """
+    key, report_keys = _report_keys(window)
+    reports = cache.get_many(report_keys)
+    cache.delete_many([key] + report_keys)
+    if not reports:
+        return 0
+    _send_reports([reports[report_key] for report_key in report_keys if report_key in reports])
+    return len(reports)
@@ -0,0 +1,20 @@
+#-*- coding: utf-8 -*-
+"""
+Create the geoads index pack on an existing database
+
+New databases get these indexes after syncdb, see geoads.indexes.
+"""
+from django.core.management.base import BaseCommand
+
+from geoads.indexes import create_indexes
+
+
+class Command(BaseCommand):
+    help = "Create the missing indexes of the geoads index pack (PostgreSQL only)."
+
+    def handle(self, *args, **options):
+        created = create_indexes()
+        for name in created:
+            self.stdout.write('Created index %s' % name)
+        if int(options['verbosity']) >= 1:
+            self.stdout.write('%s index(es) created.' % len(created))
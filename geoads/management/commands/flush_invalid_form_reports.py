@@ -0,0 +1,21 @@
+#-*- coding: utf-8 -*-
+"""
+Send the aggregated invalid form reports of the previous time window
+
+To be run periodically (cron), every GEOADS_INVALID_FORM_REPORT_WINDOW seconds,
+so that the last reports are sent even if no report follows them.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from geoads.mail import flush_invalid_form_reports
+from geoads.settings import GEOADS_INVALID_FORM_REPORT_WINDOW
+
+
+class Command(BaseCommand):
+    help = "Send the aggregated invalid form reports of the previous time window."
+
+    def handle(self, *args, **options):
+        window = int(time.time()) // GEOADS_INVALID_FORM_REPORT_WINDOW
+        flush_invalid_form_reports.delay(window - 1)
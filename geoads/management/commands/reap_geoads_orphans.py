@@ -0,0 +1,16 @@
+#-*- coding: utf-8 -*-
+"""
+Remove search results, contacts and pictures of deleted ads
+
+To be run periodically (cron), see geoads.reaper.
+"""
+from django.core.management.base import BaseCommand
+
+from geoads.reaper import reap_orphans
+
+
+class Command(BaseCommand):
+    help = "Remove search results, contacts and pictures referencing deleted ads."
+
+    def handle(self, *args, **options):
+        reap_orphans.delay()
@@ -0,0 +1,135 @@
+#-*- coding: utf-8 -*-
+"""
+Rebuild AdSearchResult table
+
+Recompute all AdSearchResult rows, for example after a filterset change,
+a data fix or an index migration. Work is sharded by Ad content type and
+AdSearch id range, and shards are processed by a pool of processes.
+"""
+import time
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Max, Min
+
+from geoads.events import definition_matching_pks, get_definition, sync_ad_search_results
+from geoads.models import AdSearch
+
+
+def rebuild_shard(shard):
+    """
+    Rebuild results of AdSearch instances in the given shard
+
+    shard is a (content_type_id, first_id, last_id, dry_run) tuple.
+    Return a (content_type_id, searches, added, removed, diff) tuple,
+    diff being the list of (ad_search_id, added, removed) for changed searches.
+    """
+    content_type_id, first_id, last_id, dry_run = shard
+    searches = added = removed = 0
+    diff = []
+    # identical searches of the shard are evaluated only once
+    matching_pks = {}
+    ad_searches = AdSearch.objects.select_related('definition', 'definition__content_type')\
+        .filter(content_type_id=content_type_id, id__gte=first_id, id__lte=last_id)
+    for ad_search in ad_searches:
+        definition = get_definition(ad_search)
+        if definition.id not in matching_pks:
+            matching_pks[definition.id] = definition_matching_pks(definition)
+        ad_search_added, ad_search_removed = sync_ad_search_results(
+            ad_search, matching_pks=matching_pks[definition.id], dry_run=dry_run)
+        searches += 1
+        added += len(ad_search_added)
+        removed += len(ad_search_removed)
+        if ad_search_added or ad_search_removed:
+            diff.append((ad_search.id, sorted(ad_search_added), sorted(ad_search_removed)))
+    return content_type_id, searches, added, removed, diff
+
+
+class Command(BaseCommand):
+    help = "Rebuild AdSearchResult rows of all (or some) AdSearch instances. " \
+           "Rows are added with bulk inserts, so no notification is sent."
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of worker processes (default: 1, no pool)'),
+        make_option('--shard-size', dest='shard_size', type='int', default=500,
+                    help='Number of AdSearch ids per shard (default: 500)'),
+        make_option('--model', dest='models', action='append', default=[],
+                    help='Only rebuild searches on this ad model, as app_label.model. '
+                         'Can be repeated.'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                    help='Compute and report the differences without writing them'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        dry_run = options['dry_run']
+        if options['shard_size'] < 1 or options['processes'] < 1:
+            raise CommandError('--shard-size and --processes must be positive')
+
+        shards = self.get_shards(options['models'], options['shard_size'], dry_run)
+        if not shards:
+            self.stdout.write('No AdSearch to rebuild.')
+            return
+
+        start = time.time()
+        if options['processes'] > 1:
+            # children must not share the parent database connection
+            connection.close()
+            pool = Pool(options['processes'])
+            results = pool.imap_unordered(rebuild_shard, shards)
+        else:
+            pool = None
+            results = (rebuild_shard(shard) for shard in shards)
+
+        searches = added = removed = 0
+        try:
+            for done, result in enumerate(results, 1):
+                content_type_id, shard_searches, shard_added, shard_removed, diff = result
+                searches += shard_searches
+                added += shard_added
+                removed += shard_removed
+                if verbosity >= 1:
+                    self.stdout.write('[%s/%s] %s: %s searches, +%s -%s results'
+                                      % (done, len(shards),
+                                         ContentType.objects.get_for_id(content_type_id),
+                                         shard_searches, shard_added, shard_removed))
+                if dry_run and verbosity >= 2:
+                    for ad_search_id, diff_added, diff_removed in diff:
+                        self.stdout.write('  AdSearch %s: +%s -%s'
+                                          % (ad_search_id, diff_added, diff_removed))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - start or 1e-6
+        self.stdout.write('%s%s searches rebuilt in %.1fs (%.1f searches/s): '
+                          '%s results added, %s results removed (%.1f results/s)'
+                          % ('[dry-run] ' if dry_run else '', searches, elapsed,
+                             searches / elapsed, added, removed,
+                             (added + removed) / elapsed))
+
+    def get_shards(self, models, shard_size, dry_run):
+        """
+        Split AdSearch ids in (content_type_id, first_id, last_id, dry_run) shards
+        """
+        ad_searches = AdSearch.objects.all()
+        if models:
+            content_types = []
+            for model in models:
+                try:
+                    app_label, name = model.lower().split('.')
+                    content_types.append(ContentType.objects.get(app_label=app_label, model=name))
+                except (ValueError, ContentType.DoesNotExist):
+                    raise CommandError('Unknown ad model %s' % model)
+            ad_searches = ad_searches.filter(content_type__in=content_types)
+        shards = []
+        bounds = ad_searches.values('content_type').annotate(first_id=Min('id'), last_id=Max('id'))
+        for bound in bounds.order_by('content_type'):
+            for first_id in range(bound['first_id'], bound['last_id'] + 1, shard_size):
+                shards.append((bound['content_type'], first_id,
+                               min(first_id + shard_size - 1, bound['last_id']), dry_run))
+        return shards
@@ -0,0 +1,51 @@
+#-*- coding: utf-8 -*-
+"""
+Summarize the slow ad filterset queries log
+
+Queries with the same shape (same filters, whatever their values) are
+grouped and ranked by total time, with the plan of their last occurrence,
+to tell which indexes and filters to add. See geoads.models.SlowFilterQuery.
+"""
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, Max, Sum
+
+from geoads.models import SlowFilterQuery
+
+
+class Command(BaseCommand):
+    help = "Show the slowest ad filterset query shapes, with their query plan."
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=10,
+                    help='Number of query shapes shown (default: 10)'),
+        make_option('--clear', dest='clear', action='store_true', default=False,
+                    help='Empty the log once shown'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        shapes = SlowFilterQuery.objects.values('content_type', 'sql_fingerprint')\
+            .annotate(count=Count('id'), total=Sum('duration'), avg=Avg('duration'),
+                      max=Max('duration'), last_id=Max('id'))\
+            .order_by('-total')[:options['limit']]
+        shapes = list(shapes)
+        if not shapes:
+            self.stdout.write('No slow filterset query.')
+            return
+        last_queries = SlowFilterQuery.objects.in_bulk([shape['last_id'] for shape in shapes])
+        for rank, shape in enumerate(shapes, 1):
+            query = last_queries[shape['last_id']]
+            self.stdout.write('#%s %s: %s queries, total %.0f ms, avg %.0f ms, max %.0f ms'
+                              % (rank, ContentType.objects.get_for_id(shape['content_type']),
+                                 shape['count'], shape['total'], shape['avg'], shape['max']))
+            self.stdout.write('  search: %s' % (query.search or '(empty)'))
+            if verbosity >= 2:
+                self.stdout.write('  sql: %s' % query.sql)
+                self.stdout.write('  params: %s' % query.params)
+            if verbosity >= 1 and query.plan:
+                for line in query.plan.splitlines():
+                    self.stdout.write('    %s' % line)
+        if options['clear']:
+            SlowFilterQuery.objects.all().delete()
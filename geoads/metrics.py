@@ -0,0 +1,107 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app metrics module
+
+Timers and counters of geoads hot paths (geocoding, filtersets, matching,
+mails), sent to the backend set by GEOADS_METRICS_BACKEND:
+- geoads.metrics.NullMetrics (default) drops them
+- geoads.metrics.StatsdMetrics sends them over UDP, statsd format with
+  DogStatsD style tags, options (host, port, prefix) come from
+  GEOADS_METRICS_OPTIONS
+
+    from geoads import metrics
+    metrics.incr('matching.results_added', 3, tags={'model': 'customads.testad'})
+    with metrics.timer('geocode.latency'):
+        ...
+"""
+import socket
+import time
+
+from django.utils.importlib import import_module
+
+from geoads.settings import GEOADS_METRICS_BACKEND, GEOADS_METRICS_OPTIONS
+
+
+class Timer(object):
+    """
+    Context manager sending the duration of its block, in milliseconds
+    """
+    def __init__(self, backend, name, tags=None):
+        self.backend = backend
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.backend.timing(self.name, (time.time() - self.start) * 1000, self.tags)
+
+
+class NullMetrics(object):
+    """
+    Metrics backend doing nothing
+    """
+    def incr(self, name, value=1, tags=None):
+        pass
+
+    def timing(self, name, ms, tags=None):
+        pass
+
+    def timer(self, name, tags=None):
+        return Timer(self, name, tags)
+
+
+class StatsdMetrics(NullMetrics):
+    """
+    Metrics backend sending statsd UDP packets, e.g.
+    geoads.matching.results_added:3|c|#model:customads.testad
+    """
+    def __init__(self, host='localhost', port=8125, prefix='geoads'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind, tags=None):
+        packet = '%s.%s:%s|%s' % (self.prefix, name, value, kind)
+        if tags:
+            packet += '|#' + ','.join('%s:%s' % item for item in sorted(tags.items()))
+        try:
+            self.socket.sendto(packet.encode('utf-8'), self.address)
+        except socket.error:
+            # metrics must never break the application
+            pass
+
+    def incr(self, name, value=1, tags=None):
+        self.send(name, value, 'c', tags)
+
+    def timing(self, name, ms, tags=None):
+        self.send(name, '%.3f' % ms, 'ms', tags)
+
+
+def load_backend(path=GEOADS_METRICS_BACKEND, options=GEOADS_METRICS_OPTIONS):
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)(**options)
+
+
+backend = load_backend()
+
+
+def incr(name, value=1, tags=None):
+    backend.incr(name, value, tags)
+
+
+def timing(name, ms, tags=None):
+    backend.timing(name, ms, tags)
+
+
+def timer(name, tags=None):
+    return backend.timer(name, tags)
+
+
+def model_tag(model):
+    """
+    Tag value of an ad model (or instance): app_label.model
+    """
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name.lower())
@@ -0,0 +1,79 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app middleware module
+"""
+import cProfile
+import logging
+
+from geoads.instrumentation import QueryRecorder
+from geoads.profiling import profiling_requested, save_profile
+from geoads.settings import GEOADS_QUERY_INSTRUMENTATION
+
+
+logger = logging.getLogger('geoads.queries')
+
+
+class QueryCountMiddleware(object):
+    """
+    Development middleware recording the queries of each view dispatch
+
+    Add an X-Geoads-Queries header (queries count and repeated shapes count)
+    and log the repeated query shapes (likely N+1).
+    Inactive unless GEOADS_QUERY_INSTRUMENTATION is enabled (DEBUG by default).
+    """
+
+    def process_request(self, request):
+        if GEOADS_QUERY_INSTRUMENTATION:
+            request._geoads_query_recorder = QueryRecorder().__enter__()
+
+    def process_response(self, request, response):
+        recorder = self._stop(request)
+        if recorder is not None:
+            response['X-Geoads-Queries'] = '%s; repeated=%s' % (recorder.count, len(recorder.duplicates()))
+        return response
+
+    def process_exception(self, request, exception):
+        # the recorder forces use_debug_cursor: never leave it open
+        self._stop(request)
+
+    def _stop(self, request):
+        """
+        Close and log the recorder of the request, if any, and return it
+        """
+        recorder = getattr(request, '_geoads_query_recorder', None)
+        if recorder is None:
+            return None
+        recorder.__exit__(None, None, None)
+        del request._geoads_query_recorder
+        name = '%s %s' % (request.method, request.path)
+        if recorder.duplicates():
+            logger.warning(recorder.summary(name))
+        else:
+            logger.debug(recorder.summary(name))
+        return recorder
+
+
+class ProfilingMiddleware(object):
+    """
+    Profile a single request with cProfile, on demand
+
+    Requests with a X-Geoads-Profile header signed with
+    geoads.profiling.make_profiling_token(), or a geoads_profile query
+    parameter sent by a staff user, are profiled from the view to the
+    rendered response. The profile is saved in the profiles store and
+    its name is returned in the X-Geoads-Profile response header.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if profiling_requested(request):
+            request._geoads_profiler = cProfile.Profile()
+            request._geoads_profiler.enable()
+
+    def process_response(self, request, response):
+        profiler = getattr(request, '_geoads_profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        del request._geoads_profiler
+        response['X-Geoads-Profile'] = save_profile(profiler, '%s %s' % (request.method, request.path))
+        return response
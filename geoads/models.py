@@ -1,8 +1,12 @@
 #-*- coding: utf-8 -*-
+import hashlib
+import json
 import logging
 
-from django.db import models
+from django.db import connection, models, transaction, DatabaseError
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.contrib.gis.db import models
+from django.contrib.gis.db.models.query import GeoQuerySet
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
@@ -12,7 +16,10 @@ from autoslug import AutoSlugField
 from jsonfield.fields import JSONField
 
 
-from geoads.signals import geoad_new_interested_user
+from geoads.instrumentation import explain, normalize_sql
+from geoads.settings import GEOADS_SLOW_FILTER_QUERY_MAX_ROWS
+from geoads.signals import geoad_new_interested_users
+from geoads.utils import normalize_search, resolve_content_objects, search_fingerprint
 
 
 logger = logging.getLogger(__name__)
@@ -48,6 +55,43 @@ class AdContact(models.Model):
         db_table = 'ads_adcontact'
 
 
+class AdSearchDefinitionManager(models.Manager):
+    """
+    Ad Search Definition Manager
+    """
+    def get_for_search(self, content_type, search):
+        """
+        Return the (shared) definition of a search on an ad content type
+        """
+        content_type_id = getattr(content_type, 'id', content_type)
+        search = normalize_search(search)
+        definition, created = self.get_or_create(
+            fingerprint=search_fingerprint(content_type_id, search),
+            defaults={'content_type_id': content_type_id, 'search': search})
+        return definition
+
+
+class AdSearchDefinition(models.Model):
+    """
+    AdSearch definition
+
+    Distinct (content type, normalized search) couple, shared by all
+    identical AdSearch instances, so that matching is done once
+    per definition and then fanned out to subscribers (AdSearch).
+    """
+    fingerprint = models.CharField(max_length=40, unique=True)
+    content_type = models.ForeignKey(ContentType)
+    search = models.CharField(max_length=2550)
+
+    objects = AdSearchDefinitionManager()
+
+    class Meta:
+        db_table = 'ads_adsearchdefinition'
+
+    def __unicode__(self):
+        return self.fingerprint
+
+
 '''
 class PublicAdSearchManager(models.Manager):
     """
@@ -59,6 +103,17 @@ class PublicAdSearchManager(models.Manager):
 '''
 
 
+class AdSearchManager(models.Manager):
+    """
+    AdSearch Manager
+    """
+    def unread_counts(self, user):
+        """
+        Return {ad_search_id: unread results count} for all user searches, in one query
+        """
+        return dict(self.filter(user=user).values_list('id', 'unread_count'))
+
+
 class AdSearch(models.Model):
     """
     AdSearch base
@@ -75,8 +130,15 @@ class AdSearch(models.Model):
                                  help_text=u"Une recherche publique permet aux vendeurs ayant un bien correspondant à votre recherche de vous contacter.")
     description = models.TextField("Message aux vendeurs", null=True, blank=True, 
                                    help_text=u"Ce message est destiné aux vendeurs ayant un bien correspondant à votre recherche. Il sera publié avec votre annonce de recherche.")
+    definition = models.ForeignKey(AdSearchDefinition, null=True, blank=True, editable=False)
+    # results created after last_seen_date, maintained by the matching pipeline
+    last_seen_date = models.DateTimeField(null=True, blank=True, editable=False)
+    unread_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # fields only written by queryset updates
+    counter_fields = ('unread_count', 'last_seen_date')
 
-    objects = models.Manager()
+    objects = AdSearchManager()
     #publics = PublicAdSearchManager()
 
     class Meta:
@@ -85,14 +147,22 @@ class AdSearch(models.Model):
     def save(self, *args, **kwargs):
         previous_public = None
         if self.id is not None:
-            previous_public = AdSearch.objects.get(id=self.id).public
+            previous_public = AdSearch.objects.values_list('public', flat=True).get(id=self.id)
+            if kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+                # counters are maintained by UPDATE queries, leave them out of this one
+                kwargs['update_fields'] = [field.name for field in self._meta.local_fields
+                                           if not field.primary_key and field.name not in self.counter_fields]
+        self.definition = AdSearchDefinition.objects.get_for_search(self.content_type_id, self.search)
         super(AdSearch, self).save(*args, **kwargs)  # Call the "real" save() method.
         if previous_public != self.public and self.public is True:
-            # send mail to vendors
+            # send mail to vendors, in one batch
             ad_search_results = AdSearchResult.objects.filter(ad_search=self)
-            for instance in ad_search_results:
-                if instance.create_date < self.create_date or previous_public is False:
-                    geoad_new_interested_user.send(sender=Ad, ad=instance.content_object, interested_user=self.user)
+            if previous_public is not False:
+                ad_search_results = ad_search_results.filter(create_date__lt=self.create_date)
+            ads = [result.content_object for result in resolve_content_objects(ad_search_results)
+                   if result.content_object is not None]
+            if ads:
+                geoad_new_interested_users.send(sender=Ad, pairs=[(ad, self) for ad in ads])
 
 
 class AdSearchResult(models.Model):
@@ -113,16 +183,140 @@ class AdSearchResult(models.Model):
         db_table = 'ads_adsearchresult'
         # ensure that an ad is only present once for
         unique_together = ('ad_search', 'content_type', 'object_pk')
+        # results feed range scans, see AdSearchResultFeedView
+        index_together = [['ad_search', 'create_date', 'id']]
+
+
+class SlowFilterQueryManager(models.Manager):
+    """
+    Slow Filter Query Manager
+    """
+    def record(self, filterset, queryset, duration):
+        """
+        Record a query of a filterset qs which took duration milliseconds,
+        keeping the last GEOADS_SLOW_FILTER_QUERY_MAX_ROWS queries only
+
+        The log never breaks the request: database errors are logged.
+        """
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return None  # no query was run
+        try:
+            if transaction.is_managed():
+                return self._record(filterset, queryset, sql, params, duration)
+            # create commits by itself outside of a managed block
+            with transaction.commit_on_success():
+                return self._record(filterset, queryset, sql, params, duration)
+        except DatabaseError:
+            logger.exception('Slow filterset query not recorded')
+            return None
+
+    def _record(self, filterset, queryset, sql, params, duration):
+        sid = transaction.savepoint()
+        try:
+            slow_query = self.create(
+                content_type=ContentType.objects.get_for_model(filterset._meta.model),
+                search=filterset.get_search()[:self.model._meta.get_field('search').max_length], sql=sql,
+                sql_fingerprint=hashlib.sha1(normalize_sql(sql).encode('utf-8')).hexdigest(),
+                params=json.dumps(params, default=repr), duration=duration,
+                plan=explain(queryset))
+            self.filter(id__lte=slow_query.id - GEOADS_SLOW_FILTER_QUERY_MAX_ROWS).delete()
+        except DatabaseError:
+            transaction.savepoint_rollback(sid)
+            raise
+        transaction.savepoint_commit(sid)
+        return slow_query
+
+
+class SlowFilterQuery(models.Model):
+    """
+    Slow filterset query
+
+    Ad filterset query slower than GEOADS_SLOW_FILTER_QUERY_THRESHOLD,
+    with its query plan, see the slow_filter_queries command.
+    """
+    content_type = models.ForeignKey(ContentType)
+    search = models.CharField(max_length=2550)
+    sql = models.TextField()
+    # queries with the same shape (whatever the values) share the fingerprint
+    sql_fingerprint = models.CharField(max_length=40, db_index=True)
+    params = models.TextField()
+    duration = models.FloatField()  # milliseconds
+    plan = models.TextField(blank=True)
+    create_date = models.DateTimeField(auto_now_add=True)
+
+    objects = SlowFilterQueryManager()
+
+    class Meta:
+        db_table = 'ads_slowfilterquery'
+
+    def __unicode__(self):
+        return u'%s (%.0f ms)' % (self.search, self.duration)
+
+
+class AdQuerySet(GeoQuerySet):
+    """
+    Ad QuerySet
+    """
+    def with_public_adsearch_count(self):
+        """
+        Annotate ads with public_adsearch_count, the number of public searches
+        they belong to, read from the buyers_count counter (no subquery)
+        """
+        qn = connection.ops.quote_name
+        return self.extra(select={'public_adsearch_count': '%s.%s' % (
+            qn(self.model._meta.db_table), qn(self.model._meta.get_field('buyers_count').column))})
+
+    def prefetch_public_adsearch(self):
+        """
+        Prefetch search results and their searches, used by Ad.public_adsearch
+        (2 more queries whatever the number of ads)
+        """
+        return self.prefetch_related('ad_search_results__ad_search')
 
 
 class AdManager(models.GeoManager):
     """
     Ad Manager
-    anticipation of use for it
     no more used to get filterset linked to Ad model
+
+    Soft deleted ads (with a delete_date) are excluded
     """
+    include_deleted = False
+
     #TODO fix for django1.5 needed get_query_set became get_queryset
-    pass
+    def get_query_set(self):
+        queryset = AdQuerySet(self.model, using=self._db)
+        if not self.include_deleted:
+            # matches the live ads partial index, see geoads.indexes
+            queryset = queryset.filter(delete_date__isnull=True)
+        return queryset
+
+    def with_public_adsearch_count(self):
+        return self.get_query_set().with_public_adsearch_count()
+
+    def prefetch_public_adsearch(self):
+        return self.get_query_set().prefetch_public_adsearch()
+
+
+class AllAdManager(AdManager):
+    """
+    Ad Manager including soft deleted ads
+    """
+    include_deleted = True
+
+
+class AdSlugField(AutoSlugField):
+    """
+    AutoSlugField checking uniqueness against all the ads
+
+    Soft deleted ads keep their slug in the table, autoslug would only
+    look for rivals in the live ads of the objects manager.
+    """
+    def pre_save(self, instance, add):
+        self.manager = type(instance).all_objects
+        return super(AdSlugField, self).pre_save(instance, add)
 
 
 class Ad(models.Model):
@@ -130,8 +324,8 @@ class Ad(models.Model):
     Ad abstract base model
     """
     user = models.ForeignKey(User)
-    slug = AutoSlugField(populate_from='get_full_description',
-                         always_update=True, unique=True)
+    slug = AdSlugField(populate_from='get_full_description',
+                       always_update=True, unique=True)
     description = models.TextField("", null=True, blank=True)
     user_entered_address = models.CharField("Adresse", max_length=2550,
                                             help_text=u"Adresse complète, ex. : 5 rue de Verneuil Paris")
@@ -141,14 +335,20 @@ class Ad(models.Model):
     update_date = models.DateTimeField(auto_now=True)
     create_date = models.DateTimeField(auto_now_add=True)
     delete_date = models.DateTimeField(null=True, blank=True)
+    # public searches results counters, maintained by geoads.events
+    buyers_count = models.PositiveIntegerField(default=0, editable=False)
+    contacted_buyers_count = models.PositiveIntegerField(default=0, editable=False)
 
     ad_search_results = generic.GenericRelation(AdSearchResult,
                                                 object_id_field="object_pk",
                                                 content_type_field="content_type")
 
     objects = AdManager()
+    all_objects = AllAdManager()
 
     default_filterset = 'geoads.filtersets.AdFilterSet'
+    # text fields of the full-text search_vector column, see geoads.indexes
+    full_text_fields = ('description',)
 
     @classmethod
     def filterset(cls):
@@ -163,16 +363,24 @@ class Ad(models.Model):
         logger.info('%s' % klass)
         return klass
     
+    @classmethod
+    def matchable_queryset(cls):
+        """
+        Ads which can be found by searches, base queryset of filtersets
+        """
+        return cls._default_manager.all()
+
     def get_full_description(self, instance=None):
         raise NotImplementedError
 
     def _get_public_adsearch(self):
-        #TODO should be just one queryset ! this is ugly
-        ad_search_results_public = []
-        for ad in self.ad_search_results.all():
-            if ad.ad_search.public is True:
-                ad_search_results_public.append(ad.ad_search)
-        return ad_search_results_public
+        if 'ad_search_results' in getattr(self, '_prefetched_objects_cache', {}):
+            # see AdQuerySet.prefetch_public_adsearch
+            return [result.ad_search for result in self.ad_search_results.all()
+                    if result.ad_search.public is True]
+        content_type = ContentType.objects.get_for_model(self)
+        return list(AdSearch.objects.filter(public=True, adsearchresult__content_type=content_type,
+                                            adsearchresult__object_pk=self.pk))
 
     public_adsearch = property(_get_public_adsearch)
 
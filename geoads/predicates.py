@@ -0,0 +1,164 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app predicates module
+
+Compile the filterset criteria of an AdSearch (in fact of its shared
+AdSearchDefinition) into a python predicate,
+so that an ad already in memory can be tested against many saved searches
+without running one SQL query per search.
+Compiled predicates (and the GEOS prepared geometries they hold) are cached
+per process, for the GEOADS_PREDICATES_CACHE_SIZE last used definitions,
+and invalidated when an AdSearch is saved or deleted.
+rq workers fork a process per job: there, the cache is rebuilt for each
+job and only saves work within a job matching ads against many searches.
+"""
+from collections import OrderedDict
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.contrib.gis.geos import fromstr
+from django.db.models.fields import FieldDoesNotExist
+from django.http import QueryDict
+
+import django_filters
+
+from geoads.filters import FullTextFilter, LocationFilter, BooleanForNumberFilter
+from geoads.settings import GEOADS_PREDICATES_CACHE_SIZE
+
+
+# filters that only do an 'exact' lookup on a model field
+EXACT_FILTERS = (django_filters.Filter, django_filters.CharFilter,
+                 django_filters.NumberFilter, django_filters.BooleanFilter,
+                 django_filters.ChoiceFilter, django_filters.AllValuesFilter)
+
+EMPTY_VALUES = ([], (), {}, None, '')
+
+# per process LRU cache: AdSearchDefinition id => predicate
+_predicates = OrderedDict()
+
+
+def _always(ad):
+    return True
+
+
+def _never(ad):
+    return False
+
+
+def _compile_filter(model, filter_, value):
+    """
+    Return a predicate for one filter of a filterset and its cleaned value,
+    mirroring what filter_.filter(qs, value) does in SQL,
+    or None if this filter can't be evaluated in python
+    """
+    if type(filter_) is FullTextFilter:
+        # stemming and ranking are done by the database
+        return _always if value in EMPTY_VALUES else None
+    if '__' in filter_.name:
+        return None
+    try:
+        field = model._meta.get_field(filter_.name)
+    except FieldDoesNotExist:
+        return None
+    attname = field.attname
+    filter_class = type(filter_)
+
+    if filter_class is LocationFilter:
+        if not value:
+            return _always
+        geometry = fromstr(value)
+        if geometry.srid and field.srid and geometry.srid != field.srid:
+            geometry.transform(field.srid)
+        prepared = geometry.prepared
+
+        def location_test(ad):
+            location = getattr(ad, attname)
+            return location is not None and prepared.contains(location)
+        return location_test
+
+    if filter_class is BooleanForNumberFilter:
+        is_set = bool(value)
+        return lambda ad: (getattr(ad, attname) is not None) == is_set
+
+    if filter_class in EXACT_FILTERS and filter_.lookup_type in ('exact', 'in'):
+        if value in EMPTY_VALUES:
+            return _always
+        # form values (strings for choice filters) are compared to model values
+        # the way the database compares them
+        try:
+            if filter_.lookup_type == 'in':
+                if not isinstance(value, (list, tuple)):
+                    return None
+                values = set(field.to_python(item) for item in value)
+                return lambda ad: getattr(ad, attname) in values
+            value = field.to_python(value)
+        except ValidationError:
+            return None
+        return lambda ad: getattr(ad, attname) == value
+
+    if filter_class is django_filters.ModelChoiceFilter and filter_.lookup_type == 'exact':
+        if value in EMPTY_VALUES:
+            return _always
+        pk = value.pk
+        return lambda ad: getattr(ad, attname) == pk
+
+    return None
+
+
+def compile_filterset(filterset):
+    """
+    Compile filterset criteria into a predicate taking an ad instance
+
+    Values are cleaned exactly like FilterSet.qs does.
+    Return None if any of the filters can't be evaluated in python.
+    """
+    if not filterset.is_bound:
+        return _always
+    form = filterset.form
+    valid = form.is_valid()
+    tests = []
+    for name, filter_ in filterset.filters.items():
+        if valid:
+            value = form.cleaned_data[name]
+        else:
+            try:
+                value = form.fields[name].clean(form[name].value())
+            except forms.ValidationError:
+                if filterset.strict:
+                    return _never
+                continue
+        if value is None:
+            continue
+        test = _compile_filter(filterset._meta.model, filter_, value)
+        if test is None:
+            return None
+        if test is not _always:
+            tests.append(test)
+    if not tests:
+        return _always
+    return lambda ad: all(test(ad) for test in tests)
+
+
+def get_predicate(definition):
+    """
+    Return the (cached) compiled predicate of an AdSearchDefinition,
+    or None if it can't be compiled
+    """
+    try:
+        predicate = _predicates.pop(definition.id)
+    except KeyError:
+        query = QueryDict(definition.search)
+        filterset = definition.content_type.model_class().filterset()(query or None)
+        predicate = compile_filterset(filterset)
+        if len(_predicates) >= GEOADS_PREDICATES_CACHE_SIZE:
+            # least recently used first
+            _predicates.popitem(last=False)
+    _predicates[definition.id] = predicate
+    return predicate
+
+
+def invalidate_predicate(sender, instance, **kwargs):
+    """
+    Drop the cached predicate of an AdSearch instance definition
+    """
+    _predicates.pop(instance.definition_id, None)
@@ -0,0 +1,118 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app profiling module
+
+cProfile profiles of single requests (see geoads.middleware.ProfilingMiddleware)
+and of sampled matching jobs, kept in a bounded on-disk store:
+GEOADS_PROFILING_DIR holds at most GEOADS_PROFILING_MAX_FILES .prof files,
+the oldest ones are removed first. Profiling is disabled while
+GEOADS_PROFILING_DIR isn't set.
+
+A request is profiled when it carries a X-Geoads-Profile header signed with
+make_profiling_token(), or a geoads_profile query parameter sent by a staff user.
+Profiles can be read with pstats or snakeviz.
+"""
+import cProfile
+import functools
+import os
+import random
+import re
+import time
+
+from django.core import signing
+
+from geoads.settings import (GEOADS_PROFILING_DIR, GEOADS_PROFILING_MAX_FILES,
+                             GEOADS_PROFILING_TOKEN_MAX_AGE, GEOADS_PROFILING_JOB_SAMPLE_RATE)
+
+
+PROFILING_HEADER = 'HTTP_X_GEOADS_PROFILE'
+PROFILING_PARAM = 'geoads_profile'
+PROFILING_SALT = 'geoads.profiling'
+
+_PROFILE_NAME = re.compile(r'^[\w.-]+\.prof$')
+
+
+def make_profiling_token():
+    """
+    Return a X-Geoads-Profile header value, valid GEOADS_PROFILING_TOKEN_MAX_AGE seconds
+    """
+    return signing.TimestampSigner(salt=PROFILING_SALT).sign('profile')
+
+
+def profiling_requested(request):
+    """
+    Whether the request asks to be profiled: valid signed header or staff query parameter
+    """
+    if GEOADS_PROFILING_DIR is None:
+        return False
+    token = request.META.get(PROFILING_HEADER)
+    if token:
+        try:
+            signing.TimestampSigner(salt=PROFILING_SALT).unsign(token, max_age=GEOADS_PROFILING_TOKEN_MAX_AGE)
+            return True
+        except signing.BadSignature:
+            return False
+    user = getattr(request, 'user', None)
+    return PROFILING_PARAM in request.GET and user is not None and user.is_staff
+
+
+def save_profile(profiler, label):
+    """
+    Dump the profiler stats in the store and return the profile name
+    """
+    if not os.path.isdir(GEOADS_PROFILING_DIR):
+        os.makedirs(GEOADS_PROFILING_DIR, 0o700)
+    now = time.time()
+    name = '%s%06d-%s.prof' % (time.strftime('%Y%m%d%H%M%S', time.gmtime(now)),
+                                int(now % 1 * 1000000), re.sub(r'[^\w.-]+', '_', label).strip('_')[:80])
+    profiler.dump_stats(os.path.join(GEOADS_PROFILING_DIR, name))
+    for old in list_profiles()[GEOADS_PROFILING_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(GEOADS_PROFILING_DIR, old['name']))
+        except OSError:
+            pass  # already removed by another process
+    return name
+
+
+def list_profiles():
+    """
+    Return profiles of the store, newest first: [{'name', 'size', 'date'}]
+    """
+    if GEOADS_PROFILING_DIR is None or not os.path.isdir(GEOADS_PROFILING_DIR):
+        return []
+    profiles = []
+    for name in os.listdir(GEOADS_PROFILING_DIR):
+        path = os.path.join(GEOADS_PROFILING_DIR, name)
+        if _PROFILE_NAME.match(name) and os.path.isfile(path):
+            profiles.append({'name': name, 'size': os.path.getsize(path),
+                             'date': os.path.getmtime(path)})
+    # names start with the profile date
+    return sorted(profiles, key=lambda profile: profile['name'], reverse=True)
+
+
+def profile_path(name):
+    """
+    Return the path of a stored profile, None if there is no such profile
+    """
+    if GEOADS_PROFILING_DIR is None or not _PROFILE_NAME.match(name):
+        return None
+    path = os.path.join(GEOADS_PROFILING_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+def profile_sampled(func):
+    """
+    Profile a GEOADS_PROFILING_JOB_SAMPLE_RATE share of the calls (rq jobs)
+    """
+    label = 'job-%s' % func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if GEOADS_PROFILING_DIR is None or random.random() >= GEOADS_PROFILING_JOB_SAMPLE_RATE:
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            save_profile(profiler, label)
+    return wrapper
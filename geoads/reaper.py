@@ -0,0 +1,79 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app reaper module
+
+Remove rows with a generic reference to an ad that doesn't exist anymore
+(hard deleted without signals, or deleted while a matching pass was running).
+Search results of soft deleted ads are removed too, as soft deleted ads
+don't belong to any search.
+Rows are checked in id ranges of GEOADS_REAPER_BATCH_SIZE,
+with one in_bulk query per ad model and one DELETE per batch.
+"""
+import logging
+from collections import defaultdict
+
+from django_rq import job
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max, Min
+
+from geoads.events import update_unread_counts
+from geoads.models import AdContact, AdPicture, AdSearchResult
+from geoads.settings import GEOADS_REAPER_BATCH_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+# (model, generic foreign key object field, only live ads are valid targets)
+REAPED = ((AdSearchResult, 'object_pk', True),
+          (AdContact, 'object_pk', False),
+          (AdPicture, 'object_id', False))
+
+
+def find_orphans(model, fk_field, live_only, first_id, last_id):
+    """
+    Return ids of model rows in [first_id, last_id] with an invalid generic reference
+    """
+    rows = model.objects.filter(id__gte=first_id, id__lte=last_id)\
+        .values_list('id', 'content_type', fk_field)
+    by_content_type = defaultdict(list)
+    for id, content_type_id, object_pk in rows:
+        by_content_type[content_type_id].append((id, object_pk))
+    orphans = []
+    for content_type_id, refs in by_content_type.items():
+        ad_model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if ad_model is None:
+            # model of the content type doesn't exist anymore
+            orphans.extend(id for id, object_pk in refs)
+            continue
+        manager = ad_model._default_manager if live_only else ad_model._base_manager
+        existing = manager.in_bulk([object_pk for id, object_pk in refs])
+        orphans.extend(id for id, object_pk in refs if object_pk not in existing)
+    return orphans
+
+
+@job
+def reap_orphans(batch_size=GEOADS_REAPER_BATCH_SIZE):
+    """
+    Delete rows of REAPED models with invalid generic references
+    Return the {model name: deleted rows count} dict.
+    """
+    reaped = {}
+    for model, fk_field, live_only in REAPED:
+        reaped[model._meta.object_name] = 0
+        bounds = model.objects.aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            continue
+        for first_id in range(bounds['id__min'], bounds['id__max'] + 1, batch_size):
+            orphans = find_orphans(model, fk_field, live_only, first_id, first_id + batch_size - 1)
+            if not orphans:
+                continue
+            rows = model.objects.filter(id__in=orphans)
+            if model is AdSearchResult:
+                update_unread_counts(removed=rows)
+            rows.delete()
+            reaped[model._meta.object_name] += len(orphans)
+        if reaped[model._meta.object_name]:
+            logger.info('Reaped %s orphan %s rows' % (reaped[model._meta.object_name],
+                                                      model._meta.object_name))
+    return reaped
@@ -1,11 +1,36 @@
 #-*- coding: utf-8 -*-
-from django.db.models.signals import post_save
-from .events import ad_search_post_save_handler, ad_search_result_post_save_handler
+from django.db.models.signals import post_save, pre_delete, post_delete, post_syncdb
+from .events import (ad_search_post_save_handler, ad_search_result_post_save_handler,
+                     ad_search_pre_delete_handler, ad_search_post_delete_handler,
+                     new_relevant_ads_for_searches_handler, new_interested_users_handler)
+from .indexes import create_indexes_handler
 from .models import AdSearch, AdSearchResult 
+from .predicates import invalidate_predicate
+from .signals import geoad_new_relevant_ads_for_searches, geoad_new_interested_users
 
 
 post_save.connect(ad_search_post_save_handler,
                   sender=AdSearch, dispatch_uid="ad_search_post_save_handler")
 
+pre_delete.connect(ad_search_pre_delete_handler,
+                   sender=AdSearch, dispatch_uid="ad_search_pre_delete_handler")
+
+post_delete.connect(ad_search_post_delete_handler,
+                    sender=AdSearch, dispatch_uid="ad_search_post_delete_handler")
+
 post_save.connect(ad_search_result_post_save_handler,
                   sender=AdSearchResult, dispatch_uid="ad_search_result_post_save_handler")
+
+post_save.connect(invalidate_predicate,
+                  sender=AdSearch, dispatch_uid="ad_search_post_save_invalidate_predicate")
+
+post_delete.connect(invalidate_predicate,
+                    sender=AdSearch, dispatch_uid="ad_search_post_delete_invalidate_predicate")
+
+geoad_new_relevant_ads_for_searches.connect(new_relevant_ads_for_searches_handler,
+                                            dispatch_uid="new_relevant_ads_for_searches_handler")
+
+geoad_new_interested_users.connect(new_interested_users_handler,
+                                   dispatch_uid="new_interested_users_handler")
+
+post_syncdb.connect(create_indexes_handler, dispatch_uid="geoads_create_indexes_handler")
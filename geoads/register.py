@@ -1,6 +1,13 @@
-from django.db.models.signals import post_save
-from .events import ad_post_save_handler
+from django.db.models.signals import post_save, pre_delete, post_delete
+from .cache import ad_fragments_invalidation_handler
+from .events import ad_post_save_handler, ad_pre_delete_handler
 
 def geoads_register(model_class):
     post_save.connect(ad_post_save_handler, sender=model_class,
                       dispatch_uid="ad_post_save_handler")
+    post_save.connect(ad_fragments_invalidation_handler, sender=model_class,
+                      dispatch_uid="ad_fragments_post_save_handler")
+    post_delete.connect(ad_fragments_invalidation_handler, sender=model_class,
+                        dispatch_uid="ad_fragments_post_delete_handler")
+    pre_delete.connect(ad_pre_delete_handler, sender=model_class,
+                       dispatch_uid="ad_pre_delete_handler")
@@ -4,3 +4,69 @@ from django.conf import settings
 GEOCODE = getattr(settings, 'GEOCODE', 'nominatim')
 
 GEOADS_ASYNC = getattr(settings, 'GEOADS_ASYNC', False)
+
+# default notification digest frequency: 'immediate', 'hourly' or 'daily'
+GEOADS_NOTIFICATION_FREQUENCY = getattr(settings, 'GEOADS_NOTIFICATION_FREQUENCY', 'immediate')
+
+# mail delivery, see geoads.mail
+GEOADS_EMAIL_BACKEND = getattr(settings, 'GEOADS_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+GEOADS_MAIL_QUEUE = getattr(settings, 'GEOADS_MAIL_QUEUE', 'default')
+GEOADS_MAIL_MAX_RETRIES = getattr(settings, 'GEOADS_MAIL_MAX_RETRIES', 3)
+GEOADS_MAIL_RETRY_DELAY = getattr(settings, 'GEOADS_MAIL_RETRY_DELAY', 5)
+GEOADS_REPORT_EMAIL = getattr(settings, 'GEOADS_REPORT_EMAIL', 'contact@achetersanscom.com')
+GEOADS_INVALID_FORM_REPORT_WINDOW = getattr(settings, 'GEOADS_INVALID_FORM_REPORT_WINDOW', 600)
+
+# maximum number of ads kept in session as already contacted
+GEOADS_SESSION_SENT_MAIL_MAX = getattr(settings, 'GEOADS_SESSION_SENT_MAIL_MAX', 50)
+
+# timeout of cached ad fragments (adcache template tag)
+GEOADS_FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'GEOADS_FRAGMENT_CACHE_TIMEOUT', 3600)
+
+# saved-search results feed (AdSearchResultFeedView)
+GEOADS_FEED_PAGE_SIZE = getattr(settings, 'GEOADS_FEED_PAGE_SIZE', 100)
+GEOADS_FEED_MAX_WAIT = getattr(settings, 'GEOADS_FEED_MAX_WAIT', 25)
+GEOADS_FEED_POLL_INTERVAL = getattr(settings, 'GEOADS_FEED_POLL_INTERVAL', 1)
+
+# number of rows checked per batch by the orphans reaper (geoads.reaper)
+GEOADS_REAPER_BATCH_SIZE = getattr(settings, 'GEOADS_REAPER_BATCH_SIZE', 1000)
+
+# query instrumentation (geoads.instrumentation, geoads.middleware), for development
+GEOADS_QUERY_INSTRUMENTATION = getattr(settings, 'GEOADS_QUERY_INSTRUMENTATION', settings.DEBUG)
+GEOADS_QUERY_DUPLICATES_THRESHOLD = getattr(settings, 'GEOADS_QUERY_DUPLICATES_THRESHOLD', 3)
+
+# rq queue of the matching jobs (geoads.events)
+GEOADS_MATCHING_QUEUE = getattr(settings, 'GEOADS_MATCHING_QUEUE', 'default')
+
+# compiled search predicates kept per process (geoads.predicates)
+GEOADS_PREDICATES_CACHE_SIZE = getattr(settings, 'GEOADS_PREDICATES_CACHE_SIZE', 500)
+
+# metrics backend, see geoads.metrics
+GEOADS_METRICS_BACKEND = getattr(settings, 'GEOADS_METRICS_BACKEND', 'geoads.metrics.NullMetrics')
+GEOADS_METRICS_OPTIONS = getattr(settings, 'GEOADS_METRICS_OPTIONS', {})
+
+# geocoding results cache timeout (seconds), None or 0 disables the cache
+GEOADS_GEOCODE_CACHE_TIMEOUT = getattr(settings, 'GEOADS_GEOCODE_CACHE_TIMEOUT', None)
+
+# request and matching jobs profiling (geoads.profiling, geoads.middleware),
+# disabled unless the profiles store directory is set (e.g. under the project)
+GEOADS_PROFILING_DIR = getattr(settings, 'GEOADS_PROFILING_DIR', None)
+GEOADS_PROFILING_MAX_FILES = getattr(settings, 'GEOADS_PROFILING_MAX_FILES', 50)
+GEOADS_PROFILING_TOKEN_MAX_AGE = getattr(settings, 'GEOADS_PROFILING_TOKEN_MAX_AGE', 3600)
+# share of the matching jobs profiled, between 0 (none) and 1 (all)
+GEOADS_PROFILING_JOB_SAMPLE_RATE = getattr(settings, 'GEOADS_PROFILING_JOB_SAMPLE_RATE', 0)
+
+# slow ad filterset queries log (geoads.models.SlowFilterQuery), threshold
+# in milliseconds (None disables it) and maximum number of queries kept
+GEOADS_SLOW_FILTER_QUERY_THRESHOLD = getattr(settings, 'GEOADS_SLOW_FILTER_QUERY_THRESHOLD', 500)
+GEOADS_SLOW_FILTER_QUERY_MAX_ROWS = getattr(settings, 'GEOADS_SLOW_FILTER_QUERY_MAX_ROWS', 1000)
+
+# admin changelists of tables with more rows than this use an estimated count
+GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD = getattr(settings, 'GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000)
+
+# text search configuration of the full-text search (geoads.filters.FullTextFilter)
+GEOADS_FULL_TEXT_CONFIG = getattr(settings, 'GEOADS_FULL_TEXT_CONFIG', 'french')
+# rows per UPDATE (and commit) when search vectors of existing ads are filled
+GEOADS_FULL_TEXT_BACKFILL_BATCH = getattr(settings, 'GEOADS_FULL_TEXT_BACKFILL_BATCH', 10000)
+
+# timeout of cached filterset facet counts (AdFilterSet.facet_counts)
+GEOADS_FACETS_CACHE_TIMEOUT = getattr(settings, 'GEOADS_FACETS_CACHE_TIMEOUT', 600)
@@ -6,3 +6,7 @@ geoad_new_relevant_ad_for_search = Signal(providing_args=['ad', 'relevant_search
 geoad_user_message = Signal(providing_args=['ad', 'user', 'message'])
 geoad_vendor_message = Signal(providing_args=['ad', 'ad_search', 'user', 'message'])
 geoad_post_save_ended = Signal(providing_args=['ad'])
+
+# batch variants, sent once per matching pass with a list of (ad, ad_search) pairs
+geoad_new_relevant_ads_for_searches = Signal(providing_args=['pairs'])
+geoad_new_interested_users = Signal(providing_args=['pairs'])
@@ -0,0 +1,51 @@
+#-*- coding: utf-8 -*-
+"""
+Ads app template tags
+"""
+from django import template
+from django.core.cache import cache
+
+from geoads.cache import ad_fragment_cache_key
+from geoads.settings import GEOADS_FRAGMENT_CACHE_TIMEOUT
+
+
+register = template.Library()
+
+
+class AdCacheNode(template.Node):
+    def __init__(self, nodelist, ad, fragment):
+        self.nodelist = nodelist
+        self.ad = ad
+        self.fragment = fragment
+
+    def render(self, context):
+        ad = self.ad.resolve(context)
+        fragment = self.fragment.resolve(context) if self.fragment else 'body'
+        key = ad_fragment_cache_key(ad, fragment)
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, GEOADS_FRAGMENT_CACHE_TIMEOUT)
+        return value
+
+
+@register.tag
+def adcache(parser, token):
+    """
+    Cache a fragment of an ad page until the ad changes
+
+    Usage::
+
+        {% load geoads_tags %}
+        {% adcache ad %} ... {% endadcache %}
+        {% adcache ad "pictures" %} ... {% endadcache %}
+
+    The fragment must not depend on the user (csrf token, session...).
+    """
+    bits = token.split_contents()
+    if len(bits) not in (2, 3):
+        raise template.TemplateSyntaxError("'%s' tag takes an ad and an optional fragment name" % bits[0])
+    nodelist = parser.parse(('endadcache',))
+    parser.delete_first_token()
+    fragment = parser.compile_filter(bits[2]) if len(bits) == 3 else None
+    return AdCacheNode(nodelist, parser.compile_filter(bits[1]), fragment)
@@ -1,14 +1,106 @@
 #-*- coding: utf-8 -*-
+import hashlib
+from collections import defaultdict
+
 import requests
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.http import QueryDict
+from django.utils.http import urlencode
 
+from geoads import metrics
+from geoads.settings import GEOADS_GEOCODE_CACHE_TIMEOUT
 
-def geocode(address):
+
+def _geocode(address):
     if settings.GEOCODE == 'nominatim':
         params = {'q': address, 'format': 'json', 'addressdetails': '1', 'limit': '1', 'countrycodes': 'fr', 'polygon': '1'}
         r = requests.get("http://nominatim.openstreetmap.org/search", params=params)
         address = r.json[0]['address']
         location = Point(float(r.json[0]['lon']), float(r.json[0]['lat']), srid=900913)
         return {'address': address, 'location': location}
+
+
+def geocode(address):
+    """
+    Return address and location of address, cached for
+    GEOADS_GEOCODE_CACHE_TIMEOUT seconds when set (an address
+    is geocoded when the ad form is validated, and again when it's saved)
+    """
+    if isinstance(address, unicode):
+        address = address.encode('utf-8')
+    if not GEOADS_GEOCODE_CACHE_TIMEOUT:
+        return _timed_geocode(address)
+    key = 'geoads:geocode:%s:%s' % (settings.GEOCODE, hashlib.sha1(address).hexdigest())
+    result = cache.get(key)
+    if result is not None:
+        metrics.incr('geocode.cache_hits', tags={'backend': settings.GEOCODE})
+        return result
+    metrics.incr('geocode.cache_misses', tags={'backend': settings.GEOCODE})
+    result = _timed_geocode(address)
+    if result is not None:
+        cache.set(key, result, GEOADS_GEOCODE_CACHE_TIMEOUT)
+    return result
+
+
+def _timed_geocode(address):
+    try:
+        with metrics.timer('geocode.latency', tags={'backend': settings.GEOCODE}):
+            return _geocode(address)
+    except Exception:
+        metrics.incr('geocode.failures', tags={'backend': settings.GEOCODE})
+        raise
+
+
+def normalize_search(search):
+    """
+    Return the canonical form of a search querystring
+
+    Empty parameters are removed (Django `QueryDict` uses
+    keep_blank_values=True in parse_qsl, which keeps them as [u''])
+    and remaining parameters are sorted, so that identical searches
+    have the same representation.
+    """
+    q = QueryDict(search, mutable=True)
+    [q.pop(elt[0]) for elt in q.lists() if elt[1] == [u'']]
+    return urlencode(sorted((key, value) for key, values in q.lists() for value in values))
+
+
+def search_fingerprint(content_type_id, search):
+    """
+    Return the fingerprint of a normalized search on an ad content type
+    """
+    return hashlib.sha1(('%s:%s' % (content_type_id, search)).encode('utf-8')).hexdigest()
+
+
+def resolve_content_objects(objects, field_name='content_object'):
+    """
+    Resolve the GenericForeignKey field_name of a batch of objects
+
+    Objects are grouped by content type and each group is fetched with
+    one in_bulk query. Results are stored in the generic foreign key cache,
+    so that reading obj.content_object doesn't query the database anymore
+    (None for deleted targets). Return objects as a list.
+    """
+    objects = list(objects)
+    if not objects:
+        return objects
+    field = [f for f in objects[0]._meta.virtual_fields if f.name == field_name][0]
+    ct_attname = objects[0]._meta.get_field(field.ct_field).attname
+    pks = defaultdict(set)
+    for obj in objects:
+        pks[getattr(obj, ct_attname)].add(getattr(obj, field.fk_field))
+    targets = {}
+    for content_type_id, object_pks in pks.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        object_pks = [model._meta.pk.to_python(pk) for pk in object_pks]
+        for pk, target in model._base_manager.in_bulk(object_pks).items():
+            targets[(content_type_id, pk)] = target
+    for obj in objects:
+        model = ContentType.objects.get_for_id(getattr(obj, ct_attname)).model_class()
+        pk = model._meta.pk.to_python(getattr(obj, field.fk_field))
+        setattr(obj, field.cache_attr, targets.get((getattr(obj, ct_attname), pk)))
+    return objects
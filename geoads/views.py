@@ -5,19 +5,27 @@ Views for ads application
 This module provides class-based views Create/Read/Update/Delete absractions
 to work with Ad models.
 """
+import hashlib
+import json
+import math
+import time
+from datetime import datetime
+
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.contenttypes.generic import generic_inlineformset_factory
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.sites.models import Site
-from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
-from django.http import QueryDict, Http404, HttpResponseRedirect, HttpResponseForbidden
-from django.shortcuts import redirect
+from django.db.models import Count, Max, Q
+from django.http import (QueryDict, Http404, HttpResponse, HttpResponseRedirect,
+                         HttpResponseBadRequest, HttpResponseForbidden)
+from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from django.utils.translation import ungettext
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic import (ListView, DetailView, CreateView, UpdateView, View,
                                   DeleteView, TemplateView, FormView)
 from django.views.generic.detail import SingleObjectMixin
@@ -26,18 +34,75 @@ from django_filters.views import FilterView
 
 from geoads.models import Ad, AdSearch, AdPicture, AdSearchResult
 
+from geoads.cache import ad_model_version
 from geoads.forms import (AdContactForm, AdPictureForm, AdSearchForm,
                           AdSearchUpdateForm, AdSearchResultContactForm, BaseAdForm)
-from geoads.utils import geocode
+from geoads.mail import report_invalid_form
+from geoads.profiling import list_profiles, profile_path
+from geoads.settings import (GEOADS_SESSION_SENT_MAIL_MAX, GEOADS_FEED_PAGE_SIZE,
+                             GEOADS_FEED_MAX_WAIT, GEOADS_FEED_POLL_INTERVAL)
+from geoads.utils import geocode, normalize_search
 from geoads.signals import geoad_vendor_message, geoad_user_message
 
 
+def conditional(view, request, *version):
+    """
+    Wrap view so that it answers 304 when the request If-None-Match
+    still matches
+
+    ETag is built from version parts and the requesting user.
+    No Last-Modified is sent: pages depend on the user and the session,
+    a date alone would validate another user's or session's page.
+    Requests with pending messages are always fully rendered,
+    as messages are part of the page.
+    """
+    storage = getattr(request, '_messages', None)
+    if storage is not None and len(storage):
+        return view
+    user = getattr(request, 'user', None)
+    parts = (getattr(user, 'pk', None),) + version
+    etag = hashlib.md5(u':'.join(u'%s' % part for part in parts).encode('utf-8')).hexdigest()
+    return condition(etag_func=lambda request, *args, **kwargs: etag)(view)
+
+
+def sent_mail_key(ad):
+    """
+    Compact key of an ad, stored in session when a message is sent for it
+    """
+    return '%s:%s' % (ContentType.objects.get_for_model(ad).id, ad.pk)
+
+
+def feed_cursor(create_date, id):
+    """
+    Opaque cursor of an AdSearchResult feed position
+    """
+    return '%s_%s' % (create_date.strftime('%Y%m%d%H%M%S%f'), id)
+
+
+def parse_feed_cursor(cursor):
+    """
+    Return the (create_date, id) position of a feed cursor
+    Raise ValueError on malformed cursor
+    """
+    create_date, id = cursor.split('_')
+    create_date = datetime.strptime(create_date, '%Y%m%d%H%M%S%f')
+    if settings.USE_TZ:
+        create_date = timezone.make_aware(create_date, timezone.utc)
+    return create_date, int(id)
+
+
 class LoginRequiredMixin(object):
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
         return super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
 
 
+class StaffRequiredMixin(object):
+    @method_decorator(user_passes_test(lambda user: user.is_staff))
+    def dispatch(self, request, *args, **kwargs):
+        return super(StaffRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+
 class DefaultAdListView(FilterView):
     template_name = 'geoads/search.html'
 
@@ -55,30 +120,35 @@ class AdListView(FilterView):
             if ad_search.user != request.user:
                 return HttpResponseForbidden()
             params = QueryDict(ad_search.search).urlencode()
-            self.request.session['ad_search'] = ad_search
+            self.request.session['ad_search_id'] = ad_search.id
             return HttpResponseRedirect(request.path+"?%s" % params)
         view = DefaultAdListView.as_view(model=self.model, filterset_class = self.model.filterset())
-        return view(request, *args, **kwargs)
+        # ads version: any ad creation, update or deletion changes it
+        return conditional(view, request, request.GET.urlencode(),
+                           ad_model_version(self.model))(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
         # Only for creating a search
         # or updating an existing one
-        # We store it in session: self.request.session['search_id']
-        q = request.GET.copy()
-        [q.pop(elt[0]) for elt in q.lists() if elt[1] == [u'']]
-        search = q.urlencode()
-        if 'ad_search' not in request.session:
+        # We store its id in session: self.request.session['ad_search_id']
+        search = normalize_search(request.GET.urlencode())
+        ad_search = None
+        if 'ad_search_id' in request.session:
+            ad_searches = AdSearch.objects.filter(id=request.session['ad_search_id'],
+                                                  user=request.user)[:1]
+            if ad_searches:
+                # just update it
+                ad_search = ad_searches[0]
+                ad_search.search = search
+                ad_search.save()
+            else:
+                # deleted since, or not a search of this user
+                del request.session['ad_search_id']
+        if ad_search is None:
             # Create a search
             ad_search = AdSearch(user=request.user, search=search, public=True)
             ad_search.content_type = ContentType.objects.get_for_model(self.model)
             ad_search.save()
-        else:
-            # or just update it
-            ad_search = self.request.session['ad_search']
-            if ad_search.user != request.user:
-                return HttpResponseForbidden()
-            ad_search.search = search
-            ad_search.save()
         return HttpResponseRedirect(request.path+"?search_id=%s" % ad_search.id)
 
 class AdSearchView(ListView):
@@ -146,6 +216,17 @@ class AdSearchView(ListView):
         self.ad_search = AdSearch.objects.get(id=self.search_id)
         if self.ad_search.user != self.request.user:
                 raise Http404
+        # search version, derived from its results
+        version = self.model.objects.filter(ad_search_results__ad_search=self.ad_search)\
+            .aggregate(Max('update_date'), Count('id'))
+        return conditional(self.render_search, request, self.ad_search.id,
+                           self.ad_search.search, version['update_date__max'],
+                           version['id__count'])(request, *args, **kwargs)
+
+    def render_search(self, request, *args, **kwargs):
+        # results are seen now, a 304 answer doesn't mark them as seen
+        AdSearch.objects.filter(id=self.ad_search.id).update(unread_count=0,
+                                                             last_seen_date=timezone.now())
         self._q = QueryDict(self.ad_search.search)
         self.object_list = self.get_queryset()
         context = self.get_context_data(object_list=self.object_list)
@@ -206,7 +287,7 @@ class AdSearchView(ListView):
         """
         Search result default message
         """
-        if len(self.object_list.qs) == 0:
+        if len(self.object_list) == 0:
             messages.add_message(self.request, messages.INFO,
                 self.get_no_results_msg(), fail_silently=True)
         else:
@@ -265,6 +346,51 @@ class AdSearchDeleteView(DeleteView):
         return obj
 
 
+class AdSearchResultFeedView(LoginRequiredMixin, View):
+    """
+    JSON feed of the AdSearchResult created for the user searches
+
+    Results are returned in (create_date, id) order after the `cursor`
+    GET parameter (the `cursor` of the previous response), optionally
+    restricted to one `search`. With a `wait` parameter (in seconds),
+    the request is held until new results arrive (long-poll).
+    """
+
+    def get(self, request, *args, **kwargs):
+        ad_searches = AdSearch.objects.filter(user=request.user)
+        cursor = request.GET.get('cursor')
+        try:
+            if request.GET.get('search'):
+                ad_searches = ad_searches.filter(id=int(request.GET['search']))
+            after = parse_feed_cursor(cursor) if cursor else None
+            wait = float(request.GET.get('wait', 0))
+        except ValueError:
+            return HttpResponseBadRequest()
+        if math.isnan(wait) or math.isinf(wait):
+            return HttpResponseBadRequest()
+        wait = max(0, min(wait, GEOADS_FEED_MAX_WAIT))
+        ad_search_ids = list(ad_searches.values_list('id', flat=True))
+        results = AdSearchResult.objects.filter(ad_search__in=ad_search_ids)
+        if after is not None:
+            results = results.filter(Q(create_date__gt=after[0]) |
+                                     Q(create_date=after[0], id__gt=after[1]))
+        results = results.order_by('create_date', 'id')\
+            .values_list('id', 'create_date', 'ad_search', 'content_type', 'object_pk')
+        deadline = time.time() + wait
+        while True:
+            rows = list(results[:GEOADS_FEED_PAGE_SIZE]) if ad_search_ids else []
+            if rows or time.time() >= deadline:
+                break
+            time.sleep(GEOADS_FEED_POLL_INTERVAL)
+        if rows:
+            cursor = feed_cursor(rows[-1][1], rows[-1][0])
+        data = {'cursor': cursor,
+                'results': [{'search': ad_search_id, 'ct': content_type_id, 'pk': object_pk}
+                            for id, create_date, ad_search_id, content_type_id, object_pk in rows]}
+        return HttpResponse(json.dumps(data, separators=(',', ':')),
+                            content_type='application/json')
+
+
 class AdDisplay(DetailView):
     context_object_name = 'ad'
     template_name = 'geoads/view.html'
@@ -273,10 +399,7 @@ class AdDisplay(DetailView):
     def get_context_data(self, **kwargs):
         context = super(AdDisplay, self).get_context_data(**kwargs)
         context['contact_form'] = self.contact_form()
-        if 'sent_mail' in self.request.session and self.get_object() in self.request.session['sent_mail']: 
-            context['sent_mail'] = True
-        else:
-            context['sent_mail'] = False
+        context['sent_mail'] = sent_mail_key(self.object) in self.request.session.get('sent_mail', ())
         return context
 
 
@@ -295,13 +418,11 @@ class AdMessage(SingleObjectMixin, FormView):
         messages.add_message(self.request, messages.INFO,
                 _(u'Votre message a bien été envoyé.'), fail_silently=True)
 
-        # Use session to store already sent mails
-        if not 'sent_mail' in self.request.session or not self.request.session['sent_mail']:
-            self.request.session['sent_mail'] = [self.object]
-        else:
-            sent_mail_list = self.request.session['sent_mail']
-            sent_mail_list.append(self.object)
-            self.request.session['sent_mail'] = sent_mail_list
+        # Use session to store already sent mails, as a bounded list of ad keys
+        sent_mail_list = [key for key in self.request.session.get('sent_mail', [])
+                          if key != sent_mail_key(self.object)]
+        sent_mail_list.append(sent_mail_key(self.object))
+        self.request.session['sent_mail'] = sent_mail_list[-GEOADS_SESSION_SENT_MAIL_MAX:]
 
         return super(AdMessage, self).form_valid(form)
 
@@ -317,7 +438,17 @@ class AdDetailView(View):
     contact_form = AdContactForm     
     def get(self, request, *args, **kwargs):
         view = AdDisplay.as_view(model=self.model, contact_form=self.contact_form)
-        return view(request, *args, **kwargs)
+        if 'pk' in kwargs:
+            ads = self.model.objects.filter(pk=kwargs['pk'])
+        else:
+            ads = self.model.objects.filter(slug=kwargs.get('slug'))
+        version = ads.values_list('pk', 'update_date')[:1]
+        if not version:
+            return view(request, *args, **kwargs)  # 404
+        pk, update_date = version[0]
+        ad_key = '%s:%s' % (ContentType.objects.get_for_model(self.model).id, pk)
+        return conditional(view, request, ad_key, update_date,
+                           ad_key in request.session.get('sent_mail', ()))(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
         view = AdMessage.as_view(model=self.model, form_class=self.contact_form)
@@ -348,10 +479,8 @@ class AdCreateView(LoginRequiredMixin, CreateView):
             return redirect('complete', permanent=True)
 
     def form_invalid(self, form):
-        send_mail(_(u"[%s] %s invalid form while creating an ad") %
-                  (Site.objects.get_current().name, self.request.user.email),
-                  "%s" % (form.errors), 'contact@achetersanscom.com',
-                  ["contact@achetersanscom.com"], fail_silently=True)
+        # reported to admin, aggregated with other reports of the time window
+        report_invalid_form(self.request.user, form)
         return self.render_to_response(self.get_context_data(form=form))
 
     def get_context_data(self, **kwargs):
@@ -439,6 +568,30 @@ class AdDeleteView(LoginRequiredMixin, DeleteView):
         return settings.LOGIN_REDIRECT_URL
 
 
+class ResultList(list):
+    """
+    AdSearchResult list, with the QuerySet methods templates use on results
+    """
+    def count(self):
+        return len(self)
+
+    def exists(self):
+        return bool(self)
+
+    def all(self):
+        return self
+
+
+class PotentialBuyers(ResultList):
+    """
+    AdSearchResult list with contacted and not_contacted sublists
+    """
+    def __init__(self, *args, **kwargs):
+        super(PotentialBuyers, self).__init__(*args, **kwargs)
+        self.contacted = ResultList()
+        self.not_contacted = ResultList()
+
+
 class AdPotentialBuyersView(LoginRequiredMixin, ListView):
     """
     Class based view for listing potential buyers of an ad
@@ -449,22 +602,30 @@ class AdPotentialBuyersView(LoginRequiredMixin, ListView):
     pk = None
 
     def get_queryset(self):
-        # should return a list of buyers, in fact AdSearch instances
+        # should return a list of buyers, in fact AdSearchResult instances
+        # with their ad_search and its user, partitioned in contacted/not_contacted
         self.pk = self.kwargs['pk']
+        self.object = get_object_or_404(self.model, id=self.pk)
         content_type = ContentType.objects.get_for_model(self.model)
         queryset = self.search_model.objects.filter(object_pk=self.pk)\
-            .filter(content_type=content_type).filter(ad_search__public=True)
-        queryset.contacted = queryset.filter(contacted=True)
-        queryset.not_contacted = queryset.exclude(contacted=True)
-        for obj in queryset.not_contacted:
-            obj.form = AdSearchResultContactForm(instance=obj)
-            obj.form_action = reverse('contact_buyer', kwargs={'adsearchresult_id': obj.id})
-        return queryset
+            .filter(content_type=content_type).filter(ad_search__public=True)\
+            .select_related('ad_search', 'ad_search__user').order_by('id')
+        buyers = PotentialBuyers(queryset)
+        buyers.model = self.search_model  # for the default context object name
+        for obj in buyers:
+            obj.content_object = self.object
+            if obj.contacted:
+                buyers.contacted.append(obj)
+            else:
+                obj.form = AdSearchResultContactForm(instance=obj)
+                obj.form_action = reverse('contact_buyer', kwargs={'adsearchresult_id': obj.id})
+                buyers.not_contacted.append(obj)
+        return buyers
 
     def get_context_data(self, **kwargs):
         """extra context"""
         context = super(AdPotentialBuyersView, self).get_context_data(**kwargs)
-        context['object'] = self.model.objects.get(id=self.pk)
+        context['object'] = self.object
         return context
 
 
@@ -494,3 +655,25 @@ class AdPotentialBuyerContactView(LoginRequiredMixin, FormView):
         geoad_vendor_message.send(sender=Ad, ad=ad_search_result.content_object, ad_search=ad_search_result.ad_search,
                                   user=ad_search_result.ad_search.user, message=self.message)
         return reverse('contact_buyers', kwargs={'pk': ad_search_result.object_pk})
+
+
+class ProfileListView(StaffRequiredMixin, View):
+    """
+    Staff view of the stored request profiles (see geoads.middleware.ProfilingMiddleware)
+
+    Without `name`, JSON list of the profiles, newest first,
+    with a `name`, download of the profile (cProfile stats file).
+    """
+
+    def get(self, request, *args, **kwargs):
+        name = kwargs.get('name')
+        if name:
+            path = profile_path(name)
+            if path is None:
+                raise Http404
+            with open(path, 'rb') as profile:
+                response = HttpResponse(profile.read(), content_type='application/octet-stream')
+            response['Content-Disposition'] = 'attachment; filename=%s' % name
+            return response
+        return HttpResponse(json.dumps(list_profiles(), separators=(',', ':')),
+                            content_type='application/json')
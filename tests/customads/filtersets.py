@@ -1,11 +1,32 @@
 from geoads.filtersets import AdFilterSet
-from customads.models import TestAd
+from geoads.filters import BooleanForNumberFilter, FullTextFilter
+from customads.models import TestAd, TestNumberAd, TestModeratedAd
 from customads.forms import TestAdFilterSetForm
 
 
 class TestAdFilterSet(AdFilterSet):
+    q = FullTextFilter()
+    facets = ('brand',)
 
     class Meta:
         model = TestAd
         form = TestAdFilterSetForm
         fields = ['brand', 'location', ]
+        # relevance first: the default ordering in strict mode
+        order_by = (('search_rank', u'Pertinence'), ('brand', u'Marque'))
+
+
+class TestNumberAdFilterSet(AdFilterSet):
+    number = BooleanForNumberFilter()
+    facets = ('number',)
+
+    class Meta:
+        model = TestNumberAd
+        fields = ['number', ]
+
+
+class TestModeratedAdFilterSet(AdFilterSet):
+
+    class Meta:
+        model = TestModeratedAd
+        fields = ['brand', 'location', ]
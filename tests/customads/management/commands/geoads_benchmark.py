@@ -0,0 +1,243 @@
+#-*- coding: utf-8 -*-
+"""
+Benchmark geoads hot paths
+
+Seed a throw-away PostGIS test database with --ads TestAd spread over
+random polygons of Paris and --searches saved searches, then time:
+ad save (matching), AdSearch save (materialization), full rebuild,
+AdSearchView filter and read, potential buyers view (views are timed
+with their template rendering) and geocoding (with a stubbed backend).
+Timings are written as JSON, and compared with a previous JSON output
+given as --baseline: the command fails if a path got slower than
+--tolerance.
+
+    python manage.py geoads_benchmark --output bench.json
+    python manage.py geoads_benchmark --baseline bench.json
+"""
+import json
+import math
+import random
+import time
+from optparse import make_option
+from StringIO import StringIO
+
+import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.messages.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.http import QueryDict
+from django.test.client import RequestFactory
+from django.utils.http import urlencode
+
+from geoads import views
+from geoads.models import AdSearch, AdSearchResult
+from geoads.utils import geocode, normalize_search
+
+from customads.factories import UserFactory, TestAdSearchFactory
+from customads.models import TestAd
+
+
+# Paris bounding box (longitude, latitude)
+BBOX = (2.25, 48.81, 2.42, 48.90)
+BRANDS = ['brand%s' % i for i in range(20)]
+
+
+def stats(times):
+    """
+    Return the statistics of a list of timings, in milliseconds
+    """
+    times = sorted(t * 1000 for t in times)
+    return {'n': len(times),
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'p95': times[min(len(times) - 1, int(math.ceil(len(times) * 0.95)) - 1)]}
+
+
+def render(response):
+    """
+    Render a TemplateResponse, as the request handler does after the view
+    """
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return {path: (ratio, status)} of median timings against baseline ones
+    """
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline.get('results', {}):
+            continue
+        ratio = result['median'] / (baseline['results'][name]['median'] or 1e-6)
+        if ratio > 1 + tolerance:
+            status = 'slower'
+        elif ratio < 1 - tolerance:
+            status = 'faster'
+        else:
+            status = 'same'
+        comparison[name] = {'ratio': ratio, 'status': status}
+    return comparison
+
+
+class Command(BaseCommand):
+    help = "Time geoads hot paths on a seeded test database, and compare with a baseline."
+    option_list = BaseCommand.option_list + (
+        make_option('--ads', dest='ads', type='int', default=5000,
+                    help='Number of seeded ads (default: 5000)'),
+        make_option('--searches', dest='searches', type='int', default=500,
+                    help='Number of seeded saved searches (default: 500)'),
+        make_option('--repeat', dest='repeat', type='int', default=20,
+                    help='Number of timed runs per path (default: 20)'),
+        make_option('--seed', dest='seed', type='int', default=0,
+                    help='Random seed of the dataset (default: 0)'),
+        make_option('--output', dest='output', default=None,
+                    help='JSON output file (default: standard output)'),
+        make_option('--baseline', dest='baseline', default=None,
+                    help='JSON output of a previous run to compare with'),
+        make_option('--tolerance', dest='tolerance', type='float', default=0.2,
+                    help='Allowed median slowdown ratio (default: 0.2)'),
+    )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        self.random = random.Random(options['seed'])
+        self.factory = RequestFactory()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.seed(options['ads'], options['searches'], options['seed'])
+            results = self.run(options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        data = {'dataset': {'ads': options['ads'], 'searches': options['searches'],
+                            'seed': options['seed'], 'repeat': options['repeat']},
+                'results': results}
+        if baseline is not None:
+            data['comparison'] = compare(results, baseline, options['tolerance'])
+        output = json.dumps(data, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+        if baseline is not None:
+            slower = sorted(name for name, c in data['comparison'].items() if c['status'] == 'slower')
+            if slower:
+                raise CommandError('Slower than baseline: %s' % ', '.join(slower))
+
+    def random_location(self):
+        return 'SRID=900913;POINT(%s %s)' % (self.random.uniform(BBOX[0], BBOX[2]),
+                                             self.random.uniform(BBOX[1], BBOX[3]))
+
+    def random_search(self):
+        """
+        Return a normalized search: an irregular hexagon, sometimes a brand
+        """
+        x = self.random.uniform(BBOX[0], BBOX[2])
+        y = self.random.uniform(BBOX[1], BBOX[3])
+        radius = self.random.uniform(0.005, 0.02)
+        points = []
+        for i in range(6):
+            angle = math.pi * 2 * i / 6
+            r = radius * self.random.uniform(0.7, 1.3)
+            points.append('%s %s' % (x + r * math.cos(angle), y + r * math.sin(angle)))
+        points.append(points[0])
+        params = {'location': 'SRID=900913;POLYGON((%s))' % ', '.join(points)}
+        if self.random.random() < 0.5:
+            params['brand'] = self.random.choice(BRANDS)
+        return normalize_search(urlencode(params))
+
+    def request(self, path='/', data=None):
+        request = self.factory.get(path, data=data or {})
+        request.user = self.user
+        request.session = {}
+        request._messages = default_storage(request)
+        return request
+
+    def seed(self, ads, searches, seed):
+        """
+        Insert ads with one INSERT ... SELECT (factories geocode over the network)
+        and searches with one bulk INSERT, then materialize results
+        """
+        self.user = UserFactory.create()
+        self.content_type = ContentType.objects.get_for_model(TestAd)
+        cursor = connection.cursor()
+        cursor.execute('SELECT setseed(%s)', [1.0 / (abs(seed) + 2)])
+        cursor.execute("""INSERT INTO %s (user_id, slug, user_entered_address, location, brand,
+                                          update_date, create_date, buyers_count, contacted_buyers_count)
+                          SELECT %%s, 'ad-' || n, 'Paris',
+                                 ST_SetSRID(ST_MakePoint(%%s + random() * %%s, %%s + random() * %%s), 900913),
+                                 'brand' || floor(random() * %%s), now(), now(), 0, 0
+                          FROM generate_series(1, %%s) AS n""" % connection.ops.quote_name(TestAd._meta.db_table),
+                       [self.user.id, BBOX[0], BBOX[2] - BBOX[0], BBOX[1], BBOX[3] - BBOX[1],
+                        len(BRANDS), ads])
+        users = [UserFactory.create() for i in range(10)]
+        AdSearch.objects.bulk_create([
+            TestAdSearchFactory.build(user=self.random.choice(users), content_type=self.content_type,
+                                      search=self.random_search(), public=self.random.random() < 0.8)
+            for i in range(searches)])
+        cursor.execute('ANALYZE')
+
+    def timed(self, func, repeat):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            func(i)
+            times.append(time.time() - start)
+        return stats(times)
+
+    def run(self, repeat):
+        results = {}
+
+        start = time.time()
+        call_command('rebuild_adsearchresults', stdout=StringIO())
+        results['rebuild_adsearchresults'] = stats([time.time() - start])
+
+        def ad_save(i):
+            TestAd(user=self.user, brand=self.random.choice(BRANDS), user_entered_address='Paris',
+                   location=self.random_location()).save()
+        results['ad_save_matching'] = self.timed(ad_save, repeat)
+
+        def ad_search_save(i):
+            AdSearch(user=self.user, content_type=self.content_type, search=self.random_search(),
+                     public=True).save()
+        results['adsearch_save_materialization'] = self.timed(ad_search_save, repeat)
+
+        search_view = views.AdSearchView.as_view(model=TestAd)
+
+        def filter_ads(i):
+            render(search_view(self.request(data=dict(QueryDict(self.random_search()).items()))))
+        results['adsearchview_filter'] = self.timed(filter_ads, repeat)
+
+        ad_search_ids = list(AdSearch.objects.filter(user=self.user).values_list('id', flat=True))
+
+        def read_search(i):
+            render(search_view(self.request(), search_id=ad_search_ids[i % len(ad_search_ids)]))
+        results['adsearchview_read'] = self.timed(read_search, repeat)
+
+        # the ad with the most interested buyers
+        popular = AdSearchResult.objects.filter(ad_search__public=True).values('object_pk')\
+            .annotate(buyers=Count('id')).order_by('-buyers')[:1]
+        if popular:
+            buyers_view = views.AdPotentialBuyersView.as_view(model=TestAd)
+            results['potential_buyers_view'] = self.timed(
+                lambda i: render(buyers_view(self.request(), pk=popular[0]['object_pk'])), repeat)
+
+        response = mock.Mock()
+        response.json = [{'address': {'city': 'Paris'}, 'lon': '2.35', 'lat': '48.85'}]
+        # geocoder round trip stubbed, and cache bypassed: geocode overhead only
+        with mock.patch('geoads.utils.requests.get', return_value=response):
+            with mock.patch('geoads.utils.GEOADS_GEOCODE_CACHE_TIMEOUT', None):
+                results['geocode_stubbed'] = self.timed(lambda i: geocode('Paris'), repeat)
+        return results
@@ -11,6 +11,7 @@ class TestAd(Ad):
     brand = models.CharField(max_length=255, null=True, blank=True)
 
     default_filterset = 'tests.customads.filtersets.TestAdFilterSet'
+    full_text_fields = ('description', 'brand')
 
     @models.permalink
     def get_absolute_url(self):
@@ -23,6 +24,8 @@ class TestAd(Ad):
 class TestNumberAd(Ad):
     number = models.IntegerField(null=True, blank=True)
 
+    default_filterset = 'tests.customads.filtersets.TestNumberAdFilterSet'
+
     def get_full_description(self, instance=None):
         return 'number'
 
@@ -30,7 +33,7 @@ class TestNumberAd(Ad):
 class TestModeratedAd(ModeratedAd):
     brand = models.CharField(max_length=255, null=True, blank=True)
 
-    default_filterset = 'tests.customads.filtersets.TestAdFilterSet'
+    default_filterset = 'tests.customads.filtersets.TestModeratedAdFilterSet'
 
     def get_full_description(self, instance=None):
         return self.brand
@@ -4,30 +4,75 @@ GeoAd test module
 
 All test are done synchronously in tests (as python-rq is allready tested)
 """
+import json
+import os
+import pstats
+import shutil
+import smtplib
+import socket
+import tempfile
+import time
+from StringIO import StringIO
+from urllib import urlencode
+
+from django.conf import settings
+from django.contrib import admin
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from django.template import Context, Template
 from django.test import TransactionTestCase, TestCase
 from django.test.client import RequestFactory
+from django.db import connection, DatabaseError
 from django.http import Http404
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.messages.storage import default_storage
+from django.utils import timezone
 
+import django_filters
+from mock import Mock, patch
 from mock_django import mock_signal_receiver
+from moderation.models import ModeratedObject
 
-from geoads import views
+from geoads import metrics, predicates, views
+from geoads.admin import AdSearchResultAdmin, EstimatedCountPaginator
+from geoads.cache import invalidate_ad_fragments
 from geoads.filtersets import AdFilterSet
-from geoads.models import AdSearch
+from geoads import middleware as middleware_module
+from geoads.indexes import create_indexes
+from geoads.instrumentation import normalize_sql, query_budget
+from geoads.middleware import ProfilingMiddleware, QueryCountMiddleware
+from geoads.models import AdContact, AdPicture, AdSearch, AdSearchDefinition, AdSearchResult, SlowFilterQuery
+from geoads.events import create_ad_search_results
 from geoads.filters import BooleanForNumberFilter
 from geoads.models import Ad
-from geoads.utils import geocode
+from geoads.mail import AsyncEmailBackend, deliver_messages, report_invalid_form, flush_invalid_form_reports
+from geoads.predicates import compile_filterset, get_predicate
+from geoads.profiling import list_profiles, make_profiling_token
+from geoads.reaper import reap_orphans
+from geoads.settings import (GEOADS_INVALID_FORM_REPORT_WINDOW, GEOADS_MAIL_MAX_RETRIES,
+                             GEOADS_MAIL_RETRY_DELAY)
+from geoads.utils import geocode, resolve_content_objects
 
 from customads.models import TestAd, TestNumberAd, TestModeratedAd
 from customads.forms import TestAdForm
 from customads.factories import UserFactory, TestAdFactory, TestNumberAdFactory, TestAdSearchFactory, TestModeratedAdFactory
-from customads.filtersets import TestAdFilterSet
+from customads.filtersets import TestAdFilterSet, TestNumberAdFilterSet
 
-from geoads.signals import (geoad_user_message, geoad_new_interested_user, geoad_new_relevant_ad_for_search, geoad_post_save_ended)
+from geoads.signals import (geoad_user_message, geoad_new_interested_user, geoad_new_relevant_ad_for_search, geoad_post_save_ended,
+                            geoad_new_interested_users, geoad_new_relevant_ads_for_searches)
 
+from geoads.contrib.moderation.admin import ModeratedAdAdmin
+from geoads.contrib.moderation import moderator as moderator_module
+from geoads.contrib.moderation.moderator import batched_matching
 from geoads.contrib.moderation.signals import moderation_in_progress
 from geoads.contrib.moderation.views import ModeratedAdUpdateView
+from geoads.contrib.notifications.models import (NotificationPreference, PendingNotification,
+                                                 queue_notifications, send_digests)
 
 
 class RequestFactoryWithMessages(RequestFactory):
@@ -163,6 +208,20 @@ class AdSearchAndMoreViewTestCase(GeoadsBaseTestCase):
         request.user = user
         response = views.AdSearchView.as_view(model=TestAd)(request)
 
+    def test_ad_list_view_deleted_search(self):
+        user = UserFactory.create()
+        ad_search = TestAdSearchFactory.create(user=user, search="brand=myfunkybrand",
+                                               content_type=ContentType.objects.get_for_model(TestAd))
+        request = self.factory.post('/?brand=myfunkybrand')
+        request.user = user
+        request.session = {'ad_search_id': ad_search.id}
+        ad_search.delete()
+        response = views.AdListView.as_view(model=TestAd)(request)
+        # a new search is created instead
+        new_ad_search = AdSearch.objects.get(user=user)
+        self.assertEqual(response['Location'], '/?search_id=%s' % new_ad_search.id)
+        self.assertFalse('ad_search_id' in request.session)
+
     def test_create_update_read_delete_search(self):
         test_ad = TestAdFactory.create()
         # here we build a search ad form
@@ -197,6 +256,54 @@ class AdSearchAndMoreViewTestCase(GeoadsBaseTestCase):
         request.user = ad_search.user
         response = views.AdSearchDeleteView.as_view()(request, pk=ad_search.pk)
 
+    def test_search_results_feed(self):
+        ad_search = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                               content_type=ContentType.objects.get_for_model(TestAd))
+        TestAdFactory.create_batch(2, brand="myfunkybrand")
+        request = self.factory.get('/')
+        request.user = ad_search.user
+        data = json.loads(views.AdSearchResultFeedView.as_view()(request).content)
+        self.assertEquals(len(data['results']), 2)
+        self.assertEquals(data['results'][0]['search'], ad_search.id)
+        # nothing new after the cursor
+        request = self.factory.get('/', data={'cursor': data['cursor']})
+        request.user = ad_search.user
+        self.assertEquals(json.loads(views.AdSearchResultFeedView.as_view()(request).content)['results'], [])
+        test_ad = TestAdFactory.create(brand="myfunkybrand")
+        data = json.loads(views.AdSearchResultFeedView.as_view()(request).content)
+        self.assertEquals([result['pk'] for result in data['results']], [test_ad.pk])
+        # other users don't see these results
+        request = self.factory.get('/')
+        request.user = UserFactory.create()
+        self.assertEquals(json.loads(views.AdSearchResultFeedView.as_view()(request).content)['results'], [])
+        # invalid parameters
+        for data in ({'search': 'abc'}, {'wait': 'nan'}, {'wait': 'inf'}, {'cursor': 'abc'}):
+            request = self.factory.get('/', data=data)
+            request.user = ad_search.user
+            self.assertEquals(views.AdSearchResultFeedView.as_view()(request).status_code, 400)
+
+    def test_unread_counts(self):
+        ad_search = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                               content_type=ContentType.objects.get_for_model(TestAd))
+        TestAdFactory.create_batch(2, brand="myfunkybrand")
+        self.assertEquals(AdSearch.objects.unread_counts(ad_search.user), {ad_search.id: 2})
+        # reading the search resets its counter
+        request = self.factory.get('/')
+        request.user = ad_search.user
+        views.AdSearchView.as_view(model=TestAd)(request, search_id=ad_search.pk)
+        self.assertEquals(AdSearch.objects.unread_counts(ad_search.user), {ad_search.id: 0})
+        test_ad = TestAdFactory.create(brand="myfunkybrand")
+        self.assertEquals(AdSearch.objects.unread_counts(ad_search.user), {ad_search.id: 1})
+        # an unread result which no longer matches is no longer counted
+        test_ad.brand = "otherbrand"
+        test_ad.save()
+        self.assertEquals(AdSearch.objects.unread_counts(ad_search.user), {ad_search.id: 0})
+        # saving a stale instance leaves counters alone
+        TestAdFactory.create(brand="myfunkybrand")
+        ad_search.public = False
+        ad_search.save()
+        self.assertEquals(AdSearch.objects.unread_counts(ad_search.user), {ad_search.id: 1})
+
 
 class AdDetailViewTestCase(GeoadsBaseTestCase):
 
@@ -205,6 +312,24 @@ class AdDetailViewTestCase(GeoadsBaseTestCase):
         request = self.factory.get('/')
         response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
 
+    def test_conditional_read(self):
+        test_ad = TestAdFactory.create()
+        request = self.factory.get('/')
+        # validators are set before rendering, the app ships no geoads/view.html
+        # template: the response is not rendered
+        response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
+        self.assertEquals(response.status_code, 200)
+        # pages depend on the user and the session: ETag only
+        self.assertFalse(response.has_header('Last-Modified'))
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
+        self.assertEquals(response.status_code, 304)
+        # ad update changes its ETag
+        time.sleep(0.01)
+        test_ad.save()
+        response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
+        self.assertEquals(response.status_code, 200)
+
     def test_send_message(self):
         with mock_signal_receiver(geoad_user_message) as user_message:
             test_ad = TestAdFactory.create()
@@ -214,6 +339,28 @@ class AdDetailViewTestCase(GeoadsBaseTestCase):
             response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
             # verify mail is sent
             self.assertEquals(user_message.call_count, 1)
+            # and stored in session as a compact key
+            self.assertEquals(request.session['sent_mail'], [views.sent_mail_key(test_ad)])
+            request = self.factory.get('/')
+            request.session['sent_mail'] = [views.sent_mail_key(test_ad)]
+            response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
+            self.assertTrue(response.context_data['sent_mail'])
+
+    def test_sent_mail_session_is_bounded(self):
+        test_ads = TestAdFactory.create_batch(3)
+        user = UserFactory.create()
+        views.GEOADS_SESSION_SENT_MAIL_MAX, max_sent_mail = 2, views.GEOADS_SESSION_SENT_MAIL_MAX
+        try:
+            session = {}
+            for test_ad in test_ads:
+                request = self.factory.post('/', data={'message': 'Hi buddy !'})
+                request.session = session
+                request.user = user
+                views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
+        finally:
+            views.GEOADS_SESSION_SENT_MAIL_MAX = max_sent_mail
+        self.assertEquals(session['sent_mail'], [views.sent_mail_key(test_ads[1]),
+                                                 views.sent_mail_key(test_ads[2])])
             
 
 class AdCreateViewTestCase(GeoadsBaseTestCase):
@@ -276,6 +423,18 @@ class AdPotentialBuyersViewTestCase(GeoadsBaseTestCase):
         response = views.AdPotentialBuyersView.as_view(model=TestAd)(request, pk=ad.id)
         self.assertEqual(response.context_data['object'], ad)
         self.assertEqual(response.context_data['object_list'][0], adsearch.adsearchresult_set.all()[0])
+        self.assertEqual(response.context_data['object_list'].not_contacted,
+                         list(adsearch.adsearchresult_set.all()))
+        self.assertEqual(response.context_data['object_list'].contacted, [])
+        # the sublists were querysets, templates still count them
+        self.assertEqual(response.context_data['object_list'].not_contacted.count(), 1)
+        self.assertFalse(response.context_data['object_list'].contacted.exists())
+        response.render()
+        self.assertTrue('1 acheteur(s) potentiel(s)' in response.content)
+        result = response.context_data['object_list'].not_contacted[0]
+        self.assertEqual(result.form_action, reverse('contact_buyer', kwargs={'adsearchresult_id': result.id}))
+        # unknown ad
+        self.assertRaises(Http404, views.AdPotentialBuyersView.as_view(model=TestAd), request, pk=ad.id + 1)
 
 
 class AdPotentialBuyerContactViewTestCase(GeoadsBaseTestCase):
@@ -294,6 +453,144 @@ class AdPotentialBuyerContactViewTestCase(GeoadsBaseTestCase):
         request.user = ad.user
         response = views.AdPotentialBuyerContactView.as_view()(request,
                 adsearchresult_id=adsearch.adsearchresult_set.all()[0])
+        # denormalized counters
+        ad = TestAd.objects.get(id=ad.id)
+        self.assertEqual((ad.buyers_count, ad.contacted_buyers_count), (1, 1))
+        adsearch.delete()
+        ad = TestAd.objects.get(id=ad.id)
+        self.assertEqual((ad.buyers_count, ad.contacted_buyers_count), (0, 0))
+
+
+class InstrumentationTestCase(GeoadsBaseTestCase):
+
+    def test_normalize_sql(self):
+        self.assertEqual(normalize_sql("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'a''b'"),
+                         "SELECT * FROM t WHERE id IN (...) AND name = ?")
+        # queries not yet run, as in the slow filterset queries log
+        self.assertEqual(normalize_sql('SELECT * FROM t WHERE id IN (%s, %s) AND name = %s'),
+                         normalize_sql('SELECT * FROM t WHERE id IN (%s) AND name = %s'))
+
+    def test_potential_buyers_query_budget(self):
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        TestAdSearchFactory.create_batch(5, search="brand=myfunkybrand",
+                                         content_type=ContentType.objects.get_for_model(TestAd),
+                                         public=True)
+        request = self.factory.get('/')
+        request.user = ad.user
+        with query_budget(4, max_repeat=2):
+            views.AdPotentialBuyersView.as_view(model=TestAd)(request, pk=ad.id)
+        with self.assertRaises(AssertionError):
+            with query_budget(10, max_repeat=2):
+                [ad_search.user for ad_search in AdSearch.objects.all()]
+
+    def test_query_count_middleware(self):
+        test_ad = TestAdFactory.create()
+        request = self.factory.get('/')
+        middleware = QueryCountMiddleware()
+        middleware_module.GEOADS_QUERY_INSTRUMENTATION, enabled = True, middleware_module.GEOADS_QUERY_INSTRUMENTATION
+        try:
+            middleware.process_request(request)
+            response = views.AdDetailView.as_view(model=TestAd)(request, pk=test_ad.pk)
+            response = middleware.process_response(request, response)
+            self.assertTrue(response['X-Geoads-Queries'].endswith('; repeated=0'))
+            # a failing view doesn't leave the debug cursor forced on
+            use_debug_cursor = connection.use_debug_cursor
+            middleware.process_request(request)
+            self.assertTrue(connection.use_debug_cursor)
+            middleware.process_exception(request, Http404())
+            self.assertEqual(connection.use_debug_cursor, use_debug_cursor)
+            self.assertFalse(hasattr(request, '_geoads_query_recorder'))
+        finally:
+            middleware_module.GEOADS_QUERY_INSTRUMENTATION = enabled
+
+    def test_profiling_middleware(self):
+        test_ad = TestAdFactory.create()
+        middleware = ProfilingMiddleware()
+        view = views.AdDetailView.as_view(model=TestAd)
+        directory = tempfile.mkdtemp()
+        try:
+            with patch('geoads.profiling.GEOADS_PROFILING_DIR', directory):
+                with patch('geoads.profiling.GEOADS_PROFILING_MAX_FILES', 2):
+                    # not requested: not profiled
+                    request = self.factory.get('/', {'geoads_profile': 1})
+                    request.user = test_ad.user
+                    self.assertEqual(middleware.process_view(request, view, (), {'pk': test_ad.pk}), None)
+                    response = middleware.process_response(request, view(request, pk=test_ad.pk))
+                    self.assertFalse(response.has_header('X-Geoads-Profile'))
+                    names = []
+                    for i in range(3):
+                        request = self.factory.get('/', HTTP_X_GEOADS_PROFILE=make_profiling_token())
+                        middleware.process_view(request, view, (), {'pk': test_ad.pk})
+                        response = middleware.process_response(request, view(request, pk=test_ad.pk))
+                        names.append(response['X-Geoads-Profile'])
+                    # the store is bounded, oldest profile is removed
+                    self.assertEqual([profile['name'] for profile in list_profiles()], names[:0:-1])
+                    self.assertTrue(pstats.Stats(os.path.join(directory, names[-1])).total_calls > 0)
+                    request = self.factory.get('/')
+                    request.user = UserFactory.create(is_staff=True)
+                    response = views.ProfileListView.as_view()(request)
+                    self.assertEqual([profile['name'] for profile in json.loads(response.content)], names[:0:-1])
+                    response = views.ProfileListView.as_view()(request, name=names[-1])
+                    self.assertEqual(response['Content-Type'], 'application/octet-stream')
+                    with self.assertRaises(Http404):
+                        views.ProfileListView.as_view()(request, name=names[0])
+                    request.user = test_ad.user
+                    self.assertEqual(views.ProfileListView.as_view()(request).status_code, 302)
+        finally:
+            shutil.rmtree(directory)
+        # profiling is disabled without a profiles store
+        with patch('geoads.profiling.GEOADS_PROFILING_DIR', None):
+            request = self.factory.get('/', HTTP_X_GEOADS_PROFILE=make_profiling_token())
+            middleware.process_view(request, view, (), {'pk': test_ad.pk})
+            response = middleware.process_response(request, view(request, pk=test_ad.pk))
+            self.assertFalse(response.has_header('X-Geoads-Profile'))
+            self.assertEqual(list_profiles(), [])
+
+
+class AdminTestCase(GeoadsBaseTestCase):
+
+    def test_estimated_count_paginator(self):
+        TestAdFactory.create_batch(3, brand="myfunkybrand")
+        TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                   content_type=ContentType.objects.get_for_model(TestAd))
+        connection.cursor().execute('ANALYZE ads_adsearchresult')
+        # planner statistics say 3 rows
+        with patch('geoads.admin.GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD', 0):
+            with self.assertNumQueries(1):
+                self.assertEqual(EstimatedCountPaginator(AdSearchResult.objects.all(), 10).count, 3)
+            AdSearchResult.objects.all()[:1].get().delete()
+            # filtered querysets are counted
+            self.assertEqual(EstimatedCountPaginator(AdSearchResult.objects.filter(contacted=False), 10).count, 2)
+        # small tables are counted
+        self.assertEqual(EstimatedCountPaginator(AdSearchResult.objects.all(), 10).count, 2)
+
+    def test_changelist_content_objects(self):
+        test_ads = TestAdFactory.create_batch(3, brand="myfunkybrand")
+        TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                   content_type=ContentType.objects.get_for_model(TestAd))
+        request = RequestFactoryWithMessages().get('/')
+        request.user = UserFactory.create(is_staff=True, is_superuser=True)
+        response = AdSearchResultAdmin(AdSearchResult, admin.site).changelist_view(request)
+        result_list = response.context_data['cl'].result_list
+        with self.assertNumQueries(0):
+            content_objects = set(result.content_object for result in result_list)
+            [result.ad_search.user for result in result_list]
+        self.assertEqual(content_objects, set(test_ads))
+
+    def test_changelist_estimated_full_count(self):
+        TestAdFactory.create_batch(3, brand="myfunkybrand")
+        TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                   content_type=ContentType.objects.get_for_model(TestAd))
+        connection.cursor().execute('ANALYZE ads_adsearchresult')
+        AdSearchResult.objects.all()[:1].get().delete()
+        request = RequestFactoryWithMessages().get('/', {'content_type__id__exact':
+                                                         ContentType.objects.get_for_model(TestAd).id})
+        request.user = UserFactory.create(is_staff=True, is_superuser=True)
+        with patch('geoads.admin.GEOADS_ADMIN_ESTIMATED_COUNT_THRESHOLD', 0):
+            response = AdSearchResultAdmin(AdSearchResult, admin.site).changelist_view(request)
+        # filtered results are counted, the total is the planner estimate
+        self.assertEqual(response.context_data['cl'].result_count, 2)
+        self.assertEqual(response.context_data['cl'].full_result_count, 3)
 
 
 class UtilsFiltersTestCase(GeoadsBaseTestCase):
@@ -307,6 +604,77 @@ class UtilsFiltersTestCase(GeoadsBaseTestCase):
         TestNumberAd.objects.all().delete()
 
 
+class PredicatesTestCase(GeoadsBaseTestCase):
+
+    def test_compiled_predicates(self):
+        location = "SRID=900913;POLYGON((2.3886182861327825 48.834761790252024,2.2773817138671575 48.837925498723266,2.3251035766601262 48.87180983721773,2.4023511962890325 48.87293892019383,2.3886182861327825 48.834761790252024))"
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        ad.location = 'POINT (2.35 48.85)'
+        for search, expected in [('', True),
+                                 ('brand=myfunkybrand', True),
+                                 ('brand=mytoofunkybrand', False),
+                                 (urlencode({'brand': 'myfunkybrand', 'location': location}), True)]:
+            definition = AdSearchDefinition.objects.get_for_search(ContentType.objects.get_for_model(TestAd),
+                                                                   search)
+            predicate = get_predicate(definition)
+            self.assertTrue(predicate is not None)
+            self.assertEqual(predicate(ad), expected)
+        ad.location = 'POINT (2.2 48.9)'
+        self.assertFalse(predicate(ad))
+
+    def test_booleanfornumberfilter_predicate(self):
+        content_type = ContentType.objects.get_for_model(TestNumberAd)
+        predicate = get_predicate(AdSearchDefinition.objects.get_for_search(content_type, 'number=True'))
+        self.assertTrue(predicate(TestNumberAd(number=3)))
+        self.assertFalse(predicate(TestNumberAd(number=None)))
+
+    def test_choicefilter_predicate(self):
+        class NumberChoiceFilterSet(TestNumberAdFilterSet):
+            number = django_filters.ChoiceFilter(choices=((1, 'one'), (2, 'two')))
+        # the cleaned value is a string, compared to the integer of the ad
+        predicate = compile_filterset(NumberChoiceFilterSet({'number': '1'}))
+        self.assertTrue(predicate(TestNumberAd(number=1)))
+        self.assertFalse(predicate(TestNumberAd(number=2)))
+
+    def test_predicates_cache_size(self):
+        content_type = ContentType.objects.get_for_model(TestAd)
+        definitions = [AdSearchDefinition.objects.get_for_search(content_type, 'brand=brand%s' % i)
+                       for i in range(3)]
+        with patch('geoads.predicates.GEOADS_PREDICATES_CACHE_SIZE', 2):
+            with patch.dict('geoads.predicates._predicates', clear=True):
+                for definition in definitions:
+                    get_predicate(definition)
+                self.assertEqual(list(predicates._predicates), [definitions[1].id, definitions[2].id])
+
+    def test_matching_uses_compiled_predicates(self):
+        adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                              content_type=ContentType.objects.get_for_model(TestAd),
+                                              public=True)
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        self.assertEqual(adsearch.adsearchresult_set.count(), 1)
+        ad.brand = "mytoofunkybrand"
+        ad.save()
+        self.assertEqual(adsearch.adsearchresult_set.count(), 0)
+
+
+class AdSearchDefinitionTestCase(GeoadsBaseTestCase):
+
+    def test_identical_searches_share_definition(self):
+        content_type = ContentType.objects.get_for_model(TestAd)
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        adsearch_1 = TestAdSearchFactory.create(search="brand=myfunkybrand&description=",
+                                                content_type=content_type)
+        adsearch_2 = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                                content_type=content_type)
+        self.assertEqual(adsearch_1.definition, adsearch_2.definition)
+        self.assertEqual(AdSearchDefinition.objects.count(), 1)
+        self.assertEqual(adsearch_2.adsearchresult_set.get().object_pk, ad.id)
+        adsearch_2.search = "brand=mytoofunkybrand"
+        adsearch_2.save()
+        self.assertNotEqual(adsearch_1.definition, adsearch_2.definition)
+        self.assertEqual(adsearch_2.adsearchresult_set.count(), 0)
+
+
 class FiltersetsTestCase(GeoadsBaseTestCase):
 
     def test_filterset(self):
@@ -314,8 +682,118 @@ class FiltersetsTestCase(GeoadsBaseTestCase):
         filterset = TestAdFilterSet({'brand': 'myfunkybrand'})
         self.assertEquals(len(filterset), 1)
         self.assertEquals(filterset[0], ad)
+        # an explicit base queryset replaces the matchable ads
+        filterset = TestAdFilterSet({'brand': 'myfunkybrand'}, queryset=TestAd.objects.exclude(pk=ad.pk))
+        self.assertEquals(len(filterset), 0)
         ad.delete()
 
+    def test_full_text_filter(self):
+        red = TestAdFactory.create(brand="myfunkybrand", description=u"Vélos rouges en bon état")
+        TestAdFactory.create(brand="otherbrand", description=u"Une voiture rouge")
+        filterset = TestAdFilterSet({'q': u'vélo rouge'})
+        self.assertEqual(list(filterset.qs), [red])
+        self.assertTrue(filterset.qs[0].search_rank > 0)
+        self.assertEqual(list(TestAdFilterSet({'q': 'myfunkybrand'}).qs), [red])
+        self.assertEqual(filterset.get_order_by('search_rank'), ['-search_rank'])
+        self.assertEqual(TestAdFilterSet({'brand': 'myfunkybrand'}).get_order_by('search_rank'), [])
+        # full-text searches can be saved, and new ads are matched
+        ad_search = TestAdSearchFactory.create(search=urlencode({'q': u'vélo'.encode('utf-8')}),
+                                               content_type=ContentType.objects.get_for_model(TestAd))
+        self.assertEqual([result.content_object for result in AdSearchResult.objects.filter(ad_search=ad_search)],
+                         [red])
+        TestAdFactory.create(brand="myfunkybrand", description=u"Un vélo bleu")
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 2)
+
+    def test_search_rank_ordering(self):
+        few = TestAdFactory.create(brand="abrand", description=u"Un vélo")
+        many = TestAdFactory.create(brand="zbrand", description=u"Vélo, vélo de course et vélo de ville")
+        TestAdFactory.create(brand="otherbrand", description=u"Une voiture")
+        # relevance is the default ordering of full-text searches
+        self.assertEqual(list(TestAdFilterSet({'q': u'vélo'})), [many, few])
+        self.assertEqual(list(TestAdFilterSet({'q': u'vélo', 'o': 'search_rank'})), [many, few])
+        self.assertEqual(list(TestAdFilterSet({'q': u'vélo', 'o': 'brand'})), [few, many])
+        # without full-text filter, ranking falls back to the base ordering
+        self.assertEqual(len(TestAdFilterSet({'brand': 'abrand', 'o': 'search_rank'})), 1)
+
+    def test_facet_counts(self):
+        cache.clear()
+        TestAdFactory.create_batch(2, brand="myfunkybrand", description=u"Vélo rouge")
+        TestAdFactory.create(brand="otherbrand", description=u"Vélo bleu")
+        TestAdFactory.create(brand="otherbrand", description=u"Voiture")
+        filterset = TestAdFilterSet({'brand': 'myfunkybrand', 'q': u'vélo'})
+        ContentType.objects.get_for_model(TestAd)
+        with self.assertNumQueries(1):
+            # counts of a facet ignore its own filter
+            self.assertEqual(filterset.facet_counts(), {'brand': [('myfunkybrand', 2), ('otherbrand', 1)]})
+        with self.assertNumQueries(0):
+            self.assertEqual(TestAdFilterSet({'q': u'vélo', 'brand': 'myfunkybrand'}).facet_counts(),
+                             {'brand': [('myfunkybrand', 2), ('otherbrand', 1)]})
+        # ad writes invalidate cached counts
+        TestAdFactory.create(brand="otherbrand", description=u"Vélo vert")
+        self.assertEqual(filterset.facet_counts(), {'brand': [('myfunkybrand', 2), ('otherbrand', 2)]})
+        TestNumberAdFactory.create(number=1)
+        TestNumberAdFactory.create_batch(2, number=None)
+        self.assertEqual(TestNumberAdFilterSet({'number': 'true'}).facet_counts(),
+                         {'number': [(False, 2), (True, 1)]})
+        # invalid data select nothing in strict mode, like qs
+        filterset = TestAdFilterSet({'q': u'vélo', 'o': 'unknown'})
+        self.assertEqual(len(filterset), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(filterset.facet_counts(), {'brand': []})
+        cache.clear()
+
+    def test_related_facet(self):
+        class RelatedFacetFilterSet(TestAdFilterSet):
+            username = django_filters.CharFilter(name='user__username')
+            facets = ('username',)
+        cache.clear()
+        self.assertRaises(ImproperlyConfigured, RelatedFacetFilterSet({}).facet_counts)
+
+    def test_slow_filter_queries(self):
+        TestAdFactory.create(brand="myfunkybrand")
+        with patch('geoads.filtersets.GEOADS_SLOW_FILTER_QUERY_THRESHOLD', 0):
+            with patch('geoads.models.GEOADS_SLOW_FILTER_QUERY_MAX_ROWS', 2):
+                for brand in ('myfunkybrand', 'otherbrand', 'lastbrand'):
+                    len(TestAdFilterSet({'brand': brand}))
+        # the log is capped
+        slow_queries = SlowFilterQuery.objects.order_by('id')
+        self.assertEqual([query.search for query in slow_queries], ['brand=otherbrand', 'brand=lastbrand'])
+        self.assertEqual(len(set(query.sql_fingerprint for query in slow_queries)), 1)
+        self.assertTrue('Scan' in slow_queries[0].plan)
+        output = StringIO()
+        call_command('slow_filter_queries', stdout=output)
+        self.assertTrue('2 queries' in output.getvalue())
+        self.assertTrue('search: brand=lastbrand' in output.getvalue())
+        # below the threshold, nothing is recorded
+        len(TestAdFilterSet({'brand': 'myfunkybrand'}))
+        self.assertEqual(SlowFilterQuery.objects.count(), 2)
+
+    def test_slow_filter_queries_hooks(self):
+        TestAdFactory.create(brand="myfunkybrand")
+        with patch('geoads.filtersets.GEOADS_SLOW_FILTER_QUERY_THRESHOLD', 0):
+            # iteration, slices and counts of qs are recorded
+            list(TestAdFilterSet({'brand': 'myfunkybrand'}))
+            TestAdFilterSet({'brand': 'myfunkybrand'}).count()
+            list(TestAdFilterSet({'brand': 'myfunkybrand'})[:10])
+            self.assertEqual(SlowFilterQuery.objects.count(), 3)
+            # values clones, exists and partially consumed iterators too
+            filterset = TestAdFilterSet({'brand': 'myfunkybrand'})
+            self.assertEqual(len(filterset.qs.values_list('id', flat=True)), 1)
+            self.assertTrue(filterset.qs.exists())
+            rows = filterset.qs.iterator()
+            next(rows)
+            rows.close()
+            self.assertEqual(SlowFilterQuery.objects.count(), 6)
+            # searches are truncated to the column size
+            filterset = TestAdFilterSet({'brand': 'x' * 3000})
+            len(filterset)
+            self.assertEqual(len(SlowFilterQuery.objects.latest('id').search), 2550)
+            # a failing log doesn't break the request
+            with patch('geoads.models.explain', side_effect=DatabaseError):
+                self.assertEqual(len(TestAdFilterSet({'brand': 'myfunkybrand'})), 1)
+            self.assertEqual(SlowFilterQuery.objects.count(), 7)
+            self.assertEqual(TestAd.objects.count(), 1)
+
 
 class ModelsTestCase(GeoadsBaseTestCase):
 
@@ -331,6 +809,164 @@ class ModelsTestCase(GeoadsBaseTestCase):
         self.assertRaises(NotImplementedError, ba.get_full_description)
 
 
+class AdFragmentCacheTestCase(GeoadsBaseTestCase):
+
+    def test_adcache_templatetag(self):
+        test_ad = TestAdFactory.create(brand="myfunkybrand")
+        tpl = Template('{% load geoads_tags %}{% adcache ad %}{{ ad.brand }}{% endadcache %}')
+        self.assertEqual(tpl.render(Context({'ad': test_ad})), 'myfunkybrand')
+        # served from cache while the ad doesn't change
+        TestAd.objects.filter(id=test_ad.id).update(brand="mytoofunkybrand")
+        stale_ad = TestAd.objects.get(id=test_ad.id)
+        stale_ad.update_date = test_ad.update_date
+        self.assertEqual(tpl.render(Context({'ad': stale_ad})), 'myfunkybrand')
+        # invalidated by ad save
+        test_ad.brand = "mytoofunkybrand"
+        test_ad.save()
+        self.assertEqual(tpl.render(Context({'ad': test_ad})), 'mytoofunkybrand')
+        # and by explicit invalidation
+        stale_ad.brand = "anotherbrand"
+        stale_ad.update_date = test_ad.update_date
+        invalidate_ad_fragments(test_ad)
+        self.assertEqual(tpl.render(Context({'ad': stale_ad})), 'anotherbrand')
+
+
+class MailTestCase(GeoadsBaseTestCase):
+
+    def test_invalid_form_reports_aggregation(self):
+        user = UserFactory.create()
+        form = TestAdForm({'brand': 'my_guitar'})
+        self.assertFalse(form.is_valid())
+        now = time.time()
+        window = int(now) // GEOADS_INVALID_FORM_REPORT_WINDOW
+        with patch('geoads.mail.time') as mail_time:
+            mail_time.time.return_value = now
+            report_invalid_form(user, form)
+            incr = cache.incr
+            failures = [ValueError()]
+
+            def flaky_incr(key, delta=1):
+                # as if the counter was evicted between add and incr
+                if failures:
+                    raise failures.pop()
+                return incr(key, delta)
+            with patch.object(cache, 'incr', side_effect=flaky_incr):
+                report_invalid_form(user, form)
+        self.assertEqual(flush_invalid_form_reports(window), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(user.email in mail.outbox[0].body)
+        # reports are sent only once
+        self.assertEqual(flush_invalid_form_reports(window), 0)
+
+    def test_invalid_form_reports_cache_failure(self):
+        user = UserFactory.create()
+        form = TestAdForm({'brand': 'my_guitar'})
+        self.assertFalse(form.is_valid())
+        # counter never kept by the cache: the report is sent on its own
+        with patch.object(cache, 'incr', side_effect=ValueError()):
+            report_invalid_form(user, form)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(user.email in mail.outbox[0].body)
+        with patch('geoads.mail.cache', DummyCache('dummy', {})):
+            report_invalid_form(user, form)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_async_backend(self):
+        message = EmailMessage('subject', 'body', 'from@example.org', ['to@example.org'],
+                               connection=object())
+        with patch.object(deliver_messages, 'delay') as delay:
+            self.assertEqual(AsyncEmailBackend().send_messages([message]), 1)
+            self.assertEqual(AsyncEmailBackend().send_messages([]), 0)
+        delay.assert_called_once_with([message])
+        # messages are pickled to the queue without their connection
+        self.assertEqual(message.connection, None)
+
+    def test_deliver_messages_partial_failure(self):
+        messages = [EmailMessage('subject %s' % i, 'body', 'from@example.org', ['to@example.org'])
+                    for i in range(3)]
+        connection = Mock()
+        connection.send_messages.side_effect = [1, smtplib.SMTPException()]
+        with patch('geoads.mail.get_connection', return_value=connection):
+            with patch.object(deliver_messages, 'delay') as delay:
+                with patch('geoads.mail.time') as mail_time:
+                    self.assertEqual(deliver_messages(messages), 1)
+                    self.assertFalse(mail_time.sleep.called)
+                    # messages not yet sent are enqueued again, with a new connection
+                    delay.assert_called_once_with(messages[1:], 1)
+                    self.assertEqual(connection.close.call_count, 1)
+                    # until retries are exhausted
+                    connection.send_messages.side_effect = smtplib.SMTPException()
+                    self.assertRaises(smtplib.SMTPException, deliver_messages,
+                                      messages[1:], GEOADS_MAIL_MAX_RETRIES)
+                    self.assertEqual(delay.call_count, 1)
+                    self.assertEqual(connection.close.call_count, 2)
+                    # retries wait longer each time
+                    mail_time.sleep.assert_called_once_with(
+                        GEOADS_MAIL_RETRY_DELAY * 2 ** (GEOADS_MAIL_MAX_RETRIES - 1))
+
+
+class NotificationsTestCase(GeoadsBaseTestCase):
+
+    def setUp(self):
+        self.ad_search = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                                    content_type=ContentType.objects.get_for_model(TestAd))
+        self.ads = TestAdFactory.create_batch(2, brand="myfunkybrand")
+        self.buyer, self.vendor = self.ad_search.user, self.ads[0].user
+
+    def queue_notifications(self):
+        queue_notifications(PendingNotification.NEW_AD,
+                            [(ad, self.ad_search) for ad in self.ads], 'buyer')
+        queue_notifications(PendingNotification.NEW_INTERESTED_USER,
+                            [(self.ads[0], self.ad_search)], 'vendor')
+
+    def test_immediate(self):
+        # users without preference get GEOADS_NOTIFICATION_FREQUENCY: immediate
+        self.queue_notifications()
+        self.assertEqual(sorted(message.to for message in mail.outbox),
+                         sorted([[self.buyer.email], [self.vendor.email]]))
+        self.assertFalse(PendingNotification.objects.filter(sent_date__isnull=True).exists())
+
+    def test_digests(self):
+        NotificationPreference.objects.create(user=self.buyer, frequency='hourly')
+        NotificationPreference.objects.create(user=self.vendor, frequency='daily')
+        self.queue_notifications()
+        self.assertEqual(len(mail.outbox), 0)
+        # one digest per recipient, with all its notifications
+        self.assertEqual(send_digests('hourly'), 1)
+        self.assertEqual(mail.outbox[0].to, [self.buyer.email])
+        for ad in self.ads:
+            self.assertTrue(ad.slug in mail.outbox[0].body)
+        # notifications are sent once
+        self.assertEqual(send_digests('hourly'), 0)
+        self.assertEqual(send_digests('daily'), 1)
+        self.assertEqual(mail.outbox[1].to, [self.vendor.email])
+
+    def test_digests_partial_failure(self):
+        NotificationPreference.objects.create(user=self.buyer, frequency='hourly')
+        NotificationPreference.objects.create(user=self.vendor, frequency='hourly')
+        self.queue_notifications()
+        connection = Mock()
+        connection.send_messages.side_effect = [1, smtplib.SMTPException()]
+        with patch('geoads.contrib.notifications.models.get_connection', return_value=connection):
+            self.assertRaises(smtplib.SMTPException, send_digests, 'hourly')
+        self.assertTrue(connection.close.called)
+        # digests are sent by recipient id: the first one is sent, it won't be sent again
+        second = max([self.buyer, self.vendor], key=lambda user: user.id)
+        self.assertEqual(set(PendingNotification.objects.filter(sent_date__isnull=True)
+                             .values_list('recipient', flat=True)), set([second.id]))
+        self.assertEqual(send_digests('hourly'), 1)
+        self.assertEqual([message.to for message in mail.outbox], [[second.email]])
+
+    def test_command(self):
+        NotificationPreference.objects.create(user=self.buyer, frequency='hourly')
+        NotificationPreference.objects.create(user=self.vendor, frequency='hourly')
+        self.queue_notifications()
+        stdout = StringIO()
+        call_command('send_notification_digests', frequency='hourly', stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), '2 digests sent.')
+        self.assertEqual(len(mail.outbox), 2)
+
+
 class UtilsTestCase(GeoadsBaseTestCase):
 
     def test_geocode(self):
@@ -338,6 +974,48 @@ class UtilsTestCase(GeoadsBaseTestCase):
         self.assertTrue('address' in geo)
         self.assertTrue('location' in geo)
 
+    def test_resolve_content_objects(self):
+        test_ads = TestAdFactory.create_batch(3, brand="myfunkybrand")
+        test_number_ad = TestNumberAdFactory.create(number=1)
+        # searches without criteria get all ads
+        TestAdSearchFactory.create(search="", content_type=ContentType.objects.get_for_model(TestAd))
+        TestAdSearchFactory.create(search="", content_type=ContentType.objects.get_for_model(TestNumberAd))
+        results = list(AdSearchResult.objects.all())
+        with self.assertNumQueries(2):
+            resolve_content_objects(results)
+        with self.assertNumQueries(0):
+            content_objects = set(result.content_object for result in results)
+        self.assertEquals(content_objects, set(test_ads + [test_number_ad]))
+
+    def test_geocode_metrics(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('localhost', 0))
+        server.settimeout(1)
+        backend = metrics.backend
+        metrics.backend = metrics.StatsdMetrics(port=server.getsockname()[1])
+        geo = {'address': {}, 'location': None}
+        cache.clear()
+        try:
+            with patch('geoads.utils._geocode', return_value=geo) as _geocode:
+                # not cached by default
+                self.assertEqual(geocode(u'13 place d\'Aligre Paris'), geo)
+                self.assertEqual(_geocode.call_count, 1)
+                packet = server.recv(512)
+                with patch('geoads.utils.GEOADS_GEOCODE_CACHE_TIMEOUT', 3600):
+                    self.assertEqual(geocode(u'13 place d\'Aligre Paris'), geo)
+                    self.assertEqual(geocode(u'13 place d\'Aligre Paris'), geo)
+            self.assertEqual(_geocode.call_count, 2)
+            packets = [server.recv(512) for i in range(3)]
+        finally:
+            metrics.backend = backend
+            server.close()
+            cache.clear()
+        self.assertTrue(packet.startswith('geoads.geocode.latency:'))
+        self.assertEqual(packets[0], 'geoads.geocode.cache_misses:1|c|#backend:%s' % settings.GEOCODE)
+        self.assertTrue(packets[1].startswith('geoads.geocode.latency:'))
+        self.assertTrue(packets[1].endswith('|ms|#backend:%s' % settings.GEOCODE))
+        self.assertEqual(packets[2], 'geoads.geocode.cache_hits:1|c|#backend:%s' % settings.GEOCODE)
+
 
 class GeoadsSignalsTestCase(GeoadsBaseTestCase):
 
@@ -355,9 +1033,30 @@ class GeoadsSignalsTestCase(GeoadsBaseTestCase):
                 ad = TestAdFactory.create(brand="myfunkybrand")
                 self.assertEquals(receiver_buyer.call_count, 1)
                 self.assertEquals(receiver_vendor.call_count, 1)
+                # legacy receivers get the saved result
+                relevant_search = receiver_buyer.call_args[1]['relevant_search']
+                self.assertEquals(relevant_search, AdSearchResult.objects.get(ad_search=adsearch))
                 adsearch.delete()
                 ad.delete()
 
+    def test_concurrent_results_insert(self):
+        """
+        Results inserted by a concurrent matching pass don't break the bulk INSERT
+        """
+        content_type = ContentType.objects.get_for_model(TestAd)
+        ads = TestAdFactory.create_batch(2, brand="myfunkybrand")
+        adsearch = TestAdSearchFactory.create(search="brand=otherbrand", content_type=content_type)
+        AdSearchResult.objects.create(ad_search=adsearch, content_type=content_type, object_pk=ads[0].pk)
+        with mock_signal_receiver(geoad_new_relevant_ads_for_searches) as receiver_buyers:
+            created = create_ad_search_results([
+                AdSearchResult(ad_search=adsearch, content_type=content_type, object_pk=ad.pk) for ad in ads])
+            self.assertEqual(created, [])
+            # the missing row is created and notified by get_or_create
+            self.assertEqual(receiver_buyers.call_count, 1)
+        self.assertEqual(set(AdSearchResult.objects.filter(ad_search=adsearch).values_list('object_pk', flat=True)),
+                         set(ad.pk for ad in ads))
+        self.assertEqual(AdSearch.objects.get(pk=adsearch.pk).unread_count, 2)
+
     def test_ad_adsearch_and_ads_signals_2(self):
         """
         Test if signals are well sent to the buyer and the seller
@@ -454,6 +1153,25 @@ class GeoadsSignalsTestCase(GeoadsBaseTestCase):
                 adsearch.delete()
                 ad.delete()
 
+    def test_batch_signals(self):
+        """
+        Test that batch signals are sent once per matching pass
+        with all the new (ad, ad_search) pairs
+        """
+        with mock_signal_receiver(geoad_new_relevant_ads_for_searches) as receiver_buyers:
+            with mock_signal_receiver(geoad_new_interested_users) as receiver_vendors:
+                content_type = ContentType.objects.get_for_model(TestAd)
+                public_adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                                             content_type=content_type, public=True)
+                private_adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                                              content_type=content_type, public=False)
+                ad = TestAdFactory.create(brand="myfunkybrand")
+                self.assertEquals(receiver_buyers.call_count, 1)
+                self.assertEquals(set(receiver_buyers.call_args[1]['pairs']),
+                                  set([(ad, public_adsearch), (ad, private_adsearch)]))
+                self.assertEquals(receiver_vendors.call_count, 1)
+                self.assertEquals(receiver_vendors.call_args[1]['pairs'], [(ad, public_adsearch)])
+
     def test_remove_ad_from_ad_search(self):
         with mock_signal_receiver(geoad_new_relevant_ad_for_search) as receiver_buyer:
             with mock_signal_receiver(geoad_new_interested_user) as receiver_vendor:
@@ -481,6 +1199,128 @@ class GeoadsSignalsTestCase(GeoadsBaseTestCase):
         ad.delete()
         adsearch.delete()
 
+    def test_soft_deleted_ad(self):
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                              content_type=ContentType.objects.get_for_model(TestAd))
+        self.assertEqual(adsearch.adsearchresult_set.count(), 1)
+        ad.delete_date = timezone.now()
+        ad.save()
+        self.assertFalse(TestAd.objects.filter(id=ad.id).exists())
+        self.assertTrue(TestAd.all_objects.filter(id=ad.id).exists())
+        self.assertEqual(adsearch.adsearchresult_set.count(), 0)
+
+    def test_soft_deleted_ad_slug(self):
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        ad.delete_date = timezone.now()
+        ad.save()
+        # the soft deleted ad still holds its slug
+        other_ad = TestAdFactory.create(brand="myfunkybrand")
+        self.assertNotEqual(other_ad.slug, TestAd.all_objects.get(id=ad.id).slug)
+
+    def test_reap_orphans(self):
+        ads = TestAdFactory.create_batch(2, brand="myfunkybrand")
+        adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                              content_type=ContentType.objects.get_for_model(TestAd))
+        # hard delete, without signals
+        connection.cursor().execute('DELETE FROM customads_testad WHERE id = %s', [ads[0].id])
+        self.assertEqual(reap_orphans(batch_size=1)['AdSearchResult'], 1)
+        self.assertEqual([result.content_object for result in adsearch.adsearchresult_set.all()],
+                         [ads[1]])
+
+
+class RebuildAdSearchResultsCommandTestCase(GeoadsBaseTestCase):
+
+    def test_rebuild(self):
+        ad = TestAdFactory.create(brand="myfunkybrand")
+        adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                              content_type=ContentType.objects.get_for_model(TestAd),
+                                              public=True)
+        AdSearchResult.objects.all().delete()
+        # dry run doesn't write anything
+        call_command('rebuild_adsearchresults', dry_run=True, stdout=StringIO())
+        self.assertEqual(AdSearchResult.objects.count(), 0)
+        call_command('rebuild_adsearchresults', stdout=StringIO())
+        self.assertEqual(list(AdSearchResult.objects.values_list('ad_search', 'object_pk')),
+                         [(adsearch.id, ad.id)])
+        # stale results are removed
+        TestAd.objects.filter(id=ad.id).update(brand="mytoofunkybrand")
+        call_command('rebuild_adsearchresults', models=['customads.testad'], stdout=StringIO())
+        self.assertEqual(AdSearchResult.objects.count(), 0)
+
+
+class BenchmarkCommandTestCase(GeoadsBaseTestCase):
+
+    def test_benchmark(self):
+        output = StringIO()
+        try:
+            call_command('geoads_benchmark', ads=20, searches=5, repeat=1, stdout=output)
+        finally:
+            # the command ran on its own database
+            ContentType.objects.clear_cache()
+            cache.clear()
+        results = json.loads(output.getvalue())['results']
+        for path in ('rebuild_adsearchresults', 'ad_save_matching', 'adsearch_save_materialization',
+                     'adsearchview_filter', 'adsearchview_read', 'geocode_stubbed'):
+            self.assertEqual(results[path]['n'], 1)
+
+
+class IndexesTestCase(GeoadsBaseTestCase):
+    """
+    Canonical geoads queries must not fall back to sequential scans
+    on a large dataset
+    """
+
+    def setUp(self):
+        super(IndexesTestCase, self).setUp()
+        create_indexes()
+        user = UserFactory.create()
+        self.ad_search = TestAdSearchFactory.create(user=user, search="brand=myfunkybrand",
+                                                    content_type=ContentType.objects.get_for_model(TestAd))
+        cursor = connection.cursor()
+        cursor.execute("""INSERT INTO customads_testad (user_id, slug, user_entered_address, location,
+                                                        update_date, create_date, delete_date,
+                                                        buyers_count, contacted_buyers_count)
+                          SELECT %s, 'ad-' || n, 'Paris', ST_GeomFromText('POINT(' || n || ' ' || n || ')', 900913),
+                                 now(), now(), CASE WHEN mod(n, 10) = 0 THEN now() END, 0, 0
+                          FROM generate_series(1, 20000) AS n""", [user.id])
+        cursor.execute("""INSERT INTO ads_adsearch (search, user_id, create_date, content_type_id,
+                                                    public, unread_count)
+                          SELECT '', %s, now(), ct.id, mod(n, 2) = 0, 0
+                          FROM django_content_type AS ct, generate_series(1, 200) AS n""", [user.id])
+        cursor.execute("""INSERT INTO ads_adsearchresult (ad_search_id, content_type_id, object_pk,
+                                                          create_date, contacted)
+                          SELECT s.id, s.content_type_id, n, now(), mod(n, 5) = 0
+                          FROM ads_adsearch AS s, generate_series(1, 10) AS n""")
+        cursor.execute("""INSERT INTO ads_adcontact (user_id, content_type_id, object_pk, message)
+                          SELECT %s, %s, n, 'Hi buddy !' FROM generate_series(1, 20000) AS n""",
+                       [user.id, self.ad_search.content_type_id])
+        cursor.execute("""INSERT INTO ads_adpicture (content_type_id, object_id, image)
+                          SELECT %s, n, 'pictures/' || n || '.jpg' FROM generate_series(1, 20000) AS n""",
+                       [self.ad_search.content_type_id])
+        for model in (TestAd, AdSearch, AdSearchResult, AdContact, AdPicture):
+            cursor.execute('ANALYZE %s' % connection.ops.quote_name(model._meta.db_table))
+
+    def assertNoSeqScan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertFalse('Seq Scan' in plan, plan)
+
+    def test_canonical_queries(self):
+        content_type = self.ad_search.content_type
+        self.assertNoSeqScan(AdSearchResult.objects.filter(content_type=content_type, object_pk=1))
+        self.assertNoSeqScan(AdSearchResult.objects.filter(ad_search=self.ad_search, contacted=True))
+        self.assertNoSeqScan(AdSearch.objects.filter(content_type=content_type, public=True))
+        self.assertNoSeqScan(AdSearch.objects.filter(public=True).order_by('-id')[:100])
+        self.assertNoSeqScan(AdContact.objects.filter(content_type=content_type, object_pk=1))
+        self.assertNoSeqScan(AdPicture.objects.filter(content_type=content_type, object_id=1))
+        self.assertNoSeqScan(TestAd.objects.filter(delete_date__isnull=True).order_by('-update_date')[:10])
+        self.assertNoSeqScan(TestAd.objects.filter(
+            location__within='SRID=900913;POLYGON((0 0, 0 100, 100 100, 100 0, 0 0))'))
+        self.assertNoSeqScan(TestAdFilterSet({'q': 'myfunkybrand'}).qs)
+
 
 class AdModelPropertyTestCase(TestCase):
 
@@ -494,6 +1334,22 @@ class AdModelPropertyTestCase(TestCase):
         adsearch.save()
         self.assertEqual(ad.public_adsearch, [])
 
+    def test_ad_manager_public_adsearch(self):
+        ads = TestAdFactory.create_batch(3, brand="myfunkybrand")
+        adsearch = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                              content_type=ContentType.objects.get_for_model(TestAd),
+                                              public=True)
+        TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                   content_type=ContentType.objects.get_for_model(TestAd),
+                                   public=False)
+        with self.assertNumQueries(1):
+            counts = [(ad.id, ad.public_adsearch_count)
+                      for ad in TestAd.objects.with_public_adsearch_count().order_by('id')]
+        self.assertEqual(counts, [(ad.id, 1) for ad in ads])
+        with self.assertNumQueries(3):
+            public_adsearch = [ad.public_adsearch for ad in TestAd.objects.prefetch_public_adsearch()]
+        self.assertEqual(public_adsearch, [[adsearch]] * 3)
+
 
 class GeoadsModerationTestCase(TestCase):
 
@@ -511,6 +1367,65 @@ class GeoadsModerationTestCase(TestCase):
                 self.assertEquals(mod_in_progress.call_count, 1)
                 self.assertEquals(save_ended.call_count, 1)
 
+    def test_moderation_matching(self):
+        ad_search = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                               content_type=ContentType.objects.get_for_model(TestModeratedAd))
+        ad = TestModeratedAdFactory(brand="myfunkybrand")
+        # pending ads are hidden, they belong to no search
+        self.assertEqual(len(TestModeratedAd.filterset()({'brand': 'myfunkybrand'})), 0)
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 0)
+        ad.moderated_object.approve()
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 1)
+        # status didn't change: no matching
+        with mock_signal_receiver(geoad_post_save_ended) as save_ended:
+            TestModeratedAd.objects.get(pk=ad.pk).moderated_object.approve()
+            self.assertEqual(save_ended.call_count, 0)
+        ad.moderated_object.reject()
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 0)
+        self.assertEqual(AdSearch.objects.get(pk=ad_search.pk).unread_count, 0)
+
+    def test_bulk_moderation(self):
+        ad_search = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                               content_type=ContentType.objects.get_for_model(TestModeratedAd))
+        ads = TestModeratedAdFactory.create_batch(3, brand="myfunkybrand")
+        request = RequestFactoryWithMessages().get('/')
+        request.user = UserFactory.create(is_staff=True)
+        model_admin = ModeratedAdAdmin(TestModeratedAd, admin.site)
+        queryset = TestModeratedAd.unmoderated_objects.filter(pk__in=[ad.pk for ad in ads])
+        with patch('geoads.contrib.moderation.moderator.ad_post_save_handler') as ad_post_save_handler:
+            with mock_signal_receiver(geoad_new_relevant_ads_for_searches) as new_results:
+                model_admin.approve_selected(request, queryset)
+        # one batched matching pass, instead of a job per ad
+        self.assertFalse(ad_post_save_handler.called)
+        self.assertEqual(new_results.call_count, 1)
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 3)
+        self.assertEqual(AdSearch.objects.get(pk=ad_search.pk).unread_count, 3)
+        model_admin.reject_selected(request, queryset)
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 0)
+        self.assertEqual(AdSearch.objects.get(pk=ad_search.pk).unread_count, 0)
+
+    def test_nested_batched_matching(self):
+        ad_search = TestAdSearchFactory.create(search="brand=myfunkybrand",
+                                               content_type=ContentType.objects.get_for_model(TestModeratedAd))
+        ads = TestModeratedAdFactory.create_batch(2, brand="myfunkybrand")
+        with mock_signal_receiver(geoad_new_relevant_ads_for_searches) as new_results:
+            with batched_matching():
+                ads[0].moderated_object.approve()
+                with batched_matching():
+                    ads[1].moderated_object.approve()
+                # the outer block matches the ads of both
+                self.assertEqual(new_results.call_count, 0)
+            self.assertEqual(new_results.call_count, 1)
+        self.assertEqual(AdSearchResult.objects.filter(ad_search=ad_search).count(), 2)
+
+    def test_aborted_moderation(self):
+        ad = TestModeratedAdFactory(brand="myfunkybrand")
+        with patch.object(ModeratedObject, '_moderate', side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, ad.moderated_object.approve)
+        TestModeratedAd.unmoderated_objects.get(pk=ad.pk).moderated_object.approve()
+        # the status left by the aborted moderation is dropped
+        self.assertEqual(moderator_module._state.previous, {})
+
     def test_ad_update(self):
         self.factory = RequestFactory()
         test_ad = TestModeratedAdFactory.create()
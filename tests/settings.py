@@ -134,6 +134,7 @@ INSTALLED_APPS = (
     'customads',
     'geoads',
     'geoads.contrib.moderation', 
+    'geoads.contrib.notifications',
 )
 
 # specific test setting for coverage information
@@ -1,7 +1,8 @@
 from django.conf.urls import patterns, url
 from geoads.views import (AdSearchView, AdDetailView, AdSearchDeleteView,
                           AdCreateView,  AdUpdateView, CompleteView, AdDeleteView, 
-                          AdPotentialBuyersView, AdPotentialBuyerContactView)
+                          AdPotentialBuyersView, AdPotentialBuyerContactView,
+                          AdSearchResultFeedView, ProfileListView)
 from geoads.models import AdSearchResult
 from tests.customads.models import TestAd
 from tests.customads.forms import TestAdForm
@@ -14,6 +15,9 @@ auto_discover()
 
 urlpatterns = patterns('',
     url(r'^(?P<slug>[-\w]+)$', AdDetailView.as_view(model=TestAd), name="view"),
+    url(r'^search/feed/$', AdSearchResultFeedView.as_view(), name='search_feed'),
+    url(r'^profiles/$', ProfileListView.as_view(), name='profiles'),
+    url(r'^profiles/(?P<name>[\w.-]+\.prof)$', ProfileListView.as_view(), name='profile'),
     url(r'^search/$', AdSearchView.as_view(model=TestAd), name='search'),
     url(r'^search/(?P<search_id>\d+)/$', AdSearchView.as_view(model=TestAd), name='search'),
     url(r'^delete_search/(?P<pk>\d+)$', AdSearchDeleteView.as_view(), name='delete_search'),